@@ -1,11 +1,14 @@
 __all__ = ['__version__']
 
 import sys
+import time
 from typing import NoReturn
 
 import structlog
 
 __version__ = '2.2.2'
+# for "ready in N ms", if process start time is not available
+STARTED_AT = time.perf_counter()
 
 logger = structlog.get_logger()
 
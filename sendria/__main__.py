@@ -1,3 +1,5 @@
 from sendria.cli import main
 
-main()
+# guarded: worker processes of import (spawned) import the main module too
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""Load generator and benchmark suite for Sendria: SMTP ingest and HTTP API.
+
+Runs Sendria on a temporary database and random local ports, so it never needs network access.
+Usage: ``sendria-bench --help``.
+"""
+
+__all__ = []
@@ -0,0 +1,3 @@
+from sendria.bench.cli import main
+
+main()
@@ -0,0 +1,192 @@
+__all__ = ['main']
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+from typing import NoReturn, List, Dict, Any
+
+from .. import __version__
+from . import http_load
+from . import smtp_load
+from . import startup
+from .server import Server, RSSSampler
+from .stats import compare
+
+
+def parse_argv(argv: List) -> argparse.Namespace:
+    parser = argparse.ArgumentParser('sendria-bench',
+        description='Start Sendria on a temporary database and measure SMTP ingest and HTTP API performance.')
+    parser.add_argument('-v', '--version', action='version', version=f'%(prog)s {__version__}')
+
+    group = parser.add_argument_group('SMTP load')
+    group.add_argument('-m', '--messages', type=int, default=1000, metavar='N',
+        help='How many messages to send (default: 1000)')
+    group.add_argument('-c', '--concurrency', type=int, default=10, metavar='N',
+        help='Number of concurrent SMTP connections (default: 10)')
+    group.add_argument('--size', type=int, default=2048, metavar='BYTES',
+        help='Approximate size of text body of every message (default: 2048)')
+    group.add_argument('--attachment-ratio', type=float, default=0.2, metavar='RATIO',
+        help='Fraction of messages with attachments, 0..1 (default: 0.2)')
+    group.add_argument('--attachments', type=int, default=1, metavar='N',
+        help='Number of attachments in message with attachments (default: 1)')
+    group.add_argument('--attachment-size', type=int, default=32768, metavar='BYTES',
+        help='Size of every attachment (default: 32768)')
+    group.add_argument('--multipart-depth', type=int, default=1, metavar='N',
+        help='0: plain text messages, 1: text and html alternative, more: alternative nested in multipart/mixed '
+            '(default: 1)')
+    group.add_argument('--seed', type=int, default=0, help='Seed for generated messages (default: 0)')
+
+    group = parser.add_argument_group('HTTP scenarios')
+    group.add_argument('--scenarios', default=','.join(http_load.SCENARIOS),
+        help=f'Comma separated list of HTTP scenarios to run, empty to skip (default: {",".join(http_load.SCENARIOS)})')
+    group.add_argument('--http-requests', type=int, default=500, metavar='N',
+        help='Requests for every HTTP scenario (default: 500)')
+    group.add_argument('--http-concurrency', type=int, default=10, metavar='N',
+        help='Concurrent HTTP requests (default: 10)')
+
+    group = parser.add_argument_group('Startup')
+    group.add_argument('--startup-runs', type=int, default=3, metavar='N',
+        help='How many times to measure import time and cold start of Sendria, 0 to skip (default: 3)')
+    group.add_argument('--startup-only', action='store_true',
+        help='Measure only import time and cold start, skip SMTP load and HTTP scenarios')
+
+    group = parser.add_argument_group('Results')
+    group.add_argument('-o', '--output', metavar='PATH', help='Save results as JSON to given file (default: stdout)')
+    group.add_argument('--compare', metavar='PATH', help='Compare results with previous ones, saved with --output')
+    group.add_argument('--sendria-args', default='', metavar='ARGS',
+        help='Additional arguments for Sendria, ie: "--websocket-coalesce-time 0"')
+    group.add_argument('--keep-dir', action='store_true',
+        help='Do not remove temporary directory with database and log of Sendria')
+    group.add_argument('--timeout', type=float, default=60.0, metavar='SECONDS',
+        help='How long to wait for Sendria to start and for all messages to be delivered (default: 60)')
+
+    args = parser.parse_args(argv)
+
+    if args.startup_runs < 0:
+        parser.error('--startup-runs must not be negative')
+    if args.startup_only and not args.startup_runs:
+        parser.error('--startup-only requires --startup-runs greater than 0')
+    if args.messages < 1:
+        parser.error('--messages must be greater than 0')
+    if not 0 <= args.attachment_ratio <= 1:
+        parser.error('--attachment-ratio must be between 0 and 1')
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(args.scenarios) - set(http_load.SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    return args
+
+
+def _progress(msg: str) -> NoReturn:
+    print(msg, file=sys.stderr, flush=True)
+
+
+async def run_startup(args: argparse.Namespace) -> Dict[str, Any]:
+    _progress(f'measuring import time and cold start, {args.startup_runs} runs')
+    ret = await startup.run_startup(args.startup_runs, shlex.split(args.sendria_args), args.timeout)
+    _progress(f'import: {ret["import"].get("p50")} ms, ready for SMTP: {ret["smtp_ready"].get("p50")} ms '
+        f'(budget: {ret["budget"]} ms)')
+    return ret
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    spec = smtp_load.MessageSpec(
+        size=args.size,
+        attachment_ratio=args.attachment_ratio,
+        attachments=args.attachments,
+        attachment_size=args.attachment_size,
+        multipart_depth=args.multipart_depth,
+    )
+    run_id = f'{os.getpid()}-{int(time.time())}'
+    _progress(f'generating {args.messages} messages')
+    messages = smtp_load.build_messages(args.messages, spec, run_id, args.seed)
+
+    server = Server(shlex.split(args.sendria_args), keep_dir=args.keep_dir)
+    _progress('starting Sendria')
+    await server.start(args.timeout)
+    try:
+        _progress(f'Sendria started in {server.startup_time:.3f}s, sending messages')
+        with RSSSampler(server) as rss:
+            smtp = await smtp_load.run_load('127.0.0.1', server.smtp_port, server.http_url, messages,
+                concurrency=args.concurrency, timeout=args.timeout)
+            _progress(f'{smtp["delivered"]}/{smtp["messages"]} messages delivered, '
+                f'{smtp["messages_per_second"]} messages/s')
+
+            http = {}
+            if args.scenarios:
+                _progress(f'running HTTP scenarios: {", ".join(args.scenarios)}')
+                http = await http_load.run_scenarios(server.http_url, args.scenarios,
+                    requests=args.http_requests, concurrency=args.http_concurrency)
+        db_size = server.db_path.stat().st_size
+    finally:
+        server.stop()
+        if args.keep_dir:
+            _progress(f'database and log kept in {server.tmp_dir}')
+
+    return {
+        'params': {
+            'messages': args.messages,
+            'concurrency': args.concurrency,
+            'message': spec.to_dict(),
+            'seed': args.seed,
+            'http_requests': args.http_requests,
+            'http_concurrency': args.http_concurrency,
+            'sendria_args': args.sendria_args,
+        },
+        'startup_time': round(server.startup_time, 3),
+        'smtp': smtp,
+        'http': http,
+        'rss': rss.to_dict(),
+        'db_size': db_size,
+    }
+
+
+def _print_comparison(rows: List[Dict[str, Any]]) -> NoReturn:
+    _progress(f'{"":40} {"baseline":>12} {"current":>12} {"change":>9}')
+    for row in rows:
+        change = '' if row['change'] is None else f'{row["change"]:+.2f}%'
+        mark = {True: ' +', False: ' -', None: ''}[row['better']]
+        _progress(f'{row["name"]:40} {str(row["baseline"]):>12} {str(row["current"]):>12} {change:>9}{mark}')
+
+
+def main() -> NoReturn:
+    args = parse_argv(sys.argv[1:])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    try:
+        results = {
+            'sendria_version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+        if args.startup_runs:
+            results['startup'] = asyncio.run(run_startup(args))
+        if not args.startup_only:
+            results.update(asyncio.run(run(args)))
+    except (RuntimeError, subprocess.CalledProcessError) as exc:
+        _progress(str(exc))
+        sys.exit(1)
+
+    if baseline is not None:
+        results['comparison'] = compare(baseline, results)
+        _print_comparison(results['comparison'])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+        _progress(f'results saved to {args.output}')
+    else:
+        print(output)
@@ -0,0 +1,93 @@
+__all__ = ['SCENARIOS', 'run_scenarios']
+
+import asyncio
+import itertools
+import time
+from typing import NoReturn, List, Dict, Any, Iterator, Optional
+
+import aiohttp
+
+from .stats import summarize
+
+# in order of execution: detail collects urls used by html and part
+SCENARIOS = ('list', 'detail', 'html', 'part')
+
+
+async def _run_requests(session: aiohttp.ClientSession, urls: Iterator[str], requests: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker() -> NoReturn:
+        nonlocal errors
+        while next(counter) < requests:
+            url = next(urls)
+            started_at = time.monotonic()
+            try:
+                async with session.get(url) as rsp:
+                    await rsp.read()
+                    if rsp.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - started_at)
+
+    started_at = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.monotonic() - started_at, errors)
+
+
+async def _collect_messages(session: aiohttp.ClientSession, base_url: str) -> Dict[str, Any]:
+    async with session.get(f'{base_url}/api/messages/') as rsp:
+        data = await rsp.json()
+    return {
+        'ids': [row['id'] for row in data['data']],
+        'pages': max(1, data['meta']['pages_total']),
+    }
+
+
+async def run_scenarios(base_url: str, scenarios: List[str], requests: int = 200,
+    concurrency: int = 10,
+) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    async with aiohttp.ClientSession() as session:
+        messages = await _collect_messages(session, base_url)
+        if not messages['ids']:
+            return results
+
+        html_urls: List[str] = []
+        part_urls: List[str] = []
+
+        async def collect_formats() -> NoReturn:
+            for message_id in messages['ids']:
+                async with session.get(f'{base_url}/api/messages/{message_id}.json') as rsp:
+                    data = (await rsp.json())['data']
+                if 'html' in data['formats']:
+                    html_urls.append(base_url + data['formats']['html'])
+                part_urls.extend(base_url + part['href'] for part in data['attachments'])
+
+        for scenario in SCENARIOS:
+            if scenario not in scenarios:
+                continue
+
+            urls: Optional[Iterator[str]] = None
+            if scenario == 'list':
+                urls = itertools.cycle(f'{base_url}/api/messages/?page={page}' for page in range(1, messages['pages'] + 1))
+            elif scenario == 'detail':
+                urls = itertools.cycle(f'{base_url}/api/messages/{message_id}.json' for message_id in messages['ids'])
+            else:
+                if not html_urls and not part_urls:
+                    await collect_formats()
+                selected = html_urls if scenario == 'html' else part_urls
+                if selected:
+                    urls = itertools.cycle(selected)
+
+            if urls is None:
+                results[scenario] = {'skipped': 'no matching messages'}
+                continue
+            results[scenario] = await _run_requests(session, urls, requests, concurrency)
+    return results
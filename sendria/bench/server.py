@@ -0,0 +1,152 @@
+__all__ = ['Server', 'RSSSampler']
+
+import asyncio
+import os
+import pathlib
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional, NoReturn, List, Dict
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, deadline: float) -> bool:
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return True
+    return False
+
+
+class Server:
+    """Sendria started in subprocess, with temporary database and config dir, listening on random local ports."""
+
+    def __init__(self, extra_args: List[str] = (), keep_dir: bool = False) -> NoReturn:
+        self.extra_args = list(extra_args)
+        self.keep_dir = keep_dir
+        self.smtp_port = _free_port()
+        self.http_port = _free_port()
+        self.tmp_dir: Optional[pathlib.Path] = None
+        self.process: Optional[subprocess.Popen] = None
+        self.startup_time: Optional[float] = None
+        self.smtp_ready_time: Optional[float] = None
+        self._tmp: Optional[tempfile.TemporaryDirectory] = None
+
+    @property
+    def http_url(self) -> str:
+        return f'http://127.0.0.1:{self.http_port}'
+
+    @property
+    def log_path(self) -> pathlib.Path:
+        return self.tmp_dir / 'sendria.log'
+
+    @property
+    def db_path(self) -> pathlib.Path:
+        return self.tmp_dir / 'bench.db'
+
+    async def start(self, timeout: float = 30.0) -> NoReturn:
+        if self.keep_dir:
+            self.tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix='sendria-bench-'))
+        else:
+            self._tmp = tempfile.TemporaryDirectory(prefix='sendria-bench-')
+            self.tmp_dir = pathlib.Path(self._tmp.name)
+
+        cmd = [
+            sys.executable, '-m', 'sendria',
+            '--db', str(self.db_path),
+            '--foreground',
+            '--smtp-ip', '127.0.0.1', '--smtp-port', str(self.smtp_port),
+            '--http-ip', '127.0.0.1', '--http-port', str(self.http_port),
+            *self.extra_args,
+        ]
+        env = dict(os.environ, SENDRIA_CONFIG_DIR=str(self.tmp_dir))
+
+        started_at = time.monotonic()
+        with self.log_path.open('wb') as log:
+            self.process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)  # noqa: S603
+
+        deadline = started_at + timeout
+        for port in (self.smtp_port, self.http_port):
+            if not await _wait_for_port(port, deadline) or self.process.poll() is not None:
+                self.stop()
+                raise RuntimeError(f'Sendria did not start, see log:\n{self.log()}')
+            if port == self.smtp_port:
+                self.smtp_ready_time = time.monotonic() - started_at
+        self.startup_time = time.monotonic() - started_at
+
+    def log(self, lines: int = 30) -> str:
+        try:
+            return '\n'.join(self.log_path.read_text(errors='replace').splitlines()[-lines:])
+        except OSError:
+            return ''
+
+    def rss(self) -> Optional[int]:
+        """Resident memory of Sendria process in bytes, None if not available on this platform."""
+        if not self.process:
+            return None
+        try:
+            with open(f'/proc/{self.process.pid}/status') as fh:
+                for line in fh:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def stop(self, timeout: float = 10.0) -> NoReturn:
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._tmp:
+            self._tmp.cleanup()
+            self._tmp = None
+
+
+class RSSSampler:
+    """Samples RSS of the server in the background, to report its peak."""
+
+    def __init__(self, server: Server, interval: float = 0.1) -> NoReturn:
+        self.server = server
+        self.interval = interval
+        self.start = server.rss()
+        self.peak = self.start
+        self.end: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> NoReturn:
+        while True:
+            rss = self.server.rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self) -> 'RSSSampler':
+        self._task = asyncio.get_event_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc) -> NoReturn:
+        self._task.cancel()
+        self.end = self.server.rss()
+
+    def to_dict(self) -> Dict[str, Optional[int]]:
+        return {
+            'start': self.start,
+            'peak': self.peak,
+            'end': self.end,
+        }
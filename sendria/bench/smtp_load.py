@@ -0,0 +1,237 @@
+__all__ = ['MessageSpec', 'build_messages', 'SMTPClient', 'run_load']
+
+import asyncio
+import json
+import random
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from typing import Optional, NoReturn, List, Dict, Any, Tuple
+
+import aiohttp
+
+from .stats import summarize
+
+SENDER = 'bench@sendria.test'
+RECIPIENTS = ('alice@sendria.test', 'bob@example.test', 'carol@qa.sendria.test')
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+    'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+class SMTPError(Exception):
+    pass
+
+
+class MessageSpec:
+    """Shape of generated messages."""
+    __slots__ = ('size', 'attachment_ratio', 'attachments', 'attachment_size', 'multipart_depth')
+
+    def __init__(self, size: int = 2048, attachment_ratio: float = 0.0, attachments: int = 1,
+        attachment_size: int = 32768, multipart_depth: int = 1,
+    ) -> NoReturn:
+        self.size = size
+        self.attachment_ratio = attachment_ratio
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.multipart_depth = multipart_depth
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def _text(rnd: random.Random, size: int) -> str:
+    lines, line, length = [], [], 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        line.append(word)
+        length += len(word) + 1
+        if len(line) == 12:
+            lines.append(' '.join(line))
+            line = []
+    lines.append(' '.join(line))
+    return '\n'.join(lines)
+
+
+def _build_message(rnd: random.Random, spec: MessageSpec, subject: str) -> bytes:
+    text = _text(rnd, spec.size)
+    if spec.multipart_depth < 1:
+        email = MIMEText(text)
+    else:
+        # text + html alternative, wrapped in (depth - 1) levels of multipart/mixed
+        email = MIMEMultipart('alternative')
+        email.attach(MIMEText(text))
+        email.attach(MIMEText('<html><body><p>{}</p><a href="http://sendria.test/">link</a></body></html>'.format(
+            text.replace('\n', '</p>\n<p>')), 'html'))
+        for _ in range(spec.multipart_depth - 1):
+            wrapper = MIMEMultipart('mixed')
+            wrapper.attach(email)
+            email = wrapper
+
+    if spec.attachments and rnd.random() < spec.attachment_ratio:
+        if not email.is_multipart():
+            wrapper = MIMEMultipart('mixed')
+            wrapper.attach(email)
+            email = wrapper
+        for idx in range(spec.attachments):
+            payload = rnd.getrandbits(8 * spec.attachment_size).to_bytes(spec.attachment_size, 'little')
+            attachment = MIMEApplication(payload)
+            attachment.add_header('Content-Disposition', 'attachment', filename=f'attachment-{idx}.bin')
+            email.attach(attachment)
+
+    email['From'] = SENDER
+    email['To'] = ', '.join(RECIPIENTS[:rnd.randint(1, len(RECIPIENTS))])
+    email['Subject'] = subject
+    email['Date'] = formatdate()
+    email['Message-Id'] = make_msgid(domain='sendria.test')
+    return email.as_bytes()
+
+
+def _smtp_data(message: bytes) -> bytes:
+    lines = message.replace(b'\r\n', b'\n').split(b'\n')
+    # dot stuffing, see RFC 5321 4.5.2
+    lines = [b'.' + line if line.startswith(b'.') else line for line in lines]
+    return b'\r\n'.join(lines) + b'\r\n.\r\n'
+
+
+def build_messages(count: int, spec: MessageSpec, run_id: str, seed: int = 0) -> List[Tuple[str, bytes]]:
+    """Messages ready to be sent as SMTP DATA, with unique subjects used to track their delivery."""
+    rnd = random.Random(seed)  # noqa: S311
+    ret = []
+    for idx in range(count):
+        subject = f'bench {run_id} {idx}'
+        ret.append((subject, _smtp_data(_build_message(rnd, spec, subject))))
+    return ret
+
+
+class SMTPClient:
+    """Minimal pipelining-free SMTP client, enough to push messages to Sendria over one connection."""
+
+    def __init__(self, host: str, port: int) -> NoReturn:
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _reply(self, expected: int) -> NoReturn:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise SMTPError('connection closed')
+            if line[3:4] != b'-':
+                break
+        if int(line[:3]) != expected:
+            raise SMTPError(line.decode(errors='replace').strip())
+
+    async def command(self, cmd: str, expected: int) -> NoReturn:
+        self.writer.write(cmd.encode() + b'\r\n')
+        await self._reply(expected)
+
+    async def connect(self) -> NoReturn:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self._reply(220)
+        await self.command('EHLO sendria-bench', 250)
+
+    async def send(self, data: bytes, sender: str = SENDER, recipients: Tuple[str] = RECIPIENTS) -> NoReturn:
+        await self.command(f'MAIL FROM:<{sender}>', 250)
+        for rcpt in recipients:
+            await self.command(f'RCPT TO:<{rcpt}>', 250)
+        await self.command('DATA', 354)
+        self.writer.write(data)
+        await self._reply(250)
+
+    async def close(self) -> NoReturn:
+        try:
+            await self.command('QUIT', 221)
+        except (SMTPError, OSError):
+            pass
+        self.writer.close()
+
+
+class _Watcher:
+    """Listens on WebSocket for new messages, to measure when they become visible for API clients."""
+
+    def __init__(self, http_url: str, subjects: Dict[str, int]) -> NoReturn:
+        self.url = f'{http_url}/ws?protocol=2'
+        self.subjects = subjects
+        self.seen: Dict[int, float] = {}
+        self.all_seen = asyncio.Event()
+        self.ready = asyncio.Event()
+
+    async def run(self, session: aiohttp.ClientSession) -> NoReturn:
+        async with session.ws_connect(self.url) as ws:
+            self.ready.set()
+            async for frame in ws:
+                if frame.type != aiohttp.WSMsgType.TEXT:
+                    break
+                now = time.monotonic()
+                data = json.loads(frame.data)
+                if data.get('event') != 'add_message':
+                    continue
+                for row in data.get('data') or ():
+                    idx = self.subjects.get(row.get('subject'))
+                    if idx is not None:
+                        self.seen.setdefault(idx, now)
+                if len(self.seen) >= len(self.subjects):
+                    self.all_seen.set()
+
+
+async def run_load(host: str, port: int, http_url: str, messages: List[Tuple[str, bytes]],
+    concurrency: int = 10, timeout: float = 60.0,
+) -> Dict[str, Any]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for idx in range(len(messages)):
+        queue.put_nowait(idx)
+
+    sent_at: Dict[int, float] = {}
+    send_latencies: List[float] = []
+    errors = 0
+
+    async def worker() -> NoReturn:
+        nonlocal errors
+        client = SMTPClient(host, port)
+        await client.connect()
+        try:
+            while not queue.empty():
+                idx = queue.get_nowait()
+                started_at = time.monotonic()
+                try:
+                    await client.send(messages[idx][1])
+                except SMTPError:
+                    errors += 1
+                    await client.command('RSET', 250)
+                    continue
+                sent_at[idx] = started_at
+                send_latencies.append(time.monotonic() - started_at)
+        finally:
+            await client.close()
+
+    watcher = _Watcher(http_url, {subject: idx for idx, (subject, _) in enumerate(messages)})
+    async with aiohttp.ClientSession() as session:
+        watcher_task = asyncio.get_event_loop().create_task(watcher.run(session))
+        await asyncio.wait_for(watcher.ready.wait(), timeout)
+
+        started_at = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(messages)))))
+        sent_duration = time.monotonic() - started_at
+
+        try:
+            await asyncio.wait_for(watcher.all_seen.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        watcher_task.cancel()
+
+    e2e = [watcher.seen[idx] - sent_at[idx] for idx in watcher.seen if idx in sent_at]
+    visible_duration = (max(watcher.seen.values()) - started_at) if watcher.seen else None
+    return {
+        'messages': len(messages),
+        'bytes': sum(len(data) for _, data in messages),
+        'errors': errors,
+        'delivered': len(watcher.seen),
+        'duration': round(sent_duration, 3),
+        # until the last message was visible for API clients
+        'messages_per_second': round(len(watcher.seen) / visible_duration, 2) if visible_duration else None,
+        'send_latency': summarize(send_latencies, sent_duration, errors),
+        'e2e_latency': summarize(e2e),
+    }
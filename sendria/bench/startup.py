@@ -0,0 +1,73 @@
+__all__ = ['STARTUP_BUDGET', 'import_time', 'run_startup']
+
+import re
+import subprocess
+import sys
+import time
+from typing import Optional, List, Dict, Any, Tuple
+
+from .server import Server
+from .stats import summarize
+
+# cold start to SMTP listening, in milliseconds
+STARTUP_BUDGET = 1000
+SLOWEST_IMPORTS = 10
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)$')
+
+
+def import_time(module: str = 'sendria.cli') -> Tuple[Optional[float], List[Dict[str, Any]]]:
+    """Total import time (ms) of given module and the slowest packages it pulls in, from ``-X importtime``."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],  # noqa: S603
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+    total, modules = None, {}
+    for line in proc.stderr.decode(errors='replace').splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        cumulative, name = int(match.group(2)), match.group(3)
+        if name == module:
+            total = cumulative / 1000
+        elif '.' not in name and name != 'sendria':
+            # top-level packages only, their submodules are included in cumulative time
+            modules[name] = max(modules.get(name, 0), cumulative / 1000)
+
+    slowest = sorted(modules.items(), key=lambda item: -item[1])[:SLOWEST_IMPORTS]
+    return total, [{'module': name, 'ms': round(ms, 3)} for name, ms in slowest]
+
+
+def _version_time() -> float:
+    started_at = time.monotonic()
+    subprocess.run([sys.executable, '-m', 'sendria', '--version'],  # noqa: S603
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.monotonic() - started_at
+
+
+async def run_startup(runs: int, extra_args: List[str], timeout: float) -> Dict[str, Any]:
+    imports, slowest = [], []
+    for _ in range(runs):
+        total, slowest = import_time()
+        if total is not None:
+            imports.append(total / 1000)
+
+    version = [_version_time() for _ in range(runs)]
+
+    smtp_ready, http_ready = [], []
+    for _ in range(runs):
+        server = Server(extra_args)
+        await server.start(timeout)
+        server.stop()
+        smtp_ready.append(server.smtp_ready_time)
+        http_ready.append(server.startup_time)
+
+    smtp_summary = summarize(smtp_ready)
+    return {
+        'import': summarize(imports),
+        # from the last run, should be similar in every one
+        'slowest_imports': slowest,
+        'version': summarize(version),
+        'smtp_ready': smtp_summary,
+        'http_ready': summarize(http_ready),
+        'budget': STARTUP_BUDGET,
+        'within_budget': smtp_summary['p50'] <= STARTUP_BUDGET,
+    }
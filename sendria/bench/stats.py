@@ -0,0 +1,72 @@
+__all__ = ['percentile', 'summarize', 'compare']
+
+import math
+from typing import List, Dict, Any, Iterable, Tuple, Optional
+
+PERCENTILES = (50, 90, 99)
+# (path in results, True if higher value is better)
+COMPARED_VALUES = (
+    (('smtp', 'messages_per_second'), True),
+    (('smtp', 'e2e_latency', 'p50'), False),
+    (('smtp', 'e2e_latency', 'p99'), False),
+    (('smtp', 'send_latency', 'p99'), False),
+    (('rss', 'peak'), False),
+    (('startup', 'import', 'p50'), False),
+    (('startup', 'smtp_ready', 'p50'), False),
+)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentile with linear interpolation, values have to be sorted."""
+    if not values:
+        return None
+    k = (len(values) - 1) * pct / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    if lo == hi:
+        return values[int(k)]
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(latencies: Iterable[float], duration: Optional[float] = None, errors: int = 0) -> Dict[str, Any]:
+    """Summary of latencies (in seconds), reported in milliseconds."""
+    values = sorted(latencies)
+    ret = {
+        'count': len(values),
+        'errors': errors,
+    }
+    if duration:
+        ret['per_second'] = round(len(values) / duration, 2)
+    if values:
+        ret['min'] = round(values[0] * 1000, 3)
+        ret['mean'] = round(sum(values) / len(values) * 1000, 3)
+        for pct in PERCENTILES:
+            ret[f'p{pct}'] = round(percentile(values, pct) * 1000, 3)
+        ret['max'] = round(values[-1] * 1000, 3)
+    return ret
+
+
+def _get(data: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data if isinstance(data, (int, float)) else None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Changes of the most important values between two results, ``better`` is None if it's not comparable."""
+    paths = list(COMPARED_VALUES)
+    for scenario in sorted(set(baseline.get('http', {})) | set(current.get('http', {}))):
+        paths.append((('http', scenario, 'p50'), False))
+        paths.append((('http', scenario, 'p99'), False))
+        paths.append((('http', scenario, 'per_second'), True))
+
+    rows = []
+    for path, higher_is_better in paths:
+        old, new = _get(baseline, path), _get(current, path)
+        row = {'name': '.'.join(path), 'baseline': old, 'current': new, 'change': None, 'better': None}
+        if old is not None and new is not None and old != 0:
+            row['change'] = round((new - old) / old * 100, 2)
+            row['better'] = (new >= old) if higher_is_better else (new <= old)
+        rows.append(row)
+    return rows
@@ -1,4 +1,99 @@
-# module required for webassets
-from .http.core import configure_assets
+"""Build JS/CSS bundles, their precompressed variants and the manifest read by Sendria at runtime.
 
-environment = configure_assets(False, False)
+Usage: python -m sendria.build_assets
+"""
+
+__all__ = ['BUNDLES', 'configure_assets', 'build']
+
+import gzip
+import io
+import json
+import pathlib
+from typing import Dict, List
+
+import webassets
+from structlog import get_logger
+
+from . import config
+
+try:
+    import brotli
+except ImportError:  # optional, only .gz variants are generated without it
+    brotli = None
+
+logger = get_logger()
+BUNDLES = ('js_all', 'css_all')
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+
+def configure_assets(debug: bool, autobuild: bool) -> webassets.Environment:
+    js = webassets.Bundle('js/lib/jquery.js', 'js/lib/jquery-ui.js', 'js/lib/jquery.hotkeys.js',
+        'js/lib/handlebars.js', 'js/lib/moment.js', 'js/lib/jstorage.js',
+        'js/util.js', 'js/message.js', 'js/sendria.js',
+        filters='rjsmin', output='assets/bundle.%(version)s.js')
+    scss = webassets.Bundle('css/sendria.scss',
+        filters='pyscss', output='assets/sendria.%(version)s.css')
+    css = webassets.Bundle('css/reset.css', 'css/jquery-ui.css', scss,
+        filters=('cssrewrite', 'cssmin'), output='assets/bundle.%(version)s.css')
+
+    assets = webassets.Environment(directory=config.STATIC_DIR, url=config.STATIC_URL)
+    assets.debug = debug  # yuck! but the commandline script only supports *disabling* debug
+    assets.auto_build = autobuild
+
+    assets.register('js_all', js)
+    assets.register('css_all', css)
+
+    return assets
+
+
+def _compress(path: pathlib.Path) -> List[pathlib.Path]:
+    data = path.read_bytes()
+
+    buf = io.BytesIO()
+    # mtime=0: the same input gives the same output
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fh:
+        fh.write(data)
+    ret = [path.with_name(path.name + '.gz')]
+    ret[0].write_bytes(buf.getvalue())
+
+    if brotli is not None:
+        ret.append(path.with_name(path.name + '.br'))
+        ret[1].write_bytes(brotli.compress(data))
+
+    return ret
+
+
+def build() -> Dict[str, List[str]]:
+    """Build bundles (if sources changed) and save manifest: names of bundles to their hashed file names."""
+    assets = configure_assets(False, True)
+
+    manifest = {}
+    for name in BUNDLES:
+        # urls() builds the bundle if needed, and knows the version of output file
+        urls = assets[name].urls()
+        manifest[name] = [url.split('?', 1)[0].rsplit('/', 1)[1] for url in urls]
+
+    files = {filename for filenames in manifest.values() for filename in filenames}
+    for filename in sorted(files):
+        _compress(config.ASSETS_DIR / filename)
+
+    # bundles from previous builds
+    for path in config.ASSETS_DIR.glob('bundle.*'):
+        filename = path.name
+        for suffix in COMPRESSED_SUFFIXES:
+            if filename.endswith(suffix):
+                filename = filename[:-len(suffix)]
+        if filename not in files:
+            path.unlink()
+
+    tmp_path = config.ASSETS_MANIFEST.with_name(config.ASSETS_MANIFEST.name + '.tmp')
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    tmp_path.replace(config.ASSETS_MANIFEST)
+
+    logger.info('assets built', manifest=str(config.ASSETS_MANIFEST), files=sorted(files),
+        brotli='enabled' if brotli is not None else 'disabled')
+    return manifest
+
+
+if __name__ == '__main__':
+    build()
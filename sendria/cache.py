@@ -0,0 +1,181 @@
+__all__ = ['RecentMessages', 'setup', 'store', 'stats', 'SIZE']
+
+import collections
+from typing import Optional, NoReturn, Iterable, Dict, List, Any
+
+from . import metrics
+
+# newest messages kept in memory for every store (see: db.connection); 0: disabled
+SIZE: int = 0
+# kinds of reads, for stats: first page of the list (the most common one), other pages and details of message
+KINDS = ('first_page', 'page', 'message')
+Stores: Dict[Optional[str], 'RecentMessages'] = {}
+CACHE_REQUESTS = metrics.Counter('sendria_cache_requests_total', 'Reads of recent messages cache.', ['kind', 'result'])
+
+
+class RecentMessages:
+    """The newest messages of one store, newest first, as returned by db.get_messages (and db.get_message without
+    source, sources aren't cached).
+
+    Cached rows are always the newest ones with nothing missing in between: it's loaded from database in one go,
+    new messages are added by the write path after commit, deleted ones are removed. Anything else (ie. clock going
+    back) makes it not loaded, and it's loaded again on the next read of the first page.
+    """
+    __slots__ = ('tenant', 'loaded', 'rows', 'by_id', 'parts', 'total', 'version', 'hits', 'misses')
+
+    def __init__(self, tenant: Optional[str]) -> NoReturn:
+        self.tenant = tenant
+        self.loaded = False
+        self.rows: List[dict] = []
+        self.by_id: Dict[int, dict] = {}
+        # message id to (message_id, cid, type, filename, size, is_attachment) of its parts, only of messages added after commit
+        self.parts: Dict[int, List[tuple]] = {}
+        # number of messages in the store, if known
+        self.total: Optional[int] = None
+        # changed before and after every write, results of reads running meanwhile are not cached
+        self.version = 0
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def _hit(self, kind: str) -> NoReturn:
+        self.hits[kind] += 1
+        CACHE_REQUESTS.inc(kind=kind, result='hit')
+
+    def _miss(self, kind: str) -> NoReturn:
+        self.misses[kind] += 1
+        CACHE_REQUESTS.inc(kind=kind, result='miss')
+
+    def reset(self) -> NoReturn:
+        self.loaded = False
+        self.rows, self.by_id, self.parts = [], {}, {}
+
+    def load(self, rows: List[dict], complete: bool, version: int) -> NoReturn:
+        """Fill with the newest rows of the store (all of them if complete), read when it was at given version."""
+        if version != self.version:
+            return
+        self.reset()
+        self.loaded = True
+        self.rows = [dict(row) for row in rows]
+        self.by_id = {row['id']: row for row in self.rows}
+        if complete:
+            self.total = len(self.rows)
+        self._evict()
+
+    def _evict(self) -> NoReturn:
+        while len(self.rows) > SIZE:
+            row = self.rows.pop()
+            del self.by_id[row['id']]
+            self.parts.pop(row['id'], None)
+
+    def set_total(self, total: int, version: int) -> NoReturn:
+        if version == self.version:
+            self.total = total
+
+    def writing(self) -> NoReturn:
+        """Write to the store starts, reads running now may see it or not."""
+        self.version += 1
+
+    def added(self, count: int) -> NoReturn:
+        """New messages, just committed, when not loaded (there's nothing to add them to)."""
+        self.version += 1
+        if self.total is not None:
+            self.total += count
+
+    def add(self, rows: List[dict], parts: Dict[int, List[tuple]]) -> NoReturn:
+        """New messages, just committed."""
+        self.added(len(rows))
+        if not self.loaded:
+            return
+        rows = sorted(rows, key=lambda row: (row['created_at'], row['id']), reverse=True)
+        if self.rows and rows and (rows[-1]['created_at'], rows[-1]['id']) < (self.rows[0]['created_at'], self.rows[0]['id']):
+            # not newer than cached ones, they wouldn't be in the same order as in database
+            self.reset()
+            return
+        self.rows[:0] = [dict(row) for row in rows]
+        for row in self.rows[:len(rows)]:
+            self.by_id[row['id']] = row
+        self.parts.update(parts)
+        self._evict()
+
+    def remove(self, message_ids: Iterable[int], deleted: Optional[int] = None) -> NoReturn:
+        """Messages deleted from the store; deleted: how many of them existed, if known."""
+        message_ids = set(message_ids)
+        self.version += 1
+        if self.total is not None:
+            self.total = self.total - deleted if deleted is not None else None
+        if not message_ids & self.by_id.keys():
+            return
+        self.rows = [row for row in self.rows if row['id'] not in message_ids]
+        for message_id in message_ids:
+            self.by_id.pop(message_id, None)
+            self.parts.pop(message_id, None)
+
+    def clear(self) -> NoReturn:
+        """All messages deleted from the store."""
+        self.version += 1
+        self.reset()
+        self.loaded = True
+        self.total = 0
+
+    def page(self, offset: int, limit: int) -> Optional[List[dict]]:
+        kind = 'first_page' if offset == 0 else 'page'
+        if self.loaded and (offset + limit <= len(self.rows) or len(self.rows) == self.total):
+            self._hit(kind)
+            return [dict(row) for row in self.rows[offset:offset + limit]]
+        self._miss(kind)
+        return None
+
+    def message(self, message_id: int) -> Optional[dict]:
+        row = self.by_id.get(message_id)
+        if row is None:
+            self._miss('message')
+            return None
+        self._hit('message')
+        return dict(row)
+
+    def message_parts(self, message_id: int) -> Optional[List[tuple]]:
+        # not counted in stats, details of message are read with get_message first
+        return self.parts.get(message_id)
+
+    def set_timings(self, message_id: int, timings: Optional[dict]) -> NoReturn:
+        row = self.by_id.get(message_id)
+        if row is not None:
+            row['timings'] = timings
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'tenant': self.tenant,
+            'loaded': self.loaded,
+            'messages': len(self.rows),
+            'total': self.total,
+            'hits': {kind: self.hits[kind] for kind in KINDS},
+            'misses': {kind: self.misses[kind] for kind in KINDS},
+            'hit_rate': {
+                kind: round(self.hits[kind] / (self.hits[kind] + self.misses[kind]), 4)
+                if self.hits[kind] + self.misses[kind] else None
+                for kind in KINDS
+            },
+        }
+
+
+def setup(size: Optional[int] = None) -> NoReturn:
+    global SIZE
+    Stores.clear()
+    SIZE = size or 0
+
+
+def store(tenant: Optional[str]) -> Optional[RecentMessages]:
+    """Cache of given store, None if caching is disabled."""
+    if not SIZE:
+        return None
+    ret = Stores.get(tenant)
+    if ret is None:
+        ret = Stores[tenant] = RecentMessages(tenant)
+    return ret
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        'size': SIZE,
+        'stores': [cache.to_dict() for cache in Stores.values()],
+    }
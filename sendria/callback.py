@@ -1,22 +1,177 @@
-__all__ = ['setup', 'enqueue']
+__all__ = ['setup', 'enabled', 'route', 'enqueue', 'send_messages', 'shutdown', 'stats']
 
 import asyncio
+import gzip
+import json
+import random
+import time
 import traceback
-from contextlib import asynccontextmanager
-from typing import Optional, NoReturn
+from typing import Optional, NoReturn, Dict, Any, List, Union, Iterable
 
 import aiohttp
 from structlog import get_logger
 
-from . import __version__
+from . import __version__, exit_err
+from . import db
+from . import metrics
+from . import tenants
+from . import tracing
+from .errors import InvalidFilterException
+from .filters import MessageFilter, FilterIndex
+from .http.json_encoder import JSONEncoder
 from .message import Message
 
 logger = get_logger()
-WEBHOOK_METHOD: str = 'POST'
-WEBHOOK_URL: Optional[str] = None
-WEBHOOK_AUTH: Optional[str] = None
+DEFAULT_TARGET = 'default'
+# metadata: no source nor body, text: metadata + plain text body, full: metadata + whole source
+PAYLOAD_PROFILES = ('metadata', 'text', 'full')
+RETRY_DELAY_BASE: float = 1.0
+RETRY_DELAY_MAX: float = 300.0
 DEBUG = False
-CallbackMessagesQueue: Optional[asyncio.Queue] = None
+STARTED_AT: Optional[float] = None
+Targets: Dict[str, 'Target'] = {}
+Filters = FilterIndex()
+
+
+class Delivery:
+    # payload is built when message is received, so we don't have to keep whole message in memory
+    __slots__ = ('message_id', 'tenant', 'payload', 'attempts', 'queued_at')
+
+    def __init__(self, message_id: int, payload: Optional[Dict[str, Any]] = None, attempts: int = 0,
+        tenant: Optional[str] = None,
+    ) -> NoReturn:
+        self.message_id = message_id
+        # ids are unique only in store of one tenant
+        self.tenant = tenant
+        self.payload = payload
+        self.attempts = attempts
+        self.queued_at: Optional[float] = None
+
+
+class Target:
+    """Webhook receiver with its own routing rules, delivery queue, workers and HTTP session."""
+    __slots__ = (
+        'name', 'url', 'method', 'auth', 'workers', 'retries', 'connect_timeout', 'timeout',
+        'batch_size', 'batch_time', 'payload', 'gzip',
+        'filter', 'headers', 'min_size', 'max_size',
+        'queue', 'batch_lock', 'session', 'sent', 'failed',
+    )
+
+    def __init__(self, name: str, url: str, *,
+        method: Optional[str] = None,
+        auth: Optional[str] = None,
+        workers: Optional[int] = None,
+        retries: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        timeout: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        batch_time: Optional[float] = None,
+        payload: Optional[str] = None,
+        gzip: Optional[bool] = None,
+        message_filter: Optional[MessageFilter] = None,
+        headers: Iterable[str] = (),
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ) -> NoReturn:
+        self.name = name
+        self.url = url
+        self.method = (method or 'POST').upper()
+        self.auth = auth.split(':', 1) if auth else None
+        self.workers = workers or 4
+        self.retries = retries if retries is not None else 5
+        self.connect_timeout = connect_timeout or 5.0
+        self.timeout = timeout or 30.0
+        self.batch_size = batch_size or 1
+        self.batch_time = batch_time if batch_time is not None else 0.5
+        self.payload = payload or 'full'
+        self.gzip = bool(gzip)
+        self.filter = message_filter
+        self.headers = tuple(header.lower() for header in headers)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.queue = asyncio.Queue()
+        self.batch_lock: Optional[asyncio.Lock] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.sent = 0
+        self.failed = 0
+
+        if self.payload not in PAYLOAD_PROFILES:
+            raise ValueError(f'unknown payload profile: {self.payload}')
+
+    def accepts(self, message: Message, matched_filters: set) -> bool:
+        if self.filter and self.filter.key not in matched_filters:
+            return False
+        if self.min_size is not None and message.size < self.min_size:
+            return False
+        if self.max_size is not None and message.size > self.max_size:
+            return False
+        if self.headers and not all(header in (message.headers or ()) for header in self.headers):
+            return False
+        return True
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is not None and not self.session.closed:
+            return self.session
+
+        auth = None
+        if self.auth:
+            auth = aiohttp.BasicAuth(*self.auth)
+
+        headers = {
+            'User-agent': f'Sendria/{__version__} (https://sendria.net)',
+            'Content-type': 'application/javascript',
+        }
+
+        # one session for all workers of target: connections are kept alive and reused between webhooks
+        self.session = aiohttp.ClientSession(
+            auth=auth,
+            headers=headers,
+            connector=aiohttp.TCPConnector(limit=self.workers),
+            timeout=aiohttp.ClientTimeout(connect=self.connect_timeout, total=self.timeout),
+        )
+        return self.session
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'url': self.url,
+            'method': self.method,
+            'workers': self.workers,
+            'payload': self.payload,
+            'batch_size': self.batch_size,
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+
+
+def _target_from_config(cfg: Dict[str, Any]) -> Target:
+    name = cfg.get('name')
+    if not name or not cfg.get('url'):
+        raise ValueError('every webhook requires "name" and "url"')
+
+    message_filter = MessageFilter(
+        recipients=cfg.get('to', ()),
+        senders=cfg.get('from', ()),
+        subject=cfg.get('subject'),
+    )
+
+    return Target(name, cfg['url'],
+        method=cfg.get('method'),
+        auth=cfg.get('auth'),
+        workers=cfg.get('workers'),
+        retries=cfg.get('retries'),
+        connect_timeout=cfg.get('connect_timeout'),
+        timeout=cfg.get('timeout'),
+        batch_size=cfg.get('batch_size'),
+        batch_time=cfg['batch_time'] / 1000 if cfg.get('batch_time') is not None else None,
+        payload=cfg.get('payload'),
+        gzip=cfg.get('gzip'),
+        message_filter=None if message_filter.is_empty() else message_filter,
+        headers=cfg.get('headers', ()),
+        min_size=cfg.get('min_size'),
+        max_size=cfg.get('max_size'),
+    )
 
 
 def setup(
@@ -25,79 +180,287 @@ def setup(
     callback_webhook_url: str = None,
     callback_webhook_method: str = None,
     callback_webhook_auth: str = None,
+    callback_webhook_workers: Optional[int] = None,
+    callback_webhook_retries: Optional[int] = None,
+    callback_webhook_connect_timeout: Optional[float] = None,
+    callback_webhook_timeout: Optional[float] = None,
+    callback_webhook_batch_size: Optional[int] = None,
+    callback_webhook_batch_time: Optional[float] = None,
+    callback_webhook_payload: Optional[str] = None,
+    callback_webhook_gzip: Optional[bool] = None,
+    callback_webhooks: Optional[List[Dict[str, Any]]] = None,
 ) -> bool:
-    global WEBHOOK_URL, WEBHOOK_METHOD, WEBHOOK_AUTH, DEBUG, CallbackMessagesQueue
+    global DEBUG, STARTED_AT
 
     DEBUG = debug_mode
 
-    if not callback_webhook_url:
+    try:
+        if callback_webhook_url:
+            Targets[DEFAULT_TARGET] = Target(DEFAULT_TARGET, callback_webhook_url,
+                method=callback_webhook_method,
+                auth=callback_webhook_auth,
+                workers=callback_webhook_workers,
+                retries=callback_webhook_retries,
+                connect_timeout=callback_webhook_connect_timeout,
+                timeout=callback_webhook_timeout,
+                batch_size=callback_webhook_batch_size,
+                batch_time=callback_webhook_batch_time,
+                payload=callback_webhook_payload,
+                gzip=callback_webhook_gzip,
+            )
+
+        for cfg in callback_webhooks or ():
+            target = _target_from_config(cfg)
+            if target.name in Targets:
+                raise ValueError(f'webhook "{target.name}" defined more than once')
+            Targets[target.name] = target
+    except (ValueError, InvalidFilterException) as exc:
+        exit_err(f'invalid webhook configuration: {getattr(exc, "message", None) or exc}')
+
+    if not Targets:
         if DEBUG:
             logger.debug('webhooks disabled')
         return False
 
-    WEBHOOK_URL = callback_webhook_url
-
-    if callback_webhook_method:
-        WEBHOOK_METHOD = callback_webhook_method.upper()
+    for target in Targets.values():
+        if target.filter:
+            Filters.add(target.filter)
 
-    if callback_webhook_auth:
-        WEBHOOK_AUTH = callback_webhook_auth.split(':', 1)
-
-    CallbackMessagesQueue = asyncio.Queue()
+    STARTED_AT = time.time()
 
     if DEBUG:
-        logger.debug('webhooks enabled', method=WEBHOOK_METHOD, url=WEBHOOK_URL,
-            auth='enabled' if WEBHOOK_AUTH else 'disabled')
+        for target in Targets.values():
+            logger.debug('webhook enabled', name=target.name, method=target.method, url=target.url,
+                auth='enabled' if target.auth else 'disabled', workers=target.workers, retries=target.retries,
+                batch_size=target.batch_size, payload=target.payload, gzip=target.gzip,
+                filter=target.filter.to_dict() if target.filter else None, headers=target.headers,
+                min_size=target.min_size, max_size=target.max_size)
     return True
 
 
-@asynccontextmanager
-async def get_session() -> aiohttp.ClientSession:
-    auth = None
-    if WEBHOOK_AUTH:
-        auth = aiohttp.BasicAuth(*WEBHOOK_AUTH)
+def enabled() -> bool:
+    return bool(Targets)
 
-    headers = {
-        'User-agent': f'Sendria/{__version__} (https://sendria.net)',
-        'Content-type': 'application/javascript',
-    }
 
-    session = aiohttp.ClientSession(
-        auth=auth,
-        headers=headers,
-        # TODO: extract connect and total to some kind of settings/cli params
-        timeout=aiohttp.ClientTimeout(connect=5, total=30),
-    )
+def route(message: Message) -> List[str]:
+    """Names of targets which should receive given message. Message is matched once against all targets filters."""
+    if not Targets:
+        return []
+    matched = Filters.match(message.to_summary()) if len(Filters) else set()
+    return [name for name, target in Targets.items() if target.accepts(message, matched)]
+
+
+async def shutdown() -> NoReturn:
+    for target in Targets.values():
+        if target.session is not None and not target.session.closed:
+            await target.session.close()
+
+
+def _message_payload(target: Target, message: Message) -> Dict[str, Any]:
+    message_data = message.to_dict()
+    del message_data['parts'], message_data['created_at'], message_data['headers'], message_data['addresses'], message_data['trace']
+    if target.payload != 'full':
+        del message_data['source']
+    if target.payload == 'text':
+        message_data['text'] = message.plain_text()
+    return message_data
+
+
+def _retry_delay(attempts: int) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_DELAY_MAX, RETRY_DELAY_BASE * 2 ** attempts))  # noqa: S311
+
+
+def _put(target: Target, delivery: Delivery) -> NoReturn:
+    delivery.queued_at = time.monotonic()
+    target.queue.put_nowait(delivery)
+
+
+def _schedule(target: Target, delivery: Delivery, delay: float) -> NoReturn:
+    loop = asyncio.get_event_loop()
+    if delay > 0:
+        loop.call_later(delay, _put, target, delivery)
+    else:
+        _put(target, delivery)
+
+
+async def _load_payload(target: Target, delivery: Delivery) -> Optional[Dict[str, Any]]:
+    if delivery.payload is None:
+        async with db.connection(delivery.tenant) as conn:
+            row = await db.get_message(conn, delivery.message_id)
+            if not row:
+                return None
+            message = Message.from_db_row(row)
+            message.tenant = delivery.tenant
+            payload = _message_payload(target, message)
+            if target.payload == 'text':
+                part = await db.get_message_part_plain(conn, delivery.message_id)
+                payload['text'] = b''.join(db.iter_part_body(part)).decode(part['charset'] or 'utf-8', 'replace') if part else None
+        delivery.payload = payload
+    return delivery.payload
+
+
+def _encode(target: Target, payload: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, Any]:
+    body = json.dumps(payload, cls=JSONEncoder).encode()
+    headers = {}
+    if target.gzip:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return {'data': body, 'headers': headers}
+
+
+async def _send(target: Target, deliveries: List[Delivery]) -> List[Delivery]:
+    """Send webhook, return deliveries which should be retried"""
+    payloads = []
+    for delivery in list(deliveries):
+        payload = await _load_payload(target, delivery)
+        if payload is None:
+            logger.info('webhook skipped, message does not exist anymore', message_id=delivery.message_id,
+                target=target.name)
+            deliveries.remove(delivery)
+            continue
+        payloads.append(payload)
+
+    if not deliveries:
+        return []
+
+    log_kw = {
+        'message_ids': [delivery.message_id for delivery in deliveries],
+        'attempt': max(delivery.attempts for delivery in deliveries) + 1,
+        'target': target.name,
+        'url': target.url,
+        'method': target.method,
+    }
+    # in batch mode we always send a list, even if only one message was collected
+    request_kw = _encode(target, payloads if target.batch_size > 1 else payloads[0])
+    started_at = time.perf_counter()
     try:
-        yield session
-    finally:
-        await session.close()
+        async with target.get_session().request(target.method, target.url, **request_kw) as rsp:
+            metrics.WEBHOOK_REQUEST_SECONDS.observe(time.perf_counter() - started_at, target=target.name)
+            metrics.WEBHOOK_RESPONSES.inc(target=target.name, status=rsp.status)
+            if 200 <= rsp.status < 300:
+                if DEBUG:
+                    logger.debug('webhook sent', status=rsp.status, reason=rsp.reason, **log_kw)
+                return []
 
+            logger.warning('webhook response error', status=rsp.status, reason=rsp.reason, **log_kw)
+            # other client errors are not going to be fixed by retrying
+            if 400 <= rsp.status < 500 and rsp.status not in (408, 429):
+                return []
+            return deliveries
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        metrics.WEBHOOK_REQUEST_SECONDS.observe(time.perf_counter() - started_at, target=target.name)
+        metrics.WEBHOOK_RESPONSES.inc(target=target.name, status='error')
+        logger.error('webhook client error', traceback=traceback.format_exc(), **log_kw)
+        return deliveries
 
-async def send_messages() -> NoReturn:
-    while True:
-        message: Message = await CallbackMessagesQueue.get()
 
+async def _collect_deliveries(target: Target) -> List[Delivery]:
+    if target.batch_size < 2:
+        deliveries = [await target.queue.get()]
+    else:
+        # only one worker at time is filling its batch, otherwise messages would be spread between workers
+        async with target.batch_lock:
+            deliveries = await _collect_batch(target)
+
+    now = time.monotonic()
+    for delivery in deliveries:
+        metrics.QUEUE_WAIT_SECONDS.observe(now - delivery.queued_at, queue='callback')
+    return deliveries
+
+
+async def _collect_batch(target: Target) -> List[Delivery]:
+    deliveries = [await target.queue.get()]
+    deadline = time.monotonic() + target.batch_time
+    while len(deliveries) < target.batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            deliveries.append(await asyncio.wait_for(target.queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return deliveries
+
+
+async def _worker(target: Target) -> NoReturn:
+    while True:
+        deliveries = await _collect_deliveries(target)
         try:
-            async with get_session() as session:
-                message_data = message.to_dict()
-                del message_data['parts'], message_data['created_at']
+            failed = await _send(target, list(deliveries))
+
+            tenant_deliveries = {}
+            for delivery in deliveries:
+                tenant_deliveries.setdefault(delivery.tenant, []).append(delivery)
+            for tenant, group in tenant_deliveries.items():
+                async with db.connection(tenant) as conn:
+                    for delivery in group:
+                        delivery.attempts += 1
+                        if delivery in failed and delivery.attempts > target.retries:
+                            logger.error('webhook failed, giving up', message_id=delivery.message_id,
+                                attempts=delivery.attempts, target=target.name)
+                            target.failed += 1
+                            metrics.WEBHOOK_DELIVERIES.inc(target=target.name, result='failed')
+                        elif delivery in failed:
+                            delay = _retry_delay(delivery.attempts)
+                            await db.update_callback_delivery(conn, delivery.message_id, target.name, delivery.attempts,
+                                time.time() + delay)
+                            _schedule(target, delivery, delay)
+                            metrics.WEBHOOK_DELIVERIES.inc(target=target.name, result='retried')
+                            continue
+                        else:
+                            target.sent += 1
+                            metrics.WEBHOOK_DELIVERIES.inc(target=target.name, result='sent')
+                            tracing.mark_webhook(delivery.message_id, target.name, tenant)
+                        await db.delete_callback_delivery(conn, delivery.message_id, target.name)
+        except Exception:
+            logger.exception('webhook worker error', message_ids=[delivery.message_id for delivery in deliveries],
+                target=target.name, exc_info=traceback.format_exc())
+        finally:
+            for _ in deliveries:
+                target.queue.task_done()
 
-                async with session.request(WEBHOOK_METHOD, WEBHOOK_URL, json=message_data) as rsp:
-                    if rsp.status != 200:
-                        logger.warning('webhook response error', message_id=message.id, status=rsp.status,
-                            reason=rsp.reason, url=WEBHOOK_URL, method=WEBHOOK_METHOD)
-                    elif DEBUG:
-                        logger.debug('webhook sent', message_id=message.id, status=rsp.status,
-                            reason=rsp.reason, url=WEBHOOK_URL, method=WEBHOOK_METHOD)
-        except aiohttp.ClientError:
-            logger.error('webhook client error', traceback=traceback.format_exc())
 
-        CallbackMessagesQueue.task_done()
+async def _restore_deliveries() -> NoReturn:
+    rows = []
+    for tenant in (None, *tenants.names()):
+        async with db.connection(tenant) as conn:
+            # deliveries queued after start are already in memory queue
+            rows.extend((tenant, row) for row in await db.get_callback_deliveries(conn, queued_before=STARTED_AT))
 
+    now = time.time()
+    restored = 0
+    for tenant, row in rows:
+        target = Targets.get(row['target'])
+        if not target:
+            logger.warning('pending webhook for unknown target skipped', message_id=row['message_id'],
+                target=row['target'])
+            continue
+        delivery = Delivery(row['message_id'], attempts=row['attempts'], tenant=tenant)
+        _schedule(target, delivery, (row['next_attempt_at'] or now) - now)
+        restored += 1
 
-async def enqueue(msg: Message) -> NoReturn:
-    if not WEBHOOK_URL:
-        return
+    if restored:
+        logger.info('pending webhooks restored', count=restored)
 
-    CallbackMessagesQueue.put_nowait(msg)
+
+async def send_messages() -> NoReturn:
+    await _restore_deliveries()
+
+    workers = []
+    for target in Targets.values():
+        target.batch_lock = asyncio.Lock()
+        workers.extend(_worker(target) for _ in range(target.workers))
+    await asyncio.gather(*workers)
+
+
+async def enqueue(msg: Message, targets: Iterable[str]) -> NoReturn:
+    for name in targets:
+        target = Targets[name]
+        _put(target, Delivery(msg.id, _message_payload(target, msg), tenant=msg.tenant))
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        'targets': [target.to_dict() for target in Targets.values()],
+    }
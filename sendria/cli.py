@@ -1,4 +1,4 @@
-__all__ = ['main', 'terminate_server']
+__all__ = ['main', 'terminate_server', 'run_http_worker']
 
 import argparse
 import asyncio
@@ -6,24 +6,25 @@ import errno
 import os
 import pathlib
 import signal
+import socket
 import sys
-from typing import NoReturn, List, IO
+import time
+from typing import Optional, NoReturn, List, IO, TYPE_CHECKING
 
-import aiohttp.web
-import daemon
 import structlog
-from daemon.pidfile import TimeoutPIDLockFile
 from structlog import get_logger
 
-from . import __version__, exit_err
-from . import callback
+from . import __version__, exit_err, STARTED_AT
 from . import config
-from . import db
-from . import http
-from . import smtp
+
+if TYPE_CHECKING:
+    from .smtp import Controller
 
 logger = get_logger()
 SHUTDOWN = []
+# on shutdown, accepted messages are stored for at most that long (if journal is enabled, the rest is stored on
+# the next start)
+DRAIN_TIMEOUT = 30.0
 
 
 def parse_argv(argv: List) -> argparse.Namespace:
@@ -42,14 +43,33 @@ def parse_argv(argv: List) -> argparse.Namespace:
             'Sendria instance, ie. IP restrictions.')
     parser.add_argument('--smtp-ident',
         help='How SMTP server will identify when connect')
+    parser.add_argument('--smtp-max-message-size', type=int, metavar='BYTES',
+        help='Maximal size of message, advertised with SMTP SIZE extension, bigger ones are rejected '
+            '(default: 33554432, 0 for no limit)')
+    parser.add_argument('--smtp-spool-threshold', type=int, metavar='BYTES',
+        help='Messages bigger than that are received into a temporary file (in TMPDIR) and parsed from there, '
+            'instead of being kept in memory (default: 1048576)')
+    parser.add_argument('--smtp-max-sessions', type=int, metavar='NUM',
+        help='Maximal number of SMTP connections open at the same time, the next ones are closed with 421 reply '
+            '(default: 0, no limit)')
+    parser.add_argument('--smtp-max-messages-per-session', type=int, metavar='NUM',
+        help='Maximal number of messages sent in one SMTP connection, it\'s closed with 421 reply when client '
+            'starts the next one (default: 0, no limit)')
+    parser.add_argument('--ingest-journal', action='store_true', default=None,
+        help='Write every accepted message to a journal (next to --db, in its .journal directory) and sync it to '
+            'disk before replying to SMTP client; messages not stored in database before shutdown or crash are '
+            'stored on the next start')
     parser.add_argument('--http-ip', metavar='IP', help='HTTP ip (default: 127.0.0.1)')
     parser.add_argument('--http-port', type=int, metavar='PORT', help='HTTP port (default: 1080)')
     parser.add_argument('--http-auth', metavar='HTPASSWD', help='Apache-style htpasswd file')
+    parser.add_argument('--http-workers', type=int, metavar='NUM',
+        help='Serve HTTP from given number of processes sharing the port (SO_REUSEPORT), SMTP and storing of '
+            'messages stay in the main process (default: 0, HTTP is served by the main process)')
     parser.add_argument('-f', '--foreground', action='store_true', default=None,
         help='Run in the foreground (default if no pid file is specified)')
     parser.add_argument('-d', '--debug', help='Run the web app in debug mode', action='store_true', default=None)
     parser.add_argument('-a', '--autobuild-assets', action='store_true', default=None,
-        help='Automatically rebuild assets if necessary')
+        help='Rebuild assets on start if necessary')
     parser.add_argument('-n', '--no-quit', action='store_true', default=None,
         help='Do not allow clients to terminate the application')
     parser.add_argument('-c', '--no-clear', action='store_true', default=None,
@@ -57,6 +77,43 @@ def parse_argv(argv: List) -> argparse.Namespace:
     parser.add_argument('-p', '--pidfile', help='Use a PID file')
     parser.add_argument('--stop', action='store_true',
         help='Sends SIGTERM to the running daemon (needs --pidfile)')
+    parser.add_argument('--export', metavar='PATH',
+        help='Export messages to given file ("-" for stdout) and exit, servers are not started')
+    parser.add_argument('--export-format', choices=('mbox', 'zip'), default='mbox',
+        help='Format of export: mbox or zip with one .eml file per message (default: mbox)')
+    parser.add_argument('--export-since', metavar='DATETIME',
+        help='Export messages received since given date or date and time (ISO 8601, UTC by default)')
+    parser.add_argument('--export-until', metavar='DATETIME',
+        help='Export messages received before given date or date and time (ISO 8601, UTC by default)')
+    parser.add_argument('--export-to', action='append', metavar='ADDRESS',
+        help='Export only messages to given address, domain (@example.com) or glob, can be repeated')
+    parser.add_argument('--export-from', action='append', metavar='ADDRESS',
+        help='Export only messages from given address, domain (@example.com) or glob, can be repeated')
+    parser.add_argument('--export-subject', metavar='REGEXP',
+        help='Export only messages with subject matching given regexp')
+    parser.add_argument('--import', dest='import_path', metavar='PATH',
+        help='Import messages from mbox, Maildir, directory of .eml files or zip (ie. from --export) and exit, '
+            'servers are not started')
+    parser.add_argument('--import-workers', type=int, metavar='NUM',
+        help='How many processes parse imported messages (default: number of CPUs)')
+    parser.add_argument('--tenant', metavar='NAME',
+        help='Export messages of given tenant, or import all messages to it (tenants are defined in [[sendria.tenants]] '
+            'tables in config file; default: export the default store, import with the same routing as SMTP)')
+    parser.add_argument('--index-header', dest='index_headers', action='append', metavar='NAME',
+        help='Store values of given header in an index, so messages can be filtered by it (ie. '
+            '/api/messages/?header.X-Test-Run-Id=abc), can be repeated')
+    parser.add_argument('--parts-layout', choices=('copy', 'ranges'),
+        help='How bodies of message parts are stored: copy - decoded, next to the message source (default); '
+            'ranges - only as offsets within the source, decoded when requested (smaller database)')
+    parser.add_argument('--partition-by', choices=('hour', 'day'),
+        help='Store messages in one database file per hour or day (next to --db, in its .partitions directory), '
+            'so old ones can be expired by removing a file')
+    parser.add_argument('--partition-keep', type=int, metavar='NUM',
+        help='How many newest partitions are kept, older ones are removed when a new one is created '
+            '(default: all)')
+    parser.add_argument('--cache-size', type=int, metavar='NUM',
+        help='How many of the newest messages of every store are kept in memory, for the first pages of the list and '
+            'details of fresh messages (default: 500, 0 disables the cache)')
     parser.add_argument('--template-header-name', help='Additional name of application')
     parser.add_argument('--template-header-url', help='Url of application')
     parser.add_argument('--callback-webhook-url',
@@ -66,6 +123,40 @@ def parse_argv(argv: List) -> argparse.Namespace:
     parser.add_argument('--callback-webhook-auth',
         help='Optional credentials ("login:password") for webhook (only Basic Auth supported). If empty, then no '
             'authorization header is sent')
+    parser.add_argument('--callback-webhook-workers', type=int, metavar='NUM',
+        help='How many webhooks can be sent concurrently (default: 4)')
+    parser.add_argument('--callback-webhook-retries', type=int, metavar='NUM',
+        help='How many times failed webhook is retried, with exponential backoff (default: 5)')
+    parser.add_argument('--callback-webhook-connect-timeout', type=float, metavar='SECONDS',
+        help='Timeout for connecting to webhook receiver (default: 5)')
+    parser.add_argument('--callback-webhook-timeout', type=float, metavar='SECONDS',
+        help='Total timeout for sending single webhook (default: 30)')
+    parser.add_argument('--callback-webhook-batch-size', type=int, metavar='NUM',
+        help='Send up to NUM messages in one webhook, as JSON array. 1 (default) disables batching')
+    parser.add_argument('--callback-webhook-batch-time', type=int, metavar='MS',
+        help='How long to wait for messages to fill the batch, in milliseconds (default: 500)')
+    parser.add_argument('--callback-webhook-payload', choices=('metadata', 'text', 'full'),
+        help='What is sent in webhook: only metadata, metadata and plain text body or metadata and whole '
+            'source of message (default: full)')
+    parser.add_argument('--callback-webhook-gzip', action='store_true', default=None,
+        help='Compress webhook request body with gzip')
+    parser.add_argument('--websocket-buffer-size', type=int, metavar='FRAMES',
+        help='How many frames can wait for a single WebSocket client before it is disconnected as too slow '
+            '(default: 100)')
+    parser.add_argument('--websocket-coalesce-time', type=int, metavar='MS',
+        help='Time window in milliseconds in which WebSocket events are merged into one frame, for protocol '
+            'version 2 and SSE (default: 50, 0 disables)')
+    parser.add_argument('--trace-export-file', metavar='PATH',
+        help='Append OpenTelemetry-like spans of every message pipeline (JSON lines) to given file')
+    parser.add_argument('--profiling', action='store_true', default=None,
+        help='Enable /api/debug/profile endpoint, which captures profile of the event loop')
+    parser.add_argument('--slow-callback-threshold', type=int, metavar='MS',
+        help='Log callbacks blocking the event loop longer than given time (enables asyncio debug mode, '
+            'which has its own overhead)')
+    parser.add_argument('--slow-query-threshold', type=int, metavar='MS',
+        help='Log SQL queries executed longer than given time (0 logs all of them)')
+    parser.add_argument('--slow-request-threshold', type=int, metavar='MS',
+        help='Log HTTP requests handled longer than given time (0 logs all of them)')
     parser.add_argument('--log-file',
         help='Where logs have to come if working in background. Ignored if working in foreground.')
     parser.add_argument('--config-file', '-g',
@@ -76,6 +167,10 @@ def parse_argv(argv: List) -> argparse.Namespace:
     if args.stop:
         return args
 
+    # export and import don't start servers, so there is nothing to detach
+    if args.export or args.import_path:
+        args.foreground = True
+
     return args
 
 
@@ -161,9 +256,118 @@ async def terminate_server(sig: int, loop: asyncio.AbstractEventLoop) -> NoRetur
     loop.stop()
 
 
+def startup_time() -> float:
+    """Seconds since the process was started (since sendria was imported, if that's not known)."""
+    try:
+        with open('/proc/self/stat') as fh:
+            # starttime, in clock ticks since boot, is 22nd field; 2nd one (command) can contain spaces
+            start_ticks = int(fh.read().rpartition(')')[2].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - STARTED_AT
+
+
+def _db_options() -> dict:
+    # for db.setup, the same in servers, export and import
+    return {
+        'index_headers': config.CONFIG.index_headers,
+        'parts_layout': config.CONFIG.parts_layout,
+        'partition_by': config.CONFIG.partition_by,
+        'partition_keep': config.CONFIG.partition_keep,
+    }
+
+
+async def _setup_db() -> NoReturn:
+    # for servers and HTTP workers
+    from . import db
+
+    slow_query_threshold = config.CONFIG.slow_query_threshold
+    await db.setup(config.CONFIG.db,
+        slow_query_threshold=slow_query_threshold / 1000 if slow_query_threshold is not None else None,
+        **_db_options())
+
+
+def export_messages(args: argparse.Namespace) -> NoReturn:
+    from . import db
+    from . import export
+    from .errors import InvalidFilterException
+    from .filters import MessageFilter
+
+    if args.export == '-':
+        # stdout is for the export
+        structlog.configure(logger_factory=structlog.PrintLoggerFactory(file=sys.stderr))
+
+    try:
+        since = export.parse_time(args.export_since)
+        until = export.parse_time(args.export_until)
+    except ValueError as exc:
+        exit_err(f'invalid --export-since or --export-until: {exc}')
+    try:
+        message_filter = MessageFilter(recipients=args.export_to or (), senders=args.export_from or (),
+            subject=args.export_subject)
+    except InvalidFilterException as exc:
+        exit_err(exc.get_message())
+    if message_filter.is_empty():
+        message_filter = None
+
+    if not config.CONFIG.db.exists():
+        exit_err(f'database {config.CONFIG.db} does not exist')
+
+    async def _export(fh: IO) -> NoReturn:
+        await db.setup(config.CONFIG.db, **_db_options())
+        async with db.connection(args.tenant) as conn:
+            async for chunk in export.export_messages(conn, args.export_format, since, until, message_filter):
+                fh.write(chunk)
+
+    if args.export == '-':
+        asyncio.get_event_loop().run_until_complete(_export(sys.stdout.buffer))
+        sys.stdout.flush()
+    else:
+        with open(args.export, 'wb') as fh:
+            asyncio.get_event_loop().run_until_complete(_export(fh))
+
+
+def import_messages(args: argparse.Namespace) -> NoReturn:
+    from . import db
+    from . import importer
+
+    path = pathlib.Path(args.import_path)
+    if not path.exists():
+        exit_err(f'{path} does not exist')
+    if args.import_workers is not None and args.import_workers < 1:
+        exit_err('--import-workers must be greater than 0')
+
+    async def _import() -> NoReturn:
+        await db.setup(config.CONFIG.db, **_db_options())
+        # servers are not running, so there is nobody to notify
+        await importer.import_messages(importer.iter_path(path), notify=False, webhooks=False,
+            workers=args.import_workers, tenant=args.tenant)
+
+    asyncio.get_event_loop().run_until_complete(_import())
+
+
 def run_sendria_servers(loop: asyncio.AbstractEventLoop) -> NoReturn:
+    # imported here, so --version or --stop don't have to load the whole server stack
+    from . import cache
+    from . import callback
+    from . import db
+    from . import journal
+    from . import profiling
+    from . import smtp
+    from . import tracing
+
     # initialize db
-    loop.run_until_complete(db.setup(config.CONFIG.db))
+    slow_callback_threshold = config.CONFIG.slow_callback_threshold
+    if slow_callback_threshold is not None:
+        slow_callback_threshold /= 1000
+    profiling.setup_loop(loop, slow_callback_threshold)
+
+    loop.run_until_complete(_setup_db())
+    # only here: HTTP workers don't see writes of the main process, so they can't keep it up to date; and the other
+    # way around, deletes done by workers would not be seen here, so there is no cache with workers at all
+    if config.CONFIG.http_workers and config.CONFIG.cache_size:
+        logger.info('recent messages cache disabled, HTTP workers are enabled')
+    cache.setup(0 if config.CONFIG.http_workers else config.CONFIG.cache_size)
 
     # initialize and start webhooks
     callbacks_enabled = callback.setup(
@@ -171,32 +375,93 @@ def run_sendria_servers(loop: asyncio.AbstractEventLoop) -> NoReturn:
         callback_webhook_url=config.CONFIG.callback_webhook_url,
         callback_webhook_method=config.CONFIG.callback_webhook_method,
         callback_webhook_auth=config.CONFIG.callback_webhook_auth,
+        callback_webhook_workers=config.CONFIG.callback_webhook_workers,
+        callback_webhook_retries=config.CONFIG.callback_webhook_retries,
+        callback_webhook_connect_timeout=config.CONFIG.callback_webhook_connect_timeout,
+        callback_webhook_timeout=config.CONFIG.callback_webhook_timeout,
+        callback_webhook_batch_size=config.CONFIG.callback_webhook_batch_size,
+        callback_webhook_batch_time=config.CONFIG.callback_webhook_batch_time / 1000,
+        callback_webhook_payload=config.CONFIG.callback_webhook_payload,
+        callback_webhook_gzip=config.CONFIG.callback_webhook_gzip,
+        callback_webhooks=config.CONFIG.webhooks,
     )
     if callbacks_enabled:
         loop.create_task(callback.send_messages())
+        SHUTDOWN.append(callback.shutdown())
 
-    # initialize and start message saver
+    # initialize and start message saver, with messages left in journal by previous run
+    if config.CONFIG.ingest_journal:
+        db.add_journal_records(journal.setup(pathlib.Path(f'{config.CONFIG.db}.journal')))
     loop.create_task(db.message_saver())
+    tracing.setup(config.CONFIG.trace_export_file)
+    loop.create_task(db.timings_saver())
 
     # start smtp server
-    smtp.run(config.CONFIG.smtp_ip, config.CONFIG.smtp_port, config.CONFIG.smtp_auth, config.CONFIG.smtp_ident, config.CONFIG.debug)
+    smtp_controller = smtp.run(config.CONFIG.smtp_ip, config.CONFIG.smtp_port, config.CONFIG.smtp_auth,
+        config.CONFIG.smtp_ident, config.CONFIG.debug,
+        max_message_size=config.CONFIG.smtp_max_message_size,
+        spool_threshold=config.CONFIG.smtp_spool_threshold,
+        max_sessions=config.CONFIG.smtp_max_sessions,
+        max_messages_per_session=config.CONFIG.smtp_max_messages_per_session)
+    # SMTP server has its own loop, in separate thread (there is ie. bcrypt for SMTP auth)
+    profiling.setup_loop(smtp_controller.loop, slow_callback_threshold)
     logger.info('smtp server started', host=config.CONFIG.smtp_ip, port=config.CONFIG.smtp_port,
         auth='enabled' if config.CONFIG.smtp_auth else 'disabled',
         password_file=str(config.CONFIG.smtp_auth.path) if config.CONFIG.smtp_auth else None,
+        max_message_size=smtp.MAX_MESSAGE_SIZE,
+        max_sessions=smtp.MAX_SESSIONS or None,
+        max_messages_per_session=smtp.MAX_MESSAGES_PER_SESSION or None,
         url=f'smtp://{config.CONFIG.smtp_ip}:{config.CONFIG.smtp_port}',
     )
+    smtp_ready_in = startup_time()
+    SHUTDOWN.append(_stop_ingest(smtp_controller))
 
     # initialize and start web server
+    if config.CONFIG.http_workers:
+        from . import workers
+        loop.run_until_complete(workers.start(config.CONFIG.http_workers))
+        SHUTDOWN.append(workers.stop())
+    else:
+        _start_http_server(loop)
+
+    logger.info(f'ready in {startup_time() * 1000:.0f} ms', smtp_ready_in=f'{smtp_ready_in * 1000:.0f} ms')
+
+    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+    for s in signals:
+        loop.add_signal_handler(s, lambda s=s: asyncio.create_task(terminate_server(s, loop)))
+
+
+async def _stop_ingest(smtp_controller: 'Controller') -> NoReturn:
+    from . import db
+    from . import journal
+
+    # no new messages, then the accepted ones are stored before tasks are cancelled
+    await asyncio.get_event_loop().run_in_executor(None, smtp_controller.stop)
+    try:
+        await asyncio.wait_for(db.drain(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning('messages not stored before shutdown', queued=db.DbMessagesQueue.qsize(),
+            journal=journal.enabled())
+    await db.save_timings()
+    journal.close()
+
+
+def _start_http_server(loop: asyncio.AbstractEventLoop, reuse_port: bool = False, worker: Optional[int] = None,
+) -> NoReturn:
+    import aiohttp.web
+    from . import http
+
     app = http.setup()
 
     runner = aiohttp.web.AppRunner(app)
     loop.run_until_complete(runner.setup())
 
-    site = aiohttp.web.TCPSite(runner, host=config.CONFIG.http_ip, port=config.CONFIG.http_port)
+    # HTTP workers share the port, the kernel balances connections between them
+    site = aiohttp.web.TCPSite(runner, host=config.CONFIG.http_ip, port=config.CONFIG.http_port, reuse_port=reuse_port)
     server = site.start()
     loop.run_until_complete(server)
 
-    logger.info('http server started',
+    logger.info('http server started', worker=worker,
         host=config.CONFIG.http_ip, port=config.CONFIG.http_port,
         url=f'http://{config.CONFIG.http_ip}:{config.CONFIG.http_port}',
         auth='enabled' if config.CONFIG.http_auth else 'disabled',
@@ -211,9 +476,29 @@ def run_sendria_servers(loop: asyncio.AbstractEventLoop) -> NoReturn:
 
     SHUTDOWN.append(_initialize_aiohttp_services__stop())
 
-    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
-    for s in signals:
+
+def run_http_worker(number: int, cfg: config.Config, bus_path: str) -> NoReturn:
+    """HTTP server in separate process (see: --http-workers), reading the same database as the main process."""
+    from . import profiling
+    from . import tenants
+    from . import workers
+
+    config.CONFIG = cfg
+    configure_logger()
+    tenants.setup(config.CONFIG.tenants)
+
+    loop = asyncio.get_event_loop()
+    slow_callback_threshold = config.CONFIG.slow_callback_threshold
+    profiling.setup_loop(loop, slow_callback_threshold / 1000 if slow_callback_threshold is not None else None)
+    loop.run_until_complete(_setup_db())
+    _start_http_server(loop, reuse_port=True, worker=number)
+    loop.run_until_complete(workers.connect(bus_path, number))
+    SHUTDOWN.insert(0, workers.disconnect())
+
+    for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
         loop.add_signal_handler(s, lambda s=s: asyncio.create_task(terminate_server(s, loop)))
+    loop.run_forever()
+    loop.close()
 
 
 def stop(pidfile: pathlib.Path) -> NoReturn:
@@ -238,6 +523,22 @@ def main() -> NoReturn:
 
     if not config.CONFIG.db:
         exit_err('Missing database path. Please use --db path/to/db.sqlite')
+    if config.CONFIG.partition_keep is not None and config.CONFIG.partition_keep < 1:
+        exit_err('--partition-keep must be greater than 0')
+    if config.CONFIG.smtp_max_message_size is not None and config.CONFIG.smtp_max_message_size < 0:
+        exit_err('--smtp-max-message-size must not be negative')
+    if config.CONFIG.smtp_spool_threshold is not None and config.CONFIG.smtp_spool_threshold < 0:
+        exit_err('--smtp-spool-threshold must not be negative')
+    if config.CONFIG.smtp_max_sessions is not None and config.CONFIG.smtp_max_sessions < 0:
+        exit_err('--smtp-max-sessions must not be negative')
+    if config.CONFIG.smtp_max_messages_per_session is not None and config.CONFIG.smtp_max_messages_per_session < 0:
+        exit_err('--smtp-max-messages-per-session must not be negative')
+    if config.CONFIG.cache_size is not None and config.CONFIG.cache_size < 0:
+        exit_err('--cache-size must not be negative')
+    if config.CONFIG.http_workers is not None and config.CONFIG.http_workers < 0:
+        exit_err('--http-workers must not be negative')
+    if config.CONFIG.http_workers and not hasattr(socket, 'SO_REUSEPORT'):
+        exit_err('--http-workers requires SO_REUSEPORT, not available on this platform')
 
     log_handler = configure_logger()
 
@@ -250,6 +551,19 @@ def main() -> NoReturn:
         stop(config.CONFIG.pidfile)
         sys.exit(0)
 
+    from . import tenants
+    tenants.setup(config.CONFIG.tenants)
+    if args.tenant is not None and not tenants.exists(args.tenant):
+        exit_err(f'unknown tenant: {args.tenant}')
+
+    if args.export:
+        export_messages(args)
+        sys.exit(0)
+
+    if args.import_path:
+        import_messages(args)
+        sys.exit(0)
+
     logger.info('starting Sendria',
         debug='enabled' if config.CONFIG.debug else 'disabled',
         pidfile=str(config.CONFIG.pidfile) if config.CONFIG.pidfile else None,
@@ -261,8 +575,18 @@ def main() -> NoReturn:
     if config.CONFIG.autobuild_assets and not os.access(config.STATIC_DIR, os.W_OK):
         exit_err('autobuilding assets requires write access to %s' % config.STATIC_DIR)
 
-    if not config.CONFIG.autobuild_assets and (not config.ASSETS_DIR.exists() or not list(config.ASSETS_DIR.glob('*'))):
-        exit_err('assets not found. Generate assets using: webassets -m sendria.build_assets build', 0)
+    if config.CONFIG.autobuild_assets:
+        # once, before servers start: at runtime only the manifest is read
+        from . import build_assets
+        try:
+            build_assets.build()
+        except Exception as exc:
+            exit_err('cannot build assets', error=str(exc))
+    elif not config.ASSETS_MANIFEST.exists():
+        exit_err('assets not found. Generate assets using: python -m sendria.build_assets', 0)
+
+    import daemon
+    from daemon.pidfile import TimeoutPIDLockFile
 
     daemon_kw = {}
 
@@ -4,16 +4,18 @@ import pathlib
 import pkgutil
 import sys
 import tempfile
-from typing import Optional, NoReturn
+from typing import Optional, NoReturn, TYPE_CHECKING
 
 import attr
 import fileperms
 import structlog
 import toml
-from passlib.apache import HtpasswdFile
 
 from . import exit_err
 
+if TYPE_CHECKING:
+    from passlib.apache import HtpasswdFile
+
 CONFIG: Optional['Config'] = None
 
 logger = structlog.get_logger()
@@ -27,15 +29,32 @@ ROOT_DIR = pathlib.Path(pkgutil.get_loader('sendria').get_filename()).parent
 STATIC_DIR = ROOT_DIR / 'static'
 TEMPLATES_DIR = ROOT_DIR / 'templates'
 ASSETS_DIR = STATIC_DIR / 'assets'
+# written by build_assets
+ASSETS_MANIFEST = ASSETS_DIR / 'manifest.json'
 STATIC_URL = '/static/'
 DEFAULT_OPTIONS = {
     'smtp_ident': 'ESMTP Sendria (https://sendria.net)',
     'smtp_ip': '127.0.0.1',
     'smtp_port': 1025,
+    'smtp_max_message_size': 32 * 1024 * 1024,
+    'smtp_spool_threshold': 1024 * 1024,
+    'smtp_max_sessions': 0,
+    'smtp_max_messages_per_session': 0,
     'http_ip': '127.0.0.1',
     'http_port': 1080,
     'callback_webhook_method': 'POST',
+    'callback_webhook_workers': 4,
+    'callback_webhook_retries': 5,
+    'callback_webhook_connect_timeout': 5,
+    'callback_webhook_timeout': 30,
+    'callback_webhook_batch_size': 1,
+    'callback_webhook_batch_time': 500,
+    'callback_webhook_payload': 'full',
     'log_file': 'sendria.log',
+    'websocket_buffer_size': 100,
+    'websocket_coalesce_time': 50,
+    'parts_layout': 'copy',
+    'cache_size': 500,
 }
 
 
@@ -114,11 +133,17 @@ class Config:
     db: Optional[pathlib.Path] = attr.ib(init=False)
     smtp_ip: Optional[str] = attr.ib(init=False)
     smtp_port: Optional[int] = attr.ib(init=False)
-    smtp_auth: Optional[HtpasswdFile] = attr.ib(init=False)
+    smtp_auth: Optional['HtpasswdFile'] = attr.ib(init=False)
     smtp_ident: Optional[str] = attr.ib(init=False)
+    smtp_max_message_size: Optional[int] = attr.ib(init=False)
+    smtp_spool_threshold: Optional[int] = attr.ib(init=False)
+    smtp_max_sessions: Optional[int] = attr.ib(init=False)
+    smtp_max_messages_per_session: Optional[int] = attr.ib(init=False)
+    ingest_journal: Optional[bool] = attr.ib(init=False)
     http_ip: Optional[str] = attr.ib(init=False)
     http_port: Optional[int] = attr.ib(init=False)
-    http_auth: Optional[HtpasswdFile] = attr.ib(init=False)
+    http_auth: Optional['HtpasswdFile'] = attr.ib(init=False)
+    http_workers: Optional[int] = attr.ib(init=False)
     foreground: Optional[bool] = attr.ib(init=False)
     autobuild_assets: Optional[bool] = attr.ib(init=False)
     no_quit: Optional[bool] = attr.ib(init=False)
@@ -129,7 +154,31 @@ class Config:
     callback_webhook_url: Optional[str] = attr.ib(init=False)
     callback_webhook_method: Optional[str] = attr.ib(init=False)
     callback_webhook_auth: Optional[str] = attr.ib(init=False)
+    callback_webhook_workers: Optional[int] = attr.ib(init=False)
+    callback_webhook_retries: Optional[int] = attr.ib(init=False)
+    callback_webhook_connect_timeout: Optional[float] = attr.ib(init=False)
+    callback_webhook_timeout: Optional[float] = attr.ib(init=False)
+    callback_webhook_batch_size: Optional[int] = attr.ib(init=False)
+    callback_webhook_batch_time: Optional[int] = attr.ib(init=False)
+    callback_webhook_payload: Optional[str] = attr.ib(init=False)
+    callback_webhook_gzip: Optional[bool] = attr.ib(init=False)
+    # only in config file: list of [[sendria.webhooks]] tables
+    webhooks: Optional[list] = attr.ib(init=False)
+    # only in config file: list of [[sendria.tenants]] tables
+    tenants: Optional[list] = attr.ib(init=False)
+    index_headers: Optional[list] = attr.ib(init=False)
+    parts_layout: Optional[str] = attr.ib(init=False)
+    partition_by: Optional[str] = attr.ib(init=False)
+    partition_keep: Optional[int] = attr.ib(init=False)
+    cache_size: Optional[int] = attr.ib(init=False)
     log_file: Optional[pathlib.Path] = attr.ib(init=False)
+    websocket_buffer_size: Optional[int] = attr.ib(init=False)
+    websocket_coalesce_time: Optional[int] = attr.ib(init=False)
+    trace_export_file: Optional[pathlib.Path] = attr.ib(init=False)
+    profiling: Optional[bool] = attr.ib(init=False)
+    slow_callback_threshold: Optional[int] = attr.ib(init=False)
+    slow_query_threshold: Optional[int] = attr.ib(init=False)
+    slow_request_threshold: Optional[int] = attr.ib(init=False)
     debug: bool = attr.ib(init=False)
 
 
@@ -142,13 +191,13 @@ def setup(args: argparse.Namespace) -> NoReturn:
 
     for key in attr.fields(Config):
         name = key.name
-        value = getattr(args, name)
+        value = getattr(args, name, None)
         if value is None:
             value = cfg.get(name)
         if value is None:
             value = DEFAULT_OPTIONS.get(name)
 
-        if name in ('db', 'pidfile') and isinstance(value, str):
+        if name in ('db', 'pidfile', 'trace_export_file') and isinstance(value, str):
             value = pathlib.Path(value)
             if not value.is_absolute():
                 value = value.resolve()
@@ -157,6 +206,8 @@ def setup(args: argparse.Namespace) -> NoReturn:
             if not value.is_absolute():
                 value = value.resolve()
             if value.is_file():
+                # passlib is slow to import, and needed only if auth is enabled
+                from passlib.apache import HtpasswdFile
                 value = HtpasswdFile(value)
 
         setattr(CONFIG, name, value)
@@ -167,10 +218,10 @@ def setup(args: argparse.Namespace) -> NoReturn:
         CONFIG.foreground = True
 
     # Warn about relative paths and absolutize them
-    if CONFIG.http_auth and not isinstance(CONFIG.http_auth, HtpasswdFile):
+    if CONFIG.http_auth and isinstance(CONFIG.http_auth, pathlib.Path):
         exit_err('HTTP auth htpasswd file does not exist')
 
-    if CONFIG.smtp_auth and not isinstance(CONFIG.smtp_auth, HtpasswdFile):
+    if CONFIG.smtp_auth and isinstance(CONFIG.smtp_auth, pathlib.Path):
         exit_err('SMTP auth htpasswd file does not exist')
 
     if CONFIG.debug is None:
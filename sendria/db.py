@@ -1,42 +1,213 @@
 __all__ = ['setup', 'connection', 'add_message', 'delete_message', 'delete_messages', 'get_message',
     'get_message_attachments', 'get_message_part_cid', 'get_message_part_html', 'get_message_part_plain',
-    'get_messages', 'message_saver',
+    'get_messages', 'get_messages_count', 'iter_messages', 'delete_filtered_messages', 'get_db_size', 'message_saver', 'store_messages',
+    'message_part_rows', 'iter_part_body', 'message_header_rows', 'save_timings', 'timings_saver',
+    'get_callback_deliveries', 'update_callback_delivery', 'delete_callback_delivery', 'expire_partitions',
 ]
 
 import asyncio
+import binascii
+import datetime
 import json
 import pathlib
+import re
 import sqlite3
+import threading
+import time
+import weakref
 from contextlib import asynccontextmanager
-from email.message import Message as EmailMessage
-from typing import Iterable, Optional, Union, List, NoReturn
+from email.parser import HeaderParser
+from typing import Iterable, Optional, Union, List, NoReturn, Any, Dict, AsyncIterator, Iterator, Tuple, AsyncContextManager
 
 import aiosqlite
 from structlog import get_logger
 
+from . import cache
 from . import callback
+from . import journal
+from . import metrics
+from . import tenants
+from . import tracing
+from .filters import MessageFilter, FilterIndex, classify_address_pattern
 from .http import notifier
-from .message import Message
+from .message import Message, SENDER_ROLES, RECIPIENT_ROLES
 
 logger = get_logger()
 DB_PATH: Optional[str] = None
 DbMessagesQueue: Optional[asyncio.Queue] = None
+TIMINGS_SAVE_INTERVAL: float = 1.0
+SLOW_QUERY_THRESHOLD: Optional[float] = None
+# copy: decoded body of every part is stored in message_part; ranges: only offset and length of encoded body
+# within message source, if it can be decoded back to the same content (see: message_part_rows)
+PARTS_LAYOUTS = ('copy', 'ranges')
+PARTS_LAYOUT = 'copy'
+# partitioned storage: messages received in one time bucket are stored in their own database file (partition)
+# in <db>.partitions directory, so old ones can be expired by unlinking a file; None: everything is stored in <db>
+PARTITION_SIZES = {'hour': 3600, 'day': 86400}
+PARTITION_NAME_FORMATS = {'hour': '%Y%m%d%H', 'day': '%Y%m%d'}
+PARTITION_BY: Optional[str] = None
+# how many newest partitions are kept when a new one is created; None: all of them
+PARTITION_KEEP: Optional[int] = None
+# ids in partition start at hour of its start * PARTITION_ID_SPAN, so partition is known from id alone
+PARTITION_ID_SPAN = 10 ** 9
+# paths of partitions created or initialized (tables, migrations) by this process
+InitializedPartitions: set = set()
+# partitions by path, listing of directory is the source of truth
+PartitionsCache: Dict[str, '_Partition'] = {}
+# tenant of every open connection to main database (see: connection)
+ConnectionTenants: 'weakref.WeakKeyDictionary[aiosqlite.Connection, Optional[str]]' = weakref.WeakKeyDictionary()
+# headers stored in message_header: lowercased name to name as configured
+INDEX_HEADERS: Dict[str, str] = {}
+ITER_MESSAGES_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 100
+# messages waiting for storing are kept in memory up to that size; above it, SMTP server waits with parsing of new
+# ones, or (with the journal) they are read from the journal when their turn comes
+QUEUE_MEMORY_LIMIT = 64 * 1024 * 1024
+QueuedBytes = 0
+# QueuedBytes is changed by SMTP thread and the main one
+QueuedBytesLock = threading.Lock()
+# messages deleted in one transaction, ingest waits at most for one batch
+DELETE_BATCH_SIZE = 500
+# version of schema, in PRAGMA user_version; see: migrate
+DB_VERSION = 2
+MIGRATE_BATCH_SIZE = 1000
+RE_NEWLINES_BYTES = re.compile(rb'\r\n|\r')
+# substr() counts characters of TEXT, the same as offsets in message_part_rows
+# all but source, for lists and details of messages (and the same as in cache of recent messages)
+MESSAGE_COLUMNS = """
+    id, sender_envelope, sender_message, recipients_envelope, recipients_message_to, recipients_message_cc,
+    recipients_message_bcc, subject, size, type, peer, created_at, timings, recipients_envelope_list
+"""
+PART_COLUMNS = """
+    p.*,
+    CASE WHEN p.body_offset IS NULL THEN NULL ELSE substr(m.source, p.body_offset + 1, p.body_length) END AS source_range
+"""
 
 
-async def setup(db: Union[str, pathlib.Path]) -> NoReturn:
-    global DB_PATH, DbMessagesQueue
+def _params_shape(params: Any) -> Union[List[str], Dict[str, str], str]:
+    # types and sizes only, values may be huge (message sources) or sensitive
+    def shape(value: Any) -> str:
+        if isinstance(value, (str, bytes)):
+            return f'{type(value).__name__}({len(value)})'
+        return type(value).__name__
+
+    if isinstance(params, dict):
+        return {k: shape(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [shape(v) for v in params]
+    return shape(params)
+
+
+def _log_slow_query(sql: str, params: Any, started_at: float, many: bool = False) -> NoReturn:
+    duration = time.perf_counter() - started_at
+    if duration < SLOW_QUERY_THRESHOLD:
+        return
+    if many:
+        params = list(params) if not isinstance(params, (list, tuple)) else params
+        params_shape = {'rows': len(params), 'first': _params_shape(params[0]) if params else None}
+    else:
+        params_shape = _params_shape(params)
+    logger.warning('slow query', sql=' '.join(sql.split()), params=params_shape, duration=round(duration * 1000, 3))
+
+
+class _TimedCursor(sqlite3.Cursor):
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        started_at = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _log_slow_query(sql, parameters, started_at)
+
+    def executemany(self, sql: str, parameters: Iterable) -> sqlite3.Cursor:
+        parameters = list(parameters)
+        started_at = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            _log_slow_query(sql, parameters, started_at, many=True)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection logging queries slower than SLOW_QUERY_THRESHOLD, used only if it's set."""
+
+    def cursor(self, factory: type = _TimedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Iterable) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, parameters)
+
+
+class _Partition:
+    """Database file with messages received in time bucket [start, end), named after its start."""
+    __slots__ = ('name', 'path', 'start', 'end', 'first_id')
+
+    def __init__(self, directory: pathlib.Path, name: str) -> NoReturn:
+        if not name.isdigit() or len(name) not in (8, 10):
+            raise ValueError(f'invalid partition name: {name}')
+        size = 'hour' if len(name) == 10 else 'day'
+        self.name = name
+        self.path = directory / f'{name}.sqlite'
+        self.start = datetime.datetime.strptime(name, PARTITION_NAME_FORMATS[size])
+        self.end = self.start + datetime.timedelta(seconds=PARTITION_SIZES[size])
+        hour = int((self.start - datetime.datetime(1970, 1, 1)).total_seconds()) // 3600
+        self.first_id = hour * PARTITION_ID_SPAN
+
+    def overlaps(self, since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> bool:
+        return (since is None or self.end > since) and (until is None or self.start < until)
+
+    def within(self, since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> bool:
+        return (since is None or self.start >= since) and (until is None or self.end <= until)
+
+
+async def setup(db: Union[str, pathlib.Path], slow_query_threshold: Optional[float] = None,
+    index_headers: Optional[Iterable[str]] = None, parts_layout: Optional[str] = None,
+    partition_by: Optional[str] = None, partition_keep: Optional[int] = None,
+) -> NoReturn:
+    global DB_PATH, DbMessagesQueue, SLOW_QUERY_THRESHOLD, INDEX_HEADERS, PARTS_LAYOUT, PARTITION_BY, PARTITION_KEEP
     DB_PATH = str(db)
+    SLOW_QUERY_THRESHOLD = slow_query_threshold
+    if parts_layout:
+        PARTS_LAYOUT = parts_layout
+    INDEX_HEADERS = {name.strip().lower(): name.strip() for name in index_headers or () if name.strip()}
+    PARTITION_BY = partition_by
+    PARTITION_KEEP = partition_keep
+    InitializedPartitions.clear()
+    PartitionsCache.clear()
 
     DbMessagesQueue = asyncio.Queue()
 
-    async with connection() as conn:
-        await create_tables(conn)
-        logger.info('DB initialized')
+    stores = [None, *tenants.names()]
+    if len(stores) > 1:
+        _tenants_dir().mkdir(exist_ok=True)
+    partitions = []
+    for tenant in stores:
+        async with connection(tenant) as conn:
+            await _init_db(conn)
+        if PARTITION_BY:
+            _partitions_dir(tenant).mkdir(exist_ok=True)
+            for partition in _partitions(tenant):
+                async with _partition_connection(partition, create=True):
+                    partitions.append(partition)
+    logger.info('DB initialized', tenants=len(stores) - 1, partition_by=PARTITION_BY, partitions=len(partitions))
+
+
+async def _init_db(conn: aiosqlite.Connection) -> NoReturn:
+    # readers (ie. long exports) work on their snapshot and don't block writers
+    await conn.execute('PRAGMA journal_mode=WAL')
+    await create_tables(conn)
+    await migrate(conn)
+    await _sync_indexed_headers(conn)
+    await conn.commit()
 
 
 @asynccontextmanager
-async def connection() -> NoReturn:
-    conn = await aiosqlite.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+async def _connect(path: str, **kwargs: Any) -> NoReturn:
+    if SLOW_QUERY_THRESHOLD is not None:
+        kwargs['factory'] = _TimedConnection
+    conn = await aiosqlite.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, **kwargs)
     conn.row_factory = aiosqlite.Row
     conn.text_factory = str
     try:
@@ -45,6 +216,151 @@ async def connection() -> NoReturn:
         await conn.close()
 
 
+def _tenants_dir() -> pathlib.Path:
+    return pathlib.Path(DB_PATH + '.tenants')
+
+
+def db_path(tenant: Optional[str] = None) -> str:
+    """Main database of given tenant (see: tenants), DB_PATH for the default store."""
+    if tenant is None:
+        return DB_PATH
+    return str(_tenants_dir() / f'{tenant}.sqlite')
+
+
+@asynccontextmanager
+async def connection(tenant: Optional[str] = None) -> AsyncIterator[aiosqlite.Connection]:
+    """Connection to main database of given tenant. With partitioned storage messages are not there, but functions
+    of this module given this connection find them in partitions of the same tenant."""
+    async with _connect(db_path(tenant)) as conn:
+        ConnectionTenants[conn] = tenant
+        yield conn
+
+
+def _tenant(conn: aiosqlite.Connection) -> Optional[str]:
+    return ConnectionTenants.get(conn)
+
+
+def _partitions_dir(tenant: Optional[str]) -> pathlib.Path:
+    return pathlib.Path(db_path(tenant) + '.partitions')
+
+
+def _partitions(tenant: Optional[str], since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+) -> List[_Partition]:
+    """Existing partitions of tenant (overlapping given time range), the oldest first."""
+    ret = []
+    directory = _partitions_dir(tenant)
+    for path in directory.glob('*.sqlite'):
+        partition = PartitionsCache.get(str(path))
+        if partition is None:
+            try:
+                partition = PartitionsCache[str(path)] = _Partition(directory, path.stem)
+            except ValueError:
+                # not ours
+                continue
+        if partition.overlaps(since, until):
+            ret.append(partition)
+    ret.sort(key=lambda partition: partition.start)
+    return ret
+
+
+def _message_partition(tenant: Optional[str], message_id: Union[int, str]) -> Optional[_Partition]:
+    first_id = int(message_id) // PARTITION_ID_SPAN * PARTITION_ID_SPAN
+    for partition in _partitions(tenant):
+        if partition.first_id == first_id:
+            return partition
+    return None
+
+
+def _partition_for(tenant: Optional[str], created_at: datetime.datetime) -> _Partition:
+    partitions = _partitions(tenant)
+    for partition in partitions:
+        if partition.start <= created_at < partition.end:
+            return partition
+    directory = _partitions_dir(tenant)
+    size = PARTITION_SIZES[PARTITION_BY]
+    start = datetime.datetime.utcfromtimestamp(
+        int(created_at.replace(tzinfo=datetime.timezone.utc).timestamp()) // size * size)
+    partition = _Partition(directory, start.strftime(PARTITION_NAME_FORMATS[PARTITION_BY]))
+    if any(existing.first_id == partition.first_id for existing in partitions):
+        # partition of other size (before --partition-by was changed) starts at the same hour, ids would collide
+        partition = _Partition(directory, created_at.strftime(PARTITION_NAME_FORMATS['hour']))
+    return partition
+
+
+@asynccontextmanager
+async def _partition_connection(partition: _Partition, create: bool = False) -> AsyncIterator[aiosqlite.Connection]:
+    if not create:
+        # not created again if it was expired meanwhile
+        async with _connect(partition.path.resolve().as_uri() + '?mode=rw', uri=True) as conn:
+            yield conn
+        return
+
+    async with _connect(str(partition.path)) as conn:
+        if str(partition.path) not in InitializedPartitions:
+            await _init_db(conn)
+            InitializedPartitions.add(str(partition.path))
+        yield conn
+
+
+@asynccontextmanager
+async def _same_connection(conn: aiosqlite.Connection) -> AsyncIterator[aiosqlite.Connection]:
+    yield conn
+
+
+@asynccontextmanager
+async def _message_connection(conn: aiosqlite.Connection, message_id: Union[int, str],
+) -> AsyncIterator[Optional[aiosqlite.Connection]]:
+    """Connection to database with given message: conn itself, or to its partition (None if it doesn't exist)."""
+    if not PARTITION_BY:
+        yield conn
+        return
+    partition = _message_partition(_tenant(conn), message_id)
+    if partition is None:
+        yield None
+        return
+    async with _partition_connection(partition) as conn:
+        yield conn
+
+
+def _connections(conn: aiosqlite.Connection, since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None, newest_first: bool = False,
+) -> List[AsyncContextManager[aiosqlite.Connection]]:
+    """Connections to all databases with messages (from given time range): conn itself, or one for every partition."""
+    if not PARTITION_BY:
+        return [_same_connection(conn)]
+    partitions = _partitions(_tenant(conn), since, until)
+    if newest_first:
+        partitions.reverse()
+    return [_partition_connection(partition) for partition in partitions]
+
+
+async def _drop_partition(partition: _Partition) -> List[int]:
+    # ids only for notification, from index of primary key
+    async with _partition_connection(partition) as conn:
+        async with conn.execute('SELECT id FROM message ORDER BY id') as cur:
+            message_ids = [row[0] for row in await cur.fetchall()]
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            pathlib.Path(str(partition.path) + suffix).unlink()
+        except FileNotFoundError:
+            pass
+    InitializedPartitions.discard(str(partition.path))
+    PartitionsCache.pop(str(partition.path), None)
+    logger.info('partition dropped', partition=str(partition.path), messages=len(message_ids))
+    return message_ids
+
+
+async def expire_partitions(tenant: Optional[str] = None) -> List[int]:
+    """Drop partitions of tenant older than PARTITION_KEEP newest ones, return ids of their messages."""
+    if not PARTITION_BY or not PARTITION_KEEP:
+        return []
+    message_ids = []
+    for partition in _partitions(tenant)[:-PARTITION_KEEP]:
+        message_ids.extend(await _drop_partition(partition))
+    return message_ids
+
+
 async def create_tables(conn: aiosqlite.Connection) -> NoReturn:
     await conn.execute("""
         CREATE TABLE IF NOT EXISTS message (
@@ -60,9 +376,14 @@ async def create_tables(conn: aiosqlite.Connection) -> NoReturn:
             size INTEGER,
             type TEXT,
             peer TEXT,
-            created_at TIMESTAMP
+            created_at TIMESTAMP,
+            timings TEXT,
+            recipients_envelope_list TEXT
         )
     """)
+    await _add_column(conn, 'message', 'timings', 'TEXT')
+    # recipients_envelope split into addresses at write time (JSON), not on every read
+    await _add_column(conn, 'message', 'recipients_envelope_list', 'TEXT')
 
     await conn.execute("""
         CREATE TABLE IF NOT EXISTS message_part (
@@ -75,39 +396,421 @@ async def create_tables(conn: aiosqlite.Connection) -> NoReturn:
             charset TEXT,
             body BLOB,
             size INTEGER,
-            created_at TIMESTAMP
+            created_at TIMESTAMP,
+            encoding TEXT,
+            body_offset INTEGER,
+            body_length INTEGER
         )
     """)
+    # body_offset and body_length: encoded body within message.source, then body is NULL (see: PARTS_LAYOUT)
+    await _add_column(conn, 'message_part', 'encoding', 'TEXT')
+    await _add_column(conn, 'message_part', 'body_offset', 'INTEGER')
+    await _add_column(conn, 'message_part', 'body_length', 'INTEGER')
+    # parts are always looked up (and deleted) by message
+    await conn.execute('CREATE INDEX IF NOT EXISTS message_part_message_id ON message_part (message_id)')
+
+    # normalised senders and recipients, for lookups by address or domain
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_address (
+            message_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            address TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            PRIMARY KEY (message_id, role, address)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute('CREATE INDEX IF NOT EXISTS message_address_address ON message_address (address, role)')
+    await conn.execute('CREATE INDEX IF NOT EXISTS message_address_domain ON message_address (domain, role)')
+
+    # values of headers given in INDEX_HEADERS, and names of headers which are already indexed for all messages
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_header (
+            message_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (message_id, name, value)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute('CREATE INDEX IF NOT EXISTS message_header_value ON message_header (name, value)')
+    await conn.execute('CREATE TABLE IF NOT EXISTS indexed_header (name TEXT PRIMARY KEY)')
+
+    await _create_callback_queue(conn)
+
+
+async def _create_callback_queue(conn: aiosqlite.Connection) -> NoReturn:
+    # pending webhooks, survives restarts
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS callback_queue (
+            message_id INTEGER NOT NULL,
+            target TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL,
+            queued_at REAL,
+            PRIMARY KEY (message_id, target)
+        )
+    """)
+
+
+async def migrate(conn: aiosqlite.Connection) -> NoReturn:
+    """Fill tables and columns added in newer versions for messages stored by older ones."""
+    async with conn.execute('PRAGMA user_version') as cur:
+        version = (await cur.fetchone())[0]
+    if version >= DB_VERSION:
+        return
+
+    started_at = time.monotonic()
+    count = 0
+    if version < 1:
+        count = await _migrate_addresses(conn)
+    if version < 2:
+        await _migrate_callback_queue(conn)
+    await conn.execute(f'PRAGMA user_version = {DB_VERSION}')
+    await conn.commit()
+    logger.info('DB migrated', version=DB_VERSION, previous_version=version, messages=count,
+        duration=round(time.monotonic() - started_at, 3))
+
+
+async def _migrate_callback_queue(conn: aiosqlite.Connection) -> NoReturn:
+    # queue of version with one webhook is keyed by message only, its deliveries are for the default target
+    async with conn.execute('PRAGMA table_info(callback_queue)') as cur:
+        columns = [row['name'] for row in await cur.fetchall()]
+    if 'target' in columns:
+        return
+    await conn.execute('ALTER TABLE callback_queue RENAME TO callback_queue_old')
+    await _create_callback_queue(conn)
+    await conn.execute("""
+        INSERT INTO callback_queue (message_id, target, attempts, next_attempt_at, queued_at)
+        SELECT message_id, ?, attempts, next_attempt_at, queued_at FROM callback_queue_old
+    """, (callback.DEFAULT_TARGET,))
+    await conn.execute('DROP TABLE callback_queue_old')
+    logger.info('DB table migrated', table='callback_queue')
+
+
+async def _migrate_addresses(conn: aiosqlite.Connection) -> int:
+    # message_address and recipients_envelope_list, in batches so memory use doesn't grow with database
+    sql = """
+        SELECT
+            id, sender_envelope, sender_message, recipients_envelope,
+            recipients_message_to, recipients_message_cc, recipients_message_bcc
+        FROM
+            message
+        WHERE
+            id > ?
+        ORDER BY
+            id
+        LIMIT
+            ?
+    """
+    last_id, count = 0, 0
+    while True:
+        async with conn.execute(sql, (last_id, MIGRATE_BATCH_SIZE)) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            return count
+
+        address_rows, envelope_rows = [], []
+        for row in rows:
+            row = dict(row)
+            _prepare_message_row_inplace(row)
+            envelope_rows.append((json.dumps(row['recipients_envelope']), row['id']))
+            for role, address, domain in Message.normalize_addresses({
+                'mail_from': [row['sender_envelope']],
+                'from': [row['sender_message']],
+                'rcpt_to': row['recipients_envelope'],
+                'to': row['recipients_message_to'],
+                'cc': row['recipients_message_cc'],
+                'bcc': row['recipients_message_bcc'],
+            }):
+                address_rows.append((row['id'], role, address, domain))
+        await conn.executemany('INSERT OR IGNORE INTO message_address (message_id, role, address, domain) VALUES (?, ?, ?, ?)',
+            address_rows)
+        await conn.executemany('UPDATE message SET recipients_envelope_list = ? WHERE id = ?', envelope_rows)
+        await conn.commit()
+
+        last_id = rows[-1]['id']
+        count += len(rows)
+
+
+async def _sync_indexed_headers(conn: aiosqlite.Connection) -> NoReturn:
+    # headers added to INDEX_HEADERS are indexed for already stored messages, removed ones are dropped
+    async with conn.execute('SELECT name FROM indexed_header') as cur:
+        indexed = {row['name'] for row in await cur.fetchall()}
+    added = sorted(set(INDEX_HEADERS) - indexed)
+    removed = sorted(indexed - set(INDEX_HEADERS))
+    if not added and not removed:
+        return
+
+    started_at = time.monotonic()
+    if removed:
+        placeholders = ','.join('?' * len(removed))
+        await conn.execute(f'DELETE FROM message_header WHERE name IN ({placeholders})', removed)  # noqa: S608
+        await conn.execute(f'DELETE FROM indexed_header WHERE name IN ({placeholders})', removed)  # noqa: S608
+        await conn.commit()
+
+    count = 0
+    if added:
+        parser = HeaderParser()
+        sql = 'SELECT id, source FROM message WHERE id > ? ORDER BY id LIMIT ?'
+        last_id = 0
+        while True:
+            async with conn.execute(sql, (last_id, MIGRATE_BATCH_SIZE)) as cur:
+                rows = await cur.fetchall()
+            if not rows:
+                break
+
+            header_rows = []
+            for row in rows:
+                headers = {}
+                for name, value in parser.parsestr(row['source'] or '', headersonly=True).items():
+                    headers.setdefault(name.lower(), []).append(value)
+                header_rows.extend((row['id'], name, value) for name, value in message_header_rows(headers, added))
+            await conn.executemany('INSERT OR IGNORE INTO message_header (message_id, name, value) VALUES (?, ?, ?)',
+                header_rows)
+            await conn.commit()
+
+            last_id = rows[-1]['id']
+            count += len(rows)
+        await conn.executemany('INSERT INTO indexed_header (name) VALUES (?)', [(name,) for name in added])
+        await conn.commit()
+
+    logger.info('headers indexed', added=added, removed=removed, messages=count,
+        duration=round(time.monotonic() - started_at, 3))
+
+
+async def _add_column(conn: aiosqlite.Connection, table: str, column: str, definition: str) -> NoReturn:
+    # databases created by older versions
+    async with conn.execute(f'PRAGMA table_info({table})') as cur:
+        columns = [row['name'] for row in await cur.fetchall()]
+    if column not in columns:
+        await conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info('DB column added', table=table, column=column)
+
 
+def add_message(message: Message, record: Optional[journal.Record] = None) -> NoReturn:
+    """Queue message for storing (from any thread), record: its copy in the journal, released when it's stored."""
+    global QueuedBytes
+    if message.trace:
+        message.trace.mark('enqueued')
+    # counted right away, not when it gets to the queue, so the next message sees it (see: queue_has_room)
+    with QueuedBytesLock:
+        if record is not None and QueuedBytes >= QUEUE_MEMORY_LIMIT:
+            record.trace = message.trace
+            message = None
+        else:
+            QueuedBytes += message.size
+    DbMessagesQueue._loop.call_soon_threadsafe(DbMessagesQueue.put_nowait, (time.monotonic(), message, record))
 
-def add_message(message: Message) -> NoReturn:
-    DbMessagesQueue._loop.call_soon_threadsafe(DbMessagesQueue.put_nowait, message)
+
+def queue_has_room(size: int) -> bool:
+    """New message of that size can be kept in memory until it's stored (see: QUEUE_MEMORY_LIMIT). Called from
+    SMTP thread."""
+    # with the journal, messages above the limit are read from it when they are stored; bigger than the limit is
+    # accepted when the queue is empty, otherwise it would never fit
+    return QueuedBytes + size <= QUEUE_MEMORY_LIMIT or QueuedBytes == 0 or journal.enabled()
+
+
+def add_journal_records(records: List[journal.Record]) -> NoReturn:
+    """Queue messages left in the journal by previous run, they're read from it when their turn comes."""
+    for record in records:
+        DbMessagesQueue.put_nowait((time.monotonic(), None, record))
+
+
+def _load_message(record: journal.Record) -> Optional[Message]:
+    # in executor, message may be big
+    try:
+        tenant, email = journal.load(record)
+        message = Message.from_email(email)
+    except Exception:
+        logger.exception('message in journal can not be read, skipping', path=str(record.segment.path),
+            offset=record.offset)
+        return None
+    # tenant may be gone from configuration since the message was received
+    message.tenant = tenant if tenant is None or tenants.exists(tenant) else tenants.route(message)
+    message.trace = record.trace
+    return message
 
 
 async def message_saver() -> NoReturn:
+    global QueuedBytes
+    loop = asyncio.get_event_loop()
     while True:
-        message: Message = await DbMessagesQueue.get()
-        async with connection() as conn:
-            await store_message(conn, message)
-        DbMessagesQueue.task_done()
+        # messages received meanwhile are stored in one transaction
+        batch = [await DbMessagesQueue.get()]
+        while len(batch) < WRITE_BATCH_SIZE and not DbMessagesQueue.empty():
+            batch.append(DbMessagesQueue.get_nowait())
+
+        now = time.monotonic()
+        # one transaction in store of every tenant
+        groups = {}
+        records = []
+        # counted until they are stored, they're in memory till then
+        stored_bytes = sum(message.size for _, message, _ in batch if message is not None)
+        for queued_at, message, record in batch:
+            metrics.QUEUE_WAIT_SECONDS.observe(now - queued_at, queue='db')
+            if message is None:
+                message = await loop.run_in_executor(None, _load_message, record)
+            if record is not None:
+                records.append(record)
+            if message is not None:
+                groups.setdefault(message.tenant, []).append(message)
+        for tenant, messages in groups.items():
+            async with connection(tenant) as conn:
+                await store_messages(conn, messages)
+        with QueuedBytesLock:
+            QueuedBytes -= stored_bytes
+        if records:
+            journal.release(records)
+        for _ in batch:
+            DbMessagesQueue.task_done()
+
+
+async def drain() -> NoReturn:
+    """Wait until all queued messages are stored."""
+    await DbMessagesQueue.join()
+
+
+async def save_timings() -> NoReturn:
+    traces = tracing.pop_dirty()
+    if traces:
+        # one transaction in every partition of every tenant
+        groups = {}
+        for trace in traces:
+            key = (trace.tenant, trace.message_id // PARTITION_ID_SPAN)
+            groups.setdefault(key, []).append((trace.dumps(), trace.message_id))
+        for (tenant, _), rows in groups.items():
+            async with connection(tenant) as conn, _message_connection(conn, rows[0][1]) as message_conn:
+                if message_conn is None:
+                    continue
+                await message_conn.executemany('UPDATE message SET timings = ? WHERE id = ?', rows)
+                await message_conn.commit()
+            recent = cache.store(tenant)
+            if recent is not None:
+                for timings, message_id in rows:
+                    recent.set_timings(message_id, json.loads(timings))
+    tracing.flush_export()
+
+
+async def timings_saver() -> NoReturn:
+    # stages after commit are saved in batches, not with an UPDATE for every single one
+    while True:
+        await asyncio.sleep(TIMINGS_SAVE_INTERVAL)
+        await save_timings()
 
 
 async def store_message(conn: aiosqlite.Connection, message: Message) -> int:
-    sql = """
+    await store_messages(conn, [message])
+    return message.id
+
+
+async def store_messages(conn: aiosqlite.Connection, messages: List[Message], notify: bool = True,
+    webhooks: bool = True,
+) -> NoReturn:
+    """Store messages in one transaction, then announce them to clients (if notify) and webhooks (if webhooks).
+    Messages are stored in store of tenant of given connection, whatever their tenant was."""
+    # the same resolution and timezone as datetime('now') used to give us
+    created_at = datetime.datetime.utcnow().replace(microsecond=0)
+    tenant = _tenant(conn)
+    callback_targets = {}
+    for message in messages:
+        message.created_at = created_at
+        message.tenant = tenant
+        callback_targets[id(message)] = callback.route(message) if webhooks else []
+
+    first_id = 0
+    connect = _same_connection(conn)
+    if PARTITION_BY:
+        partition = _partition_for(tenant, created_at)
+        first_id = partition.first_id
+        connect = _partition_connection(partition, create=True)
+    recent = cache.store(tenant)
+    if recent is not None:
+        recent.writing()
+    async with connect as conn:
+        part_rows = await _insert_messages(conn, messages, callback_targets, first_id)
+        # before notifications, clients reload the first page when they get them
+        if recent is not None and recent.loaded:
+            recent.add(*_recent_rows(messages, part_rows))
+        elif recent is not None:
+            recent.added(len(messages))
+
+    if len(messages) == 1:
+        logger.debug('message stored', message_id=messages[0].id,
+            parts=[{'part_id': part['part_id'], 'cid': part['cid']} for part in messages[0].parts])
+    else:
+        logger.debug('messages stored', count=len(messages), first_id=messages[0].id, last_id=messages[-1].id)
+
+    for message in messages:
+        if message.trace:
+            tracing.register(message.id, message.trace, tenant)
+            tracing.mark(message.id, 'committed', tenant)
+
+        if notify:
+            await notifier.broadcast('add_message', message.id, tenant=tenant,
+                data=dict(message.to_summary(), headers=_headers_dict(message_header_rows(message.headers, INDEX_HEADERS))))
+        await callback.enqueue(message, callback_targets[id(message)])
+
+    if PARTITION_BY and PARTITION_KEEP:
+        if recent is not None:
+            recent.writing()
+        expired = await expire_partitions(tenant)
+        if recent is not None:
+            recent.remove(expired, len(expired))
+        if expired and notify:
+            await notifier.broadcast('delete_message', *expired, tenant=tenant)
+
+
+def _recent_rows(messages: List[Message], part_rows: List[tuple]) -> Tuple[List[dict], Dict[int, List[tuple]]]:
+    # just stored messages, the same as read by get_messages (without source), for cache of recent messages
+    rows = [
+        dict(message.to_summary(), timings=message.trace.to_dict() if message.trace else None,
+            headers=_headers_dict(message_header_rows(message.headers, INDEX_HEADERS)))
+        for message in messages
+    ]
+    parts = {message.id: [] for message in messages}
+    for _, message_id, cid, type_, is_attachment, filename, _, _, size, *_ in part_rows:
+        parts[message_id].append((message_id, cid, type_, filename, size, int(is_attachment)))
+    return rows, parts
+
+
+async def _insert_messages(conn: aiosqlite.Connection, messages: List[Message], callback_targets: Dict[int, List[str]],
+    first_id: int,
+) -> List[tuple]:
+    """Insert messages with everything of them, in one transaction. Returns inserted message_part rows."""
+    message_sql = """
         INSERT INTO message
-            (sender_envelope, sender_message, recipients_envelope, recipients_message_to,
+            (id, sender_envelope, sender_message, recipients_envelope, recipients_message_to,
              recipients_message_cc, recipients_message_bcc, subject,
-              source, type, size, peer, created_at)
+              source, type, size, peer, created_at, timings, recipients_envelope_list)
         VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    part_sql = """
+        INSERT INTO message_part
+            (id, message_id, cid, type, is_attachment, filename, charset, body, size, encoding, body_offset,
+             body_length, created_at)
+        VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
     """
 
     cur = await conn.cursor()
+    started_at = time.perf_counter()
 
     try:
-        await cur.execute(
-            sql,
-            (
+        # ids are assigned here (the same way SQLite does: max + 1, in partition: from its first id), so all rows can
+        # be inserted at once; IMMEDIATE: no other writer can take them meanwhile
+        await cur.execute('BEGIN IMMEDIATE')
+        await cur.execute('SELECT COALESCE(MAX(id), ?) FROM message', (first_id,))
+        message_id = (await cur.fetchone())[0]
+        await cur.execute('SELECT COALESCE(MAX(id), ?) FROM message_part', (first_id,))
+        part_id = (await cur.fetchone())[0]
+
+        message_rows, part_rows, address_rows, header_rows, callback_rows = [], [], [], [], []
+        queued_at = time.time()
+        for message in messages:
+            message_id += 1
+            message.id = message_id
+            message_rows.append((
+                message.id,
                 message.sender_envelope,
                 message.sender_message,
                 message.recipients_envelope,
@@ -119,48 +822,140 @@ async def store_message(conn: aiosqlite.Connection, message: Message) -> int:
                 message.type,
                 message.size,
                 message.peer,
-            ),
-        )
-        message.id = cur.lastrowid
-        # Store parts (why do we do this for non-multipart at all?!)
-        for part in message.parts:
-            part_id = await _save_message_part(cur, message.id, part['cid'], part['part'])
-            part['part_id'] = part_id
+                message.created_at.isoformat(' '),
+                message.trace.dumps() if message.trace else None,
+                json.dumps(Message.split_addresses(message.recipients_envelope or '')),
+            ))
+            for role, address, domain in message.addresses:
+                address_rows.append((message.id, role, address, domain))
+            if INDEX_HEADERS:
+                header_rows.extend((message.id, name, value) for name, value in message_header_rows(message.headers, INDEX_HEADERS))
+            # Store parts (why do we do this for non-multipart at all?!)
+            if all('row' in part for part in message.parts):
+                rows = [part['row'] for part in message.parts]
+            else:
+                rows = message_part_rows(message, PARTS_LAYOUT)
+            for part, row in zip(message.parts, rows):
+                part_id += 1
+                part['part_id'] = part_id
+                part_rows.append((part_id, message.id, *row))
+            # in the same transaction, so webhook is not lost even if we crash right after commit
+            for target in callback_targets[id(message)]:
+                callback_rows.append((message.id, target, queued_at))
+
+        await cur.executemany(message_sql, message_rows)
+        if part_rows:
+            await cur.executemany(part_sql, part_rows)
+        if address_rows:
+            await cur.executemany('INSERT INTO message_address (message_id, role, address, domain) VALUES (?, ?, ?, ?)',
+                address_rows)
+        if header_rows:
+            await cur.executemany('INSERT INTO message_header (message_id, name, value) VALUES (?, ?, ?)', header_rows)
+        if callback_rows:
+            await cur.executemany('INSERT INTO callback_queue (message_id, target, queued_at) VALUES (?, ?, ?)',
+                callback_rows)
         await cur.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            await conn.rollback()
+        raise
     finally:
         await cur.close()
+    metrics.DB_COMMIT_SECONDS.observe(time.perf_counter() - started_at)
+    metrics.DB_COMMIT_BATCH_SIZE.observe(len(messages))
+    return part_rows
 
-    logger.debug('message stored', message_id=message.id,
-        parts=[{'part_id': part['part_id'], 'cid': part['cid']} for part in message.parts])
-    await notifier.broadcast('add_message', message.id)
-    await callback.enqueue(message)
-    return message.id
 
+def _decode_range(source: str, offset: int, length: int, encoding: Optional[str]) -> Optional[bytes]:
+    try:
+        return b''.join(Message.iter_decoded_body(source[offset:offset + length], encoding))
+    except (binascii.Error, ValueError):
+        return None
 
-async def _save_message_part(cur: aiosqlite.Cursor, message_id: int, cid: str, part: EmailMessage) -> int:
-    sql = """
-        INSERT INTO message_part
-            (message_id, cid, type, is_attachment, filename, charset, body, size, created_at)
-        VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+
+def message_part_rows(message: Message, layout: str = 'copy') -> List[tuple]:
+    """Values of message_part rows, can be computed in advance (ie. in other process) and put in part['row'].
+
+    In ranges layout body is not copied if decoding its range of source gives the same content. Line endings of
+    not base64 encoded parts may be normalised (like in the source), other differences fall back to a copy.
     """
+    rows = []
+    start = 0
+    for part in message.parts:
+        cid, part = part['cid'], part['part']
+        body = part.get_payload(decode=True)
+        encoding = (part.get('Content-Transfer-Encoding') or '').strip().lower() or None
+        offset = length = None
+        if layout == 'ranges' and body:
+            found = Message.find_part_body(message.source, part, start)
+            if found:
+                decoded = _decode_range(message.source, *found, encoding)
+                if decoded == body or (encoding != 'base64' and decoded == RE_NEWLINES_BYTES.sub(b'\n', body)):
+                    offset, length = found
+                    start = offset + length
+                    body = decoded
 
-    body = part.get_payload(decode=True)
-    body_len = len(body) if body else 0
-    await cur.execute(
-        sql,
-        (
-            message_id,
+        filename = part.get_filename()
+        rows.append((
             cid,
             part.get_content_type(),
-            part.get_filename() is not None,
-            part.get_filename(),
+            filename is not None,
+            filename,
             part.get_content_charset(),
-            body,
-            body_len,
-        ),
-    )
-    return cur.lastrowid
+            body if offset is None else None,
+            len(body) if body else 0,
+            encoding,
+            offset,
+            length,
+        ))
+    return rows
+
+
+def iter_part_body(part: sqlite3.Row) -> Iterator[bytes]:
+    """Decoded body of part returned by get_message_part_*, chunk by chunk."""
+    if part['body_offset'] is None:
+        if part['body']:
+            yield part['body']
+        return
+    yield from Message.iter_decoded_body(part['source_range'], part['encoding'])
+
+
+def message_header_rows(headers: Dict[str, List[str]], names: Iterable[str]) -> List[Tuple[str, str]]:
+    """Unique (name, value) of given headers (lowercased names) to store in message_header, values are decoded."""
+    ret = []
+    for name in names:
+        seen = set()
+        for value in headers.get(name, ()):
+            try:
+                value = Message.decode_header(value)
+            except (LookupError, UnicodeError):
+                value = str(value)
+            value = ' '.join(value.split())
+            if value and value not in seen:
+                seen.add(value)
+                ret.append((name, value))
+    return ret
+
+
+def _headers_dict(rows: Iterable[Tuple[str, str]]) -> Dict[str, List[str]]:
+    # as shown in API: names as configured
+    ret = {}
+    for name, value in rows:
+        if name in INDEX_HEADERS:
+            ret.setdefault(INDEX_HEADERS[name], []).append(value)
+    return ret
+
+
+async def _add_headers_inplace(conn: aiosqlite.Connection, rows: List[dict]) -> NoReturn:
+    headers = {row['id']: [] for row in rows}
+    if INDEX_HEADERS and headers:
+        sql = 'SELECT message_id, name, value FROM message_header WHERE message_id IN ({})'.format(  # noqa: S608
+            ','.join('?' * len(headers)))
+        async with conn.execute(sql, list(headers)) as cur:
+            for row in await cur.fetchall():
+                headers[row['message_id']].append((row['name'], row['value']))
+    for row in rows:
+        row['headers'] = _headers_dict(headers[row['id']])
 
 
 def _parse_recipients(recipients: Optional[str]) -> List[str]:
@@ -171,23 +966,51 @@ def _parse_recipients(recipients: Optional[str]) -> List[str]:
 
 
 def _prepare_message_row_inplace(row: dict) -> NoReturn:
-    row['recipients_envelope'] = Message.split_addresses(row['recipients_envelope'])
+    recipients_envelope = row.pop('recipients_envelope_list', None)
+    if recipients_envelope is not None:
+        row['recipients_envelope'] = json.loads(recipients_envelope)
+    else:
+        row['recipients_envelope'] = Message.split_addresses(row['recipients_envelope'])
     row['recipients_message_to'] = _parse_recipients(row['recipients_message_to'])
     row['recipients_message_cc'] = _parse_recipients(row['recipients_message_cc'])
     row['recipients_message_bcc'] = _parse_recipients(row['recipients_message_bcc'])
+    if 'timings' in row:
+        row['timings'] = json.loads(row['timings']) if row['timings'] else None
 
 
-async def get_message(conn: aiosqlite.Connection, message_id: int) -> Optional[dict]:
-    async with conn.execute('SELECT * FROM message WHERE id = ?', (message_id,)) as cur:
-        row = await cur.fetchone()
-    if not row:
-        return None
-    row = dict(row)
-    _prepare_message_row_inplace(row)
+async def get_message(conn: aiosqlite.Connection, message_id: int, source: bool = True) -> Optional[dict]:
+    """Message with its source, if source (only without it can be served by cache of recent messages)."""
+    recent = cache.store(_tenant(conn)) if not source else None
+    if recent is not None:
+        row = recent.message(int(message_id))
+        if row is not None:
+            return row
+
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return None
+        sql = 'SELECT {0} FROM message WHERE id = ?'.format('*' if source else MESSAGE_COLUMNS)  # noqa: S608
+        async with conn.execute(sql, (message_id,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return None
+        row = dict(row)
+        _prepare_message_row_inplace(row)
+        await _add_headers_inplace(conn, [row])
     return row
 
 
 async def get_message_attachments(conn: aiosqlite.Connection, message_id: int) -> Iterable[sqlite3.Row]:
+    parts = _recent_parts(conn, message_id)
+    if parts is not None:
+        attachments = [
+            {'message_id': int(message_id), 'cid': cid, 'type': type_, 'filename': filename, 'size': size}
+            for _, cid, type_, filename, size, is_attachment in parts if is_attachment
+        ]
+        # the same order as in SQL: NULLs first
+        attachments.sort(key=lambda part: (part['filename'] is not None, part['filename'] or ''))
+        return attachments
+
     sql = """
         SELECT
             message_id, cid, type, filename, size
@@ -199,8 +1022,11 @@ async def get_message_attachments(conn: aiosqlite.Connection, message_id: int) -
         ORDER BY
             filename ASC
     """
-    async with conn.execute(sql, (message_id,)) as cur:
-        data = await cur.fetchall()
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return []
+        async with conn.execute(sql, (message_id,)) as cur:
+            data = await cur.fetchall()
 
     return data
 
@@ -208,19 +1034,23 @@ async def get_message_attachments(conn: aiosqlite.Connection, message_id: int) -
 async def _get_message_part_types(conn: aiosqlite.Connection, message_id: int, types: List[str]) -> sqlite3.Row:
     sql = """
         SELECT
-            *
+            {0}
         FROM
-            message_part
+            message_part p
+            JOIN message m ON m.id = p.message_id
         WHERE
-            message_id = ? AND
-            type IN ({0}) AND
-            is_attachment = 0
+            p.message_id = ? AND
+            p.type IN ({1}) AND
+            p.is_attachment = 0
         LIMIT
             1
-    """.format(','.join('?' * len(types)))  # noqa: S608
+    """.format(PART_COLUMNS, ','.join('?' * len(types)))  # noqa: S608
 
-    async with conn.execute(sql, (message_id,) + types) as cur:
-        data = await cur.fetchone()
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return None
+        async with conn.execute(sql, (message_id,) + types) as cur:
+            data = await cur.fetchone()
     return data
 
 
@@ -233,12 +1063,28 @@ async def get_message_part_plain(conn: aiosqlite.Connection, message_id: int) ->
 
 
 async def get_message_part_cid(conn: aiosqlite.Connection, message_id: int, cid: str) -> sqlite3.Row:
-    async with conn.execute('SELECT * FROM message_part WHERE message_id = ? AND cid = ?', (message_id, cid)) as cur:
-        data = await cur.fetchone()
+    sql = 'SELECT {0} FROM message_part p JOIN message m ON m.id = p.message_id WHERE p.message_id = ? AND p.cid = ?'.format(
+        PART_COLUMNS)  # noqa: S608
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return None
+        async with conn.execute(sql, (message_id, cid)) as cur:
+            data = await cur.fetchone()
     return data
 
 
+def _recent_parts(conn: aiosqlite.Connection, message_id: int) -> Optional[List[tuple]]:
+    recent = cache.store(_tenant(conn))
+    if recent is None:
+        return None
+    return recent.message_parts(int(message_id))
+
+
 async def _message_has_types(conn: aiosqlite.Connection, message_id: int, types: List[str]) -> bool:
+    parts = _recent_parts(conn, message_id)
+    if parts is not None:
+        return any(type_ in types and not is_attachment for _, _, type_, _, _, is_attachment in parts)
+
     sql = """
         SELECT
             1
@@ -251,8 +1097,11 @@ async def _message_has_types(conn: aiosqlite.Connection, message_id: int, types:
         LIMIT
             1
     """.format(','.join('?' * len(types)))  # noqa: S608
-    async with conn.execute(sql, (message_id,) + types) as cur:
-        data = await cur.fetchone()
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return False
+        async with conn.execute(sql, (message_id,) + types) as cur:
+            data = await cur.fetchone()
     return data is not None
 
 
@@ -264,41 +1113,341 @@ async def message_has_plain(conn: aiosqlite.Connection, message_id: int) -> bool
     return await _message_has_types(conn, message_id, ('text/plain',))
 
 
-async def get_messages(conn: aiosqlite.Connection, offset: int = 0, limit: int = 30) -> List[dict]:
-    async with conn.execute('SELECT * FROM message ORDER BY created_at DESC LIMIT ? OFFSET ?', (limit, offset)) as cur:
-        data = await cur.fetchall()
+def _index_where(recipients: Iterable[str] = (), senders: Iterable[str] = (), domains: Iterable[str] = (),
+    headers: Optional[Dict[str, Iterable[str]]] = None,
+) -> Tuple[List[str], List[str]]:
+    # every criterion is a lookup in message_address or message_header indexes, values within one criterion
+    # are OR-ed
+    where, params = [], []
+    for patterns, roles in ((recipients, RECIPIENT_ROLES), (senders, SENDER_ROLES)):
+        selects = []
+        roles_sql = ','.join('?' * len(roles))
+        for pattern in patterns:
+            kind, value = classify_address_pattern(pattern)
+            column, operator = {
+                'exact': ('address', '='),
+                'domains': ('domain', '='),
+                'patterns': ('address', 'GLOB'),
+            }[kind]
+            selects.append(f'SELECT message_id FROM message_address WHERE {column} {operator} ? AND role IN ({roles_sql})')  # noqa: S608
+            params.extend([value, *roles])
+        if selects:
+            where.append('id IN ({})'.format(' UNION '.join(selects)))
+    domains = list(domains)
+    if domains:
+        placeholders = ','.join('?' * len(domains))
+        where.append(f'id IN (SELECT message_id FROM message_address WHERE domain IN ({placeholders}))')  # noqa: S608
+        params.extend(domains)
+    for name, values in (headers or {}).items():
+        values = list(values)
+        placeholders = ','.join('?' * len(values))
+        where.append(f'id IN (SELECT message_id FROM message_header WHERE name = ? AND value IN ({placeholders}))')  # noqa: S608
+        params.extend([name.lower(), *values])
+    return where, params
 
-    data = list(map(dict, data))
-    for row in data:
-        _prepare_message_row_inplace(row)
+
+async def get_messages(conn: aiosqlite.Connection, offset: int = 0, limit: int = 30, recipients: Iterable[str] = (),
+    senders: Iterable[str] = (), domains: Iterable[str] = (), headers: Optional[Dict[str, Iterable[str]]] = None,
+) -> List[dict]:
+    where, params = _index_where(recipients, senders, domains, headers)
+    recent = cache.store(_tenant(conn)) if not where and offset + limit <= cache.SIZE else None
+    if recent is not None:
+        data = recent.page(offset, limit)
+        if data is not None:
+            return data
+        # the whole cached window is read, not only the page
+        version = recent.version
+        window = await _get_messages(conn, where, params, 0, cache.SIZE)
+        recent.load(window, len(window) < cache.SIZE, version)
+        return window[offset:offset + limit]
+    return await _get_messages(conn, where, params, offset, limit)
+
+
+async def _get_messages(conn: aiosqlite.Connection, where: List[str], params: List[str], offset: int, limit: int,
+) -> List[dict]:
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    # id: messages stored in one transaction have the same created_at
+    sql = f'SELECT {MESSAGE_COLUMNS} FROM message{where_sql} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'  # noqa: S608
+
+    data = []
+    # partitions from the newest one, until the page is filled
+    for connect in _connections(conn, newest_first=True):
+        async with connect as conn:
+            if offset and PARTITION_BY:
+                # partitions before the page are only counted
+                async with conn.execute(f'SELECT count(1) FROM message{where_sql}', params) as cur:  # noqa: S608
+                    count = (await cur.fetchone())[0]
+                if count <= offset:
+                    offset -= count
+                    continue
+
+            async with conn.execute(sql, (*params, limit - len(data), offset)) as cur:
+                rows = list(map(dict, await cur.fetchall()))
+            offset = 0
+            for row in rows:
+                _prepare_message_row_inplace(row)
+            await _add_headers_inplace(conn, rows)
+        data.extend(rows)
+        if len(data) >= limit:
+            break
     return data
 
 
-async def get_messages_count(conn: aiosqlite.Connection) -> int:
-    async with conn.execute('SELECT count(1) FROM message') as cur:
-        cnt = await cur.fetchone()
-    return cnt[0]
+def _time_range_where(since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> Tuple[List[str], List[str]]:
+    where, params = [], []
+    if since:
+        where.append('created_at >= ?')
+        params.append(since.isoformat(' '))
+    if until:
+        where.append('created_at < ?')
+        params.append(until.isoformat(' '))
+    return where, params
+
+
+async def iter_messages(conn: aiosqlite.Connection, since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+) -> AsyncIterator[dict]:
+    """All messages (with source) in order of arrival.
+
+    Read with one cursor, so it's one snapshot of database (of every partition) for the whole iteration, without
+    all rows in memory. Partitions outside of time range are not opened at all.
+    """
+    where, params = _time_range_where(since, until)
+    sql = 'SELECT * FROM message'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id'
+
+    for connect in _connections(conn, since, until):
+        async with connect as conn, conn.execute(sql, params) as cur:
+            while True:
+                rows = await cur.fetchmany(ITER_MESSAGES_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    row = dict(row)
+                    _prepare_message_row_inplace(row)
+                    yield row
+
+
+async def get_messages_count(conn: aiosqlite.Connection, recipients: Iterable[str] = (), senders: Iterable[str] = (),
+    domains: Iterable[str] = (), headers: Optional[Dict[str, Iterable[str]]] = None,
+) -> int:
+    where, params = _index_where(recipients, senders, domains, headers)
+    sql = 'SELECT count(1) FROM message'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+
+    recent = cache.store(_tenant(conn)) if not where else None
+    if recent is not None:
+        if recent.total is not None:
+            return recent.total
+        version = recent.version
+
+    total = 0
+    for connect in _connections(conn):
+        async with connect as conn, conn.execute(sql, params) as cur:
+            total += (await cur.fetchone())[0]
+    if recent is not None:
+        recent.set_total(total, version)
+    return total
+
+
+def get_db_size() -> int:
+    """Size of stores of all tenants, with their partitions."""
+    paths = []
+    for tenant in (None, *tenants.names()):
+        paths.append(db_path(tenant))
+        if PARTITION_BY:
+            paths.extend(str(partition.path) for partition in _partitions(tenant))
+    size = 0
+    for path in paths:
+        for suffix in ('', '-wal', '-journal'):
+            try:
+                size += pathlib.Path(path + suffix).stat().st_size
+            except OSError:
+                pass
+    return size
+
+
+async def _delete_rows(cur: aiosqlite.Cursor, message_ids: List[int]) -> int:
+    placeholders = ','.join('?' * len(message_ids))
+    await cur.execute(f'DELETE FROM message WHERE id IN ({placeholders})', message_ids)  # noqa: S608
+    deleted = cur.rowcount
+    await cur.execute(f'DELETE FROM message_part WHERE message_id IN ({placeholders})', message_ids)  # noqa: S608
+    await cur.execute(f'DELETE FROM message_address WHERE message_id IN ({placeholders})', message_ids)  # noqa: S608
+    await cur.execute(f'DELETE FROM message_header WHERE message_id IN ({placeholders})', message_ids)  # noqa: S608
+    await cur.execute(f'DELETE FROM callback_queue WHERE message_id IN ({placeholders})', message_ids)  # noqa: S608
+    return deleted
 
 
 async def delete_message(conn: aiosqlite.Connection, message_id: int) -> NoReturn:
+    tenant = _tenant(conn)
+    recent = cache.store(tenant)
+    if recent is not None:
+        recent.writing()
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return
+        cur = await conn.cursor()
+        try:
+            deleted = await _delete_rows(cur, [message_id])
+            await cur.execute('COMMIT')
+        finally:
+            await cur.close()
+    if recent is not None:
+        recent.remove([int(message_id)], deleted)
+    logger.debug('message deleted', message_id=message_id, tenant=tenant)
+    await notifier.broadcast('delete_message', message_id, tenant=tenant)
+
+
+async def delete_filtered_messages(conn: aiosqlite.Connection, ids: Optional[Iterable[int]] = None,
+    since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+    message_filter: Optional[MessageFilter] = None, headers: Optional[Dict[str, Iterable[str]]] = None,
+) -> int:
+    """Delete messages matching all given criteria, with their parts and pending webhooks.
+
+    Messages are deleted in batches, one transaction each, so ingest is not blocked for the whole operation.
+    Partitions within time range are unlinked as a whole if there are no other criteria. Clients are notified once,
+    with ids of all deleted messages.
+    """
+    where, params = _time_range_where(since, until)
+    index_where, index_params = _index_where(message_filter.recipients if message_filter else (),
+        message_filter.senders if message_filter else (), headers=headers)
+    where.extend(index_where)
+    params.extend(index_params)
+    filter_index = None
+    # regexp, can't be done in SQL
+    if message_filter and message_filter.subject:
+        filter_index = FilterIndex()
+        filter_index.add(MessageFilter(subject=message_filter.subject))
+    if ids is not None:
+        ids = sorted(set(ids))
+
+    tenant = _tenant(conn)
+    recent = cache.store(tenant)
+    if recent is not None:
+        recent.writing()
+    deleted = []
+    try:
+        if PARTITION_BY and ids is None and not index_where and not filter_index:
+            for partition in _partitions(tenant, since, until):
+                if partition.within(since, until):
+                    deleted.extend(await _drop_partition(partition))
+        for connect in _connections(conn, since, until):
+            async with connect as conn:
+                deleted.extend(await _delete_batches(conn, ids, where, params, filter_index))
+    finally:
+        # batches are committed one by one, the ones deleted before a failure are gone too
+        if recent is not None:
+            recent.remove(deleted, len(deleted))
+
+    logger.debug('messages deleted', count=len(deleted), tenant=tenant)
+    if deleted:
+        await notifier.broadcast('delete_message', *deleted, tenant=tenant)
+    return len(deleted)
+
+
+async def _delete_batches(conn: aiosqlite.Connection, ids: Optional[List[int]], where: List[str], params: List[Any],
+    filter_index: Optional[FilterIndex],
+) -> List[int]:
+    columns = 'id, subject' if filter_index else 'id'
+    deleted = []
+    last_id, offset = 0, 0
     cur = await conn.cursor()
     try:
-        await cur.execute('DELETE FROM message WHERE id = ?', (message_id,))
-        await cur.execute('DELETE FROM message_part WHERE message_id = ?', (message_id,))
-        await cur.execute('COMMIT')
+        while True:
+            if ids is not None:
+                batch = ids[offset:offset + DELETE_BATCH_SIZE]
+                if not batch:
+                    break
+                offset += len(batch)
+                batch_where = ' AND '.join([f'id IN ({",".join("?" * len(batch))})', *where])
+                batch_params = [*batch, *params]
+            else:
+                # keyset pagination, deleted rows are not scanned again
+                batch_where = ' AND '.join(['id > ?', *where])
+                batch_params = [last_id, *params]
+
+            await cur.execute('BEGIN IMMEDIATE')
+            try:
+                await cur.execute(f'SELECT {columns} FROM message WHERE {batch_where} ORDER BY id LIMIT ?',  # noqa: S608
+                    (*batch_params, DELETE_BATCH_SIZE))
+                rows = await cur.fetchall()
+                message_ids = []
+                for row in rows:
+                    if filter_index and not filter_index.match(dict(row)):
+                        continue
+                    message_ids.append(row['id'])
+                if message_ids:
+                    await _delete_rows(cur, message_ids)
+                await cur.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    await conn.rollback()
+                raise
+            deleted.extend(message_ids)
+
+            if ids is None:
+                if len(rows) < DELETE_BATCH_SIZE:
+                    break
+                last_id = rows[-1]['id']
     finally:
         await cur.close()
-    logger.debug('message deleted', message_id=message_id)
-    await notifier.broadcast('delete_message', message_id)
+    return deleted
 
 
 async def delete_messages(conn: aiosqlite.Connection) -> NoReturn:
+    recent = cache.store(_tenant(conn))
+    if recent is not None:
+        recent.writing()
+    if PARTITION_BY:
+        for partition in _partitions(_tenant(conn)):
+            await _drop_partition(partition)
     cur = await conn.cursor()
     try:
         await cur.execute('DELETE FROM message')
         await cur.execute('DELETE FROM message_part')
+        await cur.execute('DELETE FROM message_address')
+        await cur.execute('DELETE FROM message_header')
+        await cur.execute('DELETE FROM callback_queue')
         await cur.execute('COMMIT')
     finally:
         await cur.close()
-    logger.debug('all messages deleted')
-    await notifier.broadcast('delete_messages')
+    if recent is not None:
+        recent.clear()
+    logger.debug('all messages deleted', tenant=_tenant(conn))
+    await notifier.broadcast('delete_messages', tenant=_tenant(conn))
+
+
+async def get_callback_deliveries(conn: aiosqlite.Connection, queued_before: Optional[float] = None) -> List[sqlite3.Row]:
+    sql = 'SELECT * FROM callback_queue'
+    params = ()
+    if queued_before is not None:
+        sql += ' WHERE queued_at < ?'
+        params = (queued_before,)
+    data = []
+    # partitions are in order of ids
+    for connect in _connections(conn):
+        async with connect as conn, conn.execute(sql + ' ORDER BY message_id ASC', params) as cur:
+            data.extend(await cur.fetchall())
+    return data
+
+
+async def update_callback_delivery(conn: aiosqlite.Connection, message_id: int, target: str, attempts: int,
+    next_attempt_at: float,
+) -> NoReturn:
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return
+        await conn.execute('UPDATE callback_queue SET attempts = ?, next_attempt_at = ? WHERE message_id = ? AND target = ?',
+            (attempts, next_attempt_at, message_id, target))
+        await conn.commit()
+
+
+async def delete_callback_delivery(conn: aiosqlite.Connection, message_id: int, target: str) -> NoReturn:
+    async with _message_connection(conn, message_id) as conn:
+        if conn is None:
+            return
+        await conn.execute('DELETE FROM callback_queue WHERE message_id = ? AND target = ?', (message_id, target))
+        await conn.commit()
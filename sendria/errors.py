@@ -25,3 +25,15 @@ class SendriaException(Exception):
 
     def get_message(self) -> Optional[str]:
         return self.message
+
+
+class InvalidFilterException(SendriaException):
+    pass
+
+
+class InvalidRequestException(SendriaException):
+    pass
+
+
+class ProfilerBusyException(SendriaException):
+    pass
@@ -0,0 +1,120 @@
+__all__ = ['EXPORT_FORMATS', 'CONTENT_TYPES', 'parse_time', 'export_filename', 'export_messages']
+
+import datetime
+import re
+import time
+import zipfile
+from typing import Optional, NoReturn, AsyncIterator, List
+
+import aiosqlite
+from structlog import get_logger
+
+from . import db
+from .filters import MessageFilter, FilterIndex
+
+logger = get_logger()
+EXPORT_FORMATS = ('mbox', 'zip')
+CONTENT_TYPES = {
+    'mbox': 'application/mbox',
+    'zip': 'application/zip',
+}
+# messages are sent in chunks of at least this size (unless it's the last one)
+CHUNK_SIZE = 64 * 1024
+# mboxrd: every line looking like separator is quoted with one more '>'
+RE_MBOX_FROM = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    """ISO 8601 date or date and time (UTC if timezone is not given), as naive UTC datetime stored in DB."""
+    if not value:
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    ret = datetime.datetime.fromisoformat(value)
+    if ret.tzinfo:
+        ret = ret.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ret
+
+
+def export_filename(fmt: str) -> str:
+    return 'sendria-{}.{}'.format(time.strftime('%Y%m%d-%H%M%S'), fmt)
+
+
+def _source(row: dict) -> bytes:
+    return row['source'].encode('utf-8', 'ignore')
+
+
+def _mbox_entry(row: dict) -> bytes:
+    source = RE_MBOX_FROM.sub(rb'>\1', _source(row).replace(b'\r\n', b'\n'))
+    if not source.endswith(b'\n'):
+        source += b'\n'
+    sender = ''.join((row['sender_envelope'] or '').split()) or 'MAILER-DAEMON'
+    separator = f'From {sender} {time.asctime(row["created_at"].timetuple())}\n'
+    return separator.encode() + source + b'\n'
+
+
+def _zip_info(row: dict) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(f'{row["id"]}.eml', date_time=row['created_at'].timetuple()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+class _ZipStream:
+    """Write-only, unseekable file for ZipFile: written data is taken away after every message."""
+
+    def __init__(self) -> NoReturn:
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> NoReturn:
+        pass
+
+    def pop(self) -> bytes:
+        ret = b''.join(self._chunks)
+        self._chunks = []
+        return ret
+
+
+async def export_messages(conn: aiosqlite.Connection, fmt: str, since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None, message_filter: Optional[MessageFilter] = None,
+) -> AsyncIterator[bytes]:
+    """Archive of messages in given format, generated chunk by chunk with memory use bounded by the largest message."""
+    filter_index = None
+    if message_filter:
+        filter_index = FilterIndex()
+        filter_index.add(message_filter)
+
+    zip_stream = zip_file = None
+    if fmt == 'zip':
+        zip_stream = _ZipStream()
+        zip_file = zipfile.ZipFile(zip_stream, 'w')
+
+    chunks, size, count = [], 0, 0
+    async for row in db.iter_messages(conn, since=since, until=until):
+        if filter_index and not filter_index.match(row):
+            continue
+
+        if zip_file:
+            zip_file.writestr(_zip_info(row), _source(row))
+            data = zip_stream.pop()
+        else:
+            data = _mbox_entry(row)
+        count += 1
+
+        chunks.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunks)
+            chunks, size = [], 0
+
+    if zip_file:
+        # central directory
+        zip_file.close()
+        chunks.append(zip_stream.pop())
+    if chunks:
+        yield b''.join(chunks)
+
+    logger.info('messages exported', format=fmt, messages=count)
@@ -0,0 +1,209 @@
+__all__ = ['MessageFilter', 'FilterIndex', 'classify_address_pattern']
+
+import fnmatch
+import re
+from email.utils import getaddresses
+from typing import Optional, NoReturn, Iterable, Dict, Set, Tuple, List, Any, Pattern
+
+from .errors import InvalidFilterException
+
+FilterKey = Tuple
+
+
+def _split_values(values: Iterable[str]) -> List[str]:
+    ret = []
+    for value in values:
+        ret.extend(v.strip().lower() for v in value.split(',') if v.strip())
+    return ret
+
+
+def _extract_addresses(values: Iterable[Optional[str]]) -> Set[str]:
+    return {addr.lower() for _, addr in getaddresses([v for v in values if v]) if addr}
+
+
+def classify_address_pattern(pattern: str) -> Tuple[str, str]:
+    """Kind of address pattern (exact, domain or glob) and the value to look for."""
+    if pattern.startswith('*@'):
+        pattern = pattern[1:]
+    has_wildcards = any(c in pattern for c in '*?[')
+    if pattern.startswith('@') and not has_wildcards:
+        return 'domains', pattern[1:]
+    if not has_wildcards:
+        return 'exact', pattern
+    return 'patterns', pattern
+
+
+class MessageFilter:
+    """Subscription filter: every given criterion has to match (values within one criterion are OR-ed).
+
+    Addresses may be given as exact address (``alice@example.test``), domain (``@example.test``
+    or ``*@example.test``) or glob (``qa-*@example.test``). Subject is a case insensitive regexp.
+    """
+    __slots__ = ('recipients', 'senders', 'subject', 'key')
+
+    def __init__(self, recipients: Iterable[str] = (), senders: Iterable[str] = (),
+        subject: Optional[str] = None,
+    ) -> NoReturn:
+        self.recipients = tuple(sorted(set(_split_values(recipients))))
+        self.senders = tuple(sorted(set(_split_values(senders))))
+        self.subject = subject or None
+        if self.subject:
+            try:
+                re.compile(self.subject)
+            except re.error as exc:
+                raise InvalidFilterException(f'invalid subject pattern: {exc}')
+        self.key: FilterKey = (self.recipients, self.senders, self.subject)
+
+    @classmethod
+    def from_query(cls, query: Any) -> Optional['MessageFilter']:
+        message_filter = cls(
+            recipients=query.getall('to', []),
+            senders=query.getall('from', []),
+            subject=query.get('subject'),
+        )
+        if message_filter.is_empty():
+            return None
+        return message_filter
+
+    def is_empty(self) -> bool:
+        return not (self.recipients or self.senders or self.subject)
+
+    def matches_all(self) -> bool:
+        """Every message matches: criteria are not given, or one of their values matches anything (ie. "*" as
+        address, subject pattern matching empty string)."""
+        def any_address(patterns: Tuple[str, ...]) -> bool:
+            return not patterns or any('*' in pattern and set(pattern) <= {'*', '@'} for pattern in patterns)
+
+        return (any_address(self.recipients) and any_address(self.senders)
+            and (not self.subject or re.search(self.subject, '') is not None))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'to': list(self.recipients),
+            'from': list(self.senders),
+            'subject': self.subject,
+        }
+
+
+class _AddressIndex:
+    __slots__ = ('exact', 'domains', 'patterns')
+
+    def __init__(self) -> NoReturn:
+        self.exact: Dict[str, Set[FilterKey]] = {}
+        self.domains: Dict[str, Set[FilterKey]] = {}
+        self.patterns: Dict[str, Tuple[Pattern, Set[FilterKey]]] = {}
+
+    def add(self, pattern: str, key: FilterKey) -> NoReturn:
+        kind, value = classify_address_pattern(pattern)
+        if kind == 'patterns':
+            if value not in self.patterns:
+                self.patterns[value] = (re.compile(fnmatch.translate(value)), set())
+            self.patterns[value][1].add(key)
+        else:
+            getattr(self, kind).setdefault(value, set()).add(key)
+
+    def remove(self, pattern: str, key: FilterKey) -> NoReturn:
+        kind, value = classify_address_pattern(pattern)
+        if kind == 'patterns':
+            keys = self.patterns.get(value, (None, set()))[1]
+            keys.discard(key)
+            if not keys:
+                self.patterns.pop(value, None)
+        else:
+            index = getattr(self, kind)
+            index.get(value, set()).discard(key)
+            if not index.get(value, True):
+                del index[value]
+
+    def match(self, addresses: Set[str]) -> Set[FilterKey]:
+        ret = set()
+        for addr in addresses:
+            ret.update(self.exact.get(addr, ()))
+            ret.update(self.domains.get(addr.rpartition('@')[2], ()))
+        for rxp, keys in self.patterns.values():
+            if any(rxp.match(addr) for addr in addresses):
+                ret.update(keys)
+        return ret
+
+
+class FilterIndex:
+    """Precompiled index of all active filters.
+
+    Identical filters are stored once, exact addresses and domains are dict lookups, so matching a message
+    costs the same no matter how many subscribers share the filters.
+    """
+    __slots__ = ('_filters', '_refs', '_recipients', '_senders', '_subjects')
+
+    def __init__(self) -> NoReturn:
+        self._filters: Dict[FilterKey, MessageFilter] = {}
+        self._refs: Dict[FilterKey, int] = {}
+        self._recipients = _AddressIndex()
+        self._senders = _AddressIndex()
+        self._subjects: Dict[str, Tuple[Pattern, Set[FilterKey]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def add(self, message_filter: MessageFilter) -> FilterKey:
+        key = message_filter.key
+        self._refs[key] = self._refs.get(key, 0) + 1
+        if key in self._filters:
+            return key
+
+        self._filters[key] = message_filter
+        for pattern in message_filter.recipients:
+            self._recipients.add(pattern, key)
+        for pattern in message_filter.senders:
+            self._senders.add(pattern, key)
+        if message_filter.subject:
+            if message_filter.subject not in self._subjects:
+                self._subjects[message_filter.subject] = (re.compile(message_filter.subject, re.IGNORECASE), set())
+            self._subjects[message_filter.subject][1].add(key)
+        return key
+
+    def remove(self, message_filter: MessageFilter) -> NoReturn:
+        key = message_filter.key
+        if key not in self._refs:
+            return
+        self._refs[key] -= 1
+        if self._refs[key] > 0:
+            return
+
+        del self._refs[key], self._filters[key]
+        for pattern in message_filter.recipients:
+            self._recipients.remove(pattern, key)
+        for pattern in message_filter.senders:
+            self._senders.remove(pattern, key)
+        if message_filter.subject:
+            keys = self._subjects[message_filter.subject][1]
+            keys.discard(key)
+            if not keys:
+                del self._subjects[message_filter.subject]
+
+    def match(self, message: Dict[str, Any]) -> Set[FilterKey]:
+        """Return keys of all filters matching given message (summary row, see: Message.to_summary)."""
+        if not self._filters:
+            return set()
+
+        recipients = _extract_addresses([
+            *(message.get('recipients_envelope') or ()),
+            *(message.get('recipients_message_to') or ()),
+            *(message.get('recipients_message_cc') or ()),
+            *(message.get('recipients_message_bcc') or ()),
+        ])
+        senders = _extract_addresses([message.get('sender_envelope'), message.get('sender_message')])
+        subject = message.get('subject') or ''
+
+        matched_recipients = self._recipients.match(recipients)
+        matched_senders = self._senders.match(senders)
+        matched_subjects = set()
+        for rxp, keys in self._subjects.values():
+            if rxp.search(subject):
+                matched_subjects.update(keys)
+
+        return {
+            key for key, message_filter in self._filters.items()
+            if (not message_filter.recipients or key in matched_recipients)
+            and (not message_filter.senders or key in matched_senders)
+            and (not message_filter.subject or key in matched_subjects)
+        }
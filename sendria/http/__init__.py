@@ -1 +1,15 @@
-from .core import setup  # noqa: F401
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import aiohttp.web
+
+
+def setup() -> 'aiohttp.web.Application':
+    # http.core pulls in jinja2 and friends, notifier (imported by db) doesn't need them
+    from .core import setup as _setup
+    return _setup()
+
+
+def setup_control() -> 'aiohttp.web.Application':
+    from .core import setup_control as _setup_control
+    return _setup_control()
@@ -1,41 +1,109 @@
-__all__ = ['setup', 'configure_assets']
+__all__ = ['setup', 'setup_control', 'load_assets_manifest']
 
 import asyncio
+import codecs
+import functools
+import json
 import math
+import mimetypes
 import re
+import tempfile
+import time
 import weakref
-from typing import Union, NoReturn, Optional
+from typing import Union, NoReturn, Optional, Dict, List, Tuple, Callable, TYPE_CHECKING
 
 import aiohttp.web
 import aiohttp_jinja2
-import bs4
 import jinja2
-import webassets
 import yarl
 from structlog import get_logger
 
 from . import middlewares
 from . import notifier
 from .. import __version__
+from .. import cache
+from .. import callback
 from .. import config
 from .. import db
+from .. import export
+from .. import importer
+from .. import journal
+from .. import metrics
+from .. import profiling
+from .. import tenants
+from .. import tracing
+from .. import workers
+from ..errors import InvalidFilterException, InvalidRequestException
+from ..filters import MessageFilter
+
+if TYPE_CHECKING:
+    import bs4
 
 logger = get_logger()
 RE_CID = re.compile(r'(?P<replace>cid:(?P<cid>.+))')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+# uploaded archives bigger than that are spooled to disk
+IMPORT_SPOOL_SIZE = 16 * 1024 * 1024
+# any of them (or header filter) turns DELETE /api/messages/ from "delete all" into filtered delete; until is named
+# like in export, before is its alias
+DELETE_FILTER_PARAMS = ('ids', 'since', 'until', 'before', 'to', 'from', 'subject')
+# query string params filtering by indexed headers: header.X-Test-Run-Id=abc
+HEADER_FILTER_PREFIX = 'header.'
 RE_CID_URL = re.compile(r'url\(\s*(?P<quote>["\']?)(?P<replace>cid:(?P<cid>[^\\\')]+))(?P=quote)\s*\)')
 
 WebHandlerResponse = Union[dict, list, str, int, aiohttp.web.StreamResponse, None]
+# file names of assets are fingerprinted, so they never change
+ASSETS_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# precompressed variants created by build_assets, in order of preference
+ASSETS_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+AssetsCache: Dict[Tuple[str, str], Optional[bytes]] = {}
+# routes of tenants are named like the default ones, with this prefix
+TENANT_ROUTE_PREFIX = 'tenant-'
+# counting messages scans every store (and its partitions), on scrape it's done at most that often
+DB_MESSAGES_TTL = 60.0
+# time of the last count, and the count
+MessagesCount: Optional[Tuple[float, int]] = None
+
+
+def _in_main_process(handler: Callable) -> Callable:
+    """In HTTP worker request is passed to main process, it has SMTP server, message saver and webhooks (see:
+    workers.forward)."""
+    @functools.wraps(handler)
+    async def _handler(rq: aiohttp.web.Request) -> WebHandlerResponse:
+        if workers.ControlSession is not None:
+            return await workers.forward(rq)
+        return await handler(rq)
+
+    return _handler
+
+
+def _tenant(rq: aiohttp.web.Request) -> Optional[str]:
+    """Tenant from URL of request, None for the default store."""
+    tenant = rq.match_info.get('tenant')
+    if tenant is not None and not tenants.exists(tenant):
+        raise aiohttp.web.HTTPNotFound(text='404: tenant does not exist')
+    return tenant
+
+
+def _url_for(rq: aiohttp.web.Request, name: str, **parts: str) -> yarl.URL:
+    # URL of route in the same store as request is for
+    tenant = _tenant(rq)
+    if tenant is None:
+        return rq.app.router[name].url_for(**parts)
+    return rq.app.router[TENANT_ROUTE_PREFIX + name].url_for(tenant=tenant, **parts)
 
 
 @aiohttp_jinja2.template('index.html')
 async def home(rq: aiohttp.web.Request) -> WebHandlerResponse:
     assets = rq.app['assets']
     return {
+        'messages_url': _url_for(rq, 'get-messages'),
+        'websocket_url': _url_for(rq, 'websocket'),
         'version': __version__,
         'sendria_no_quit': rq.app['SENDRIA_NO_QUIT'],
         'sendria_no_clear': rq.app['SENDRIA_NO_CLEAR'],
-        'js_all': assets['js_all'].urls(),
-        'css_all': assets['css_all'].urls(),
+        'js_all': assets['js_all'],
+        'css_all': assets['css_all'],
         'header_name': rq.app['HEADER_NAME'],
         'header_url': rq.app['HEADER_URL'],
     }
@@ -48,21 +116,70 @@ async def terminate(rq: aiohttp.web.Request) -> WebHandlerResponse:
     logger.info('Terminate request received')
     import os
     import signal
-    os.kill(os.getpid(), signal.SIGTERM)
+    from .. import workers
+    # HTTP worker stops the main process, which stops all workers
+    os.kill(workers.MAIN_PID or os.getpid(), signal.SIGTERM)
 
     return
 
 
+def _header_filters(rq: aiohttp.web.Request) -> Dict[str, List[str]]:
+    headers = {}
+    for key, value in rq.query.items():
+        if not key.startswith(HEADER_FILTER_PREFIX):
+            continue
+        name = key[len(HEADER_FILTER_PREFIX):].strip().lower()
+        if name not in db.INDEX_HEADERS:
+            raise InvalidFilterException(f'header {name} is not indexed (see: --index-header)')
+        headers.setdefault(name, []).append(value)
+    return headers
+
+
 async def delete_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
-    if rq.app['SENDRIA_NO_CLEAR']:
+    # unknown param (ie. a typo) would make it delete everything
+    unknown = sorted({key for key in rq.query if key not in DELETE_FILTER_PARAMS and not key.startswith(HEADER_FILTER_PREFIX)})
+    if unknown:
+        raise InvalidRequestException(f'unknown filters: {", ".join(unknown)}')
+    # with --no-clear only given messages can be deleted, like single ones
+    if rq.app['SENDRIA_NO_CLEAR'] and set(rq.query) != {'ids'}:
         raise aiohttp.web.HTTPForbidden()
+    if rq.query:
+        return await _delete_filtered_messages(rq)
 
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         await db.delete_messages(conn)
 
     return {}
 
 
+async def _delete_filtered_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    ids = None
+    if 'ids' in rq.query:
+        try:
+            ids = [int(v) for value in rq.query.getall('ids') for v in value.split(',') if v.strip()]
+        except ValueError:
+            raise InvalidRequestException('ids must be comma separated list of numbers')
+    if 'until' in rq.query and 'before' in rq.query:
+        raise InvalidRequestException('until and before are the same filter, give one of them')
+    try:
+        since = export.parse_time(rq.query.get('since'))
+        until = export.parse_time(rq.query.get('until', rq.query.get('before')))
+    except ValueError:
+        raise InvalidRequestException('since and until must be ISO 8601 date or date and time')
+    message_filter = MessageFilter.from_query(rq.query)
+    headers = _header_filters(rq)
+    if ids is None and since is None and until is None and not headers and (
+        message_filter is None or message_filter.matches_all()
+    ):
+        raise InvalidRequestException('filters match all messages, delete without them to delete all')
+
+    async with db.connection(_tenant(rq)) as conn:
+        deleted = await db.delete_filtered_messages(conn, ids=ids, since=since, until=until,
+            message_filter=message_filter, headers=headers)
+
+    return {'deleted': deleted}
+
+
 async def get_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
     page = rq.query.get('page', 1)
     try:
@@ -73,11 +190,20 @@ async def get_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
     if page < 1:
         page = 1
 
+    address_filter = MessageFilter(recipients=rq.query.getall('to', []), senders=rq.query.getall('from', []))
+    domains = [v.strip().lower().lstrip('*@') for value in rq.query.getall('domain', []) for v in value.split(',') if v.strip()]
+    filters = {
+        'recipients': address_filter.recipients,
+        'senders': address_filter.senders,
+        'domains': domains,
+        'headers': _header_filters(rq),
+    }
+
     limit = 100
     offset = (page * limit) - limit
-    async with db.connection() as conn:
-        messages = await db.get_messages(conn, offset=offset, limit=limit)
-        total = await db.get_messages_count(conn)
+    async with db.connection(_tenant(rq)) as conn:
+        messages = await db.get_messages(conn, offset=offset, limit=limit, **filters)
+        total = await db.get_messages_count(conn, **filters)
 
     return {
         'code': 'OK',
@@ -88,10 +214,50 @@ async def get_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
     }
 
 
+async def export_messages(rq: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+    fmt = rq.query.get('format', 'mbox')
+    if fmt not in export.EXPORT_FORMATS:
+        raise InvalidRequestException(f'format must be one of: {", ".join(export.EXPORT_FORMATS)}')
+    try:
+        since = export.parse_time(rq.query.get('since'))
+        until = export.parse_time(rq.query.get('until'))
+    except ValueError:
+        raise InvalidRequestException('since and until must be ISO 8601 date or date and time')
+    message_filter = MessageFilter.from_query(rq.query)
+
+    response = aiohttp.web.StreamResponse(headers={
+        'Content-Type': export.CONTENT_TYPES[fmt],
+        'Content-Disposition': f'attachment; filename="{export.export_filename(fmt)}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(rq)
+    async with db.connection(_tenant(rq)) as conn:
+        async for chunk in export.export_messages(conn, fmt, since, until, message_filter):
+            await response.write(chunk)
+    await response.write_eof()
+
+    return response
+
+
+@_in_main_process
+async def import_messages(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    notify = rq.query.get('notify', '1').lower() not in FALSE_VALUES
+    webhooks = rq.query.get('webhooks', '1').lower() not in FALSE_VALUES
+
+    with tempfile.SpooledTemporaryFile(IMPORT_SPOOL_SIZE) as fh:
+        async for chunk in rq.content.iter_chunked(64 * 1024):
+            fh.write(chunk)
+        fh.seek(0)
+        stats = await importer.import_messages(importer.iter_file(fh), notify=notify, webhooks=webhooks,
+            tenant=_tenant(rq))
+
+    return stats
+
+
 async def delete_message(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
-        message = await db.get_message(conn, message_id)
+    async with db.connection(_tenant(rq)) as conn:
+        message = await db.get_message(conn, message_id, source=False)
         if not message:
             raise aiohttp.web.HTTPNotFound(text='404: message does not exist')
         await db.delete_message(conn, message_id)
@@ -100,7 +266,7 @@ async def delete_message(rq: aiohttp.web.Request) -> WebHandlerResponse:
 
 
 async def _part_url(rq: aiohttp.web.Request, part: dict) -> yarl.URL:
-    return rq.app.router['get-message-part'].url_for(message_id=str(part['message_id']), cid=part['cid'])
+    return _url_for(rq, 'get-message-part', message_id=str(part['message_id']), cid=part['cid'])
 
 
 async def _part_response(rq: aiohttp.web.Request, part: dict, body: Optional[Union[str, bytes]] = None,
@@ -108,48 +274,59 @@ async def _part_response(rq: aiohttp.web.Request, part: dict, body: Optional[Uni
 ) -> WebHandlerResponse:
     charset = charset or part['charset'] or 'utf-8'
     if body is None:
-        body = part['body']
-    if charset != 'utf-8':
-        body = body.decode(charset).encode('utf-8')
-    if isinstance(body, str):
-        body = body.encode()
+        # parts stored as ranges of source are decoded chunk by chunk
+        chunks = db.iter_part_body(part)
+    else:
+        chunks = [body.encode() if isinstance(body, str) else body]
+    decoder = codecs.getincrementaldecoder(charset)() if charset != 'utf-8' else None
 
     response = aiohttp.web.StreamResponse()
     response.content_type = part['type']
     await response.prepare(rq)
-    await response.write(body)
+    for chunk in chunks:
+        if decoder:
+            chunk = decoder.decode(chunk).encode('utf-8')
+        await response.write(chunk)
+    if decoder:
+        await response.write(decoder.decode(b'', final=True).encode('utf-8'))
     await response.write_eof()
     return response
 
 
 async def get_message_info(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
-        message = await db.get_message(conn, message_id)
+    async with db.connection(_tenant(rq)) as conn:
+        message = await db.get_message(conn, message_id, source=False)
         if not message:
             raise aiohttp.web.HTTPNotFound(text='404: message does not exist')
-        message['href'] = rq.app.router['get-message-eml'].url_for(message_id=message_id)
-        message['formats'] = {'source': rq.app.router['get-message-source'].url_for(message_id=message_id)}
+        message['href'] = _url_for(rq, 'get-message-eml', message_id=message_id)
+        message['formats'] = {'source': _url_for(rq, 'get-message-source', message_id=message_id)}
         if await db.message_has_plain(conn, message_id):
-            message['formats']['plain'] = rq.app.router['get-message-plain'].url_for(message_id=message_id)
+            message['formats']['plain'] = _url_for(rq, 'get-message-plain', message_id=message_id)
         if await db.message_has_html(conn, message_id):
-            message['formats']['html'] = rq.app.router['get-message-html'].url_for(message_id=message_id)
+            message['formats']['html'] = _url_for(rq, 'get-message-html', message_id=message_id)
         message['attachments'] = [dict(part, href=await _part_url(rq, part)) for part in await db.get_message_attachments(conn, message_id)]
+    # stages not saved yet
+    trace = tracing.get(message_id, _tenant(rq))
+    if trace:
+        message['timings'] = trace.to_dict()
     return message or {}
 
 
 async def get_message_plain(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         part = await db.get_message_part_plain(conn, message_id)
     if not part:
         raise aiohttp.web.HTTPNotFound(text='404: part does not exist')
     return await _part_response(rq, part) or {}
 
 
-async def _fix_cid_links(rq: aiohttp.web.Request, soup: bs4.BeautifulSoup, message_id: Union[str, bytes]) -> NoReturn:
+async def _fix_cid_links(rq: aiohttp.web.Request, soup: 'bs4.BeautifulSoup', message_id: Union[str, bytes]) -> NoReturn:
+    import bs4
+
     def _url_from_cid_match(m: re.Match) -> str:
-        url = rq.app.router['get-message-part'].url_for(message_id=str(message_id), cid=m.group('cid'))
+        url = _url_for(rq, 'get-message-part', message_id=str(message_id), cid=m.group('cid'))
         return m.group().replace(m.group('replace'), str(url))
 
     # Iterate over all attributes that do not contain CSS and replace cid references
@@ -168,7 +345,9 @@ async def _fix_cid_links(rq: aiohttp.web.Request, soup: bs4.BeautifulSoup, messa
         tag.string = RE_CID_URL.sub(_url_from_cid_match, tag.string)
 
 
-def _links_target_blank(soup: bs4.BeautifulSoup) -> NoReturn:
+def _links_target_blank(soup: 'bs4.BeautifulSoup') -> NoReturn:
+    import bs4
+
     for tag in soup.descendants:
         if isinstance(tag, bs4.Tag) and tag.name == 'a':
             tag.attrs['target'] = 'blank'
@@ -176,12 +355,13 @@ def _links_target_blank(soup: bs4.BeautifulSoup) -> NoReturn:
 
 async def get_message_html(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         part = await db.get_message_part_html(conn, message_id)
     if not part:
         raise aiohttp.web.HTTPNotFound(text='404: part does not exist')
     charset = part['charset'] or 'utf-8'
-    soup = bs4.BeautifulSoup(part['body'].decode(charset, 'ignore'), 'html5lib')
+    import bs4
+    soup = bs4.BeautifulSoup(b''.join(db.iter_part_body(part)).decode(charset, 'ignore'), 'html5lib')
     await _fix_cid_links(rq, soup, message_id)
     _links_target_blank(soup)
     return await _part_response(rq, part, str(soup), 'utf-8') or {}
@@ -189,7 +369,7 @@ async def get_message_html(rq: aiohttp.web.Request) -> WebHandlerResponse:
 
 async def get_message_source(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         message = await db.get_message(conn, message_id)
     if not message:
         raise aiohttp.web.HTTPNotFound(text='404: message does not exist')
@@ -205,7 +385,7 @@ async def get_message_source(rq: aiohttp.web.Request) -> WebHandlerResponse:
 
 async def get_message_eml(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         message = await db.get_message(conn, message_id)
     if not message:
         raise aiohttp.web.HTTPNotFound(text='404: message does not exist')
@@ -222,27 +402,75 @@ async def get_message_eml(rq: aiohttp.web.Request) -> WebHandlerResponse:
 async def get_message_part(rq: aiohttp.web.Request) -> WebHandlerResponse:
     message_id = rq.match_info.get('message_id')
     cid = rq.match_info.get('cid')
-    async with db.connection() as conn:
+    async with db.connection(_tenant(rq)) as conn:
         part = await db.get_message_part_cid(conn, message_id, cid)
     if not part:
         raise aiohttp.web.HTTPNotFound(text='404: part does not exist')
     return await _part_response(rq, part) or {}
 
 
+def _read_asset(filename: str, suffix: str) -> Optional[bytes]:
+    key = (filename, suffix)
+    if key not in AssetsCache:
+        try:
+            AssetsCache[key] = (config.ASSETS_DIR / (filename + suffix)).read_bytes()
+        except FileNotFoundError:
+            AssetsCache[key] = None
+    return AssetsCache[key]
+
+
+async def get_asset(rq: aiohttp.web.Request) -> aiohttp.web.Response:
+    filename = rq.match_info['filename']
+    # only bundles from manifest, anything else in assets dir may be stale
+    if filename not in rq.app['assets_files']:
+        raise aiohttp.web.HTTPNotFound()
+
+    accepted = {item.split(';', 1)[0].strip() for item in rq.headers.get('Accept-Encoding', '').lower().split(',')}
+    body, encoding = None, None
+    for name, suffix in ASSETS_ENCODINGS:
+        if name in accepted:
+            body = _read_asset(filename, suffix)
+            if body is not None:
+                encoding = name
+                break
+    if body is None:
+        body = _read_asset(filename, '')
+        if body is None:
+            raise aiohttp.web.HTTPNotFound()
+
+    rsp = aiohttp.web.Response(body=body, content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    rsp.headers['Cache-Control'] = ASSETS_CACHE_CONTROL
+    rsp.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        rsp.headers['Content-Encoding'] = encoding
+    return rsp
+
+
 async def websocket_handler(rq: aiohttp.web.Request) -> aiohttp.web.WebSocketResponse:
+    protocol = rq.query.get('protocol', notifier.DEFAULT_PROTOCOL_VERSION)
+    try:
+        protocol = int(protocol)
+    except ValueError:
+        protocol = None
+    if protocol not in notifier.PROTOCOL_VERSIONS:
+        raise InvalidRequestException('unsupported protocol version')
+    message_filter = MessageFilter.from_query(rq.query)
+    tenant = _tenant(rq)
+
     ws = aiohttp.web.WebSocketResponse()
     await ws.prepare(rq)
 
     if rq.app['debug']:
-        logger.debug('websocket connection opened', peer=rq.remote)
+        logger.debug('websocket connection opened', peer=rq.remote, protocol=protocol, tenant=tenant,
+            filter=message_filter.to_dict() if message_filter else None)
 
-    rq.app['websockets'].add(ws)
+    notifier.register(ws, rq.remote, protocol, message_filter, tenant)
     try:
         async for ws_message in ws:
             if ws_message.type == aiohttp.WSMsgType.ERROR:
                 logger.warning('ws connection closed with error', exception=ws.exception(), peer=rq.remote)
     finally:
-        rq.app['websockets'].discard(ws)
+        notifier.unregister(ws)
 
     if rq.app['debug']:
         logger.debug('websocket connection closed', peer=rq.remote)
@@ -250,33 +478,140 @@ async def websocket_handler(rq: aiohttp.web.Request) -> aiohttp.web.WebSocketRes
     return ws
 
 
-def configure_assets(debug: bool, autobuild: bool) -> webassets.Environment:
-    js = webassets.Bundle('js/lib/jquery.js', 'js/lib/jquery-ui.js', 'js/lib/jquery.hotkeys.js',
-        'js/lib/handlebars.js', 'js/lib/moment.js', 'js/lib/jstorage.js',
-        'js/util.js', 'js/message.js', 'js/sendria.js',
-        filters='rjsmin', output='assets/bundle.%(version)s.js')
-    scss = webassets.Bundle('css/sendria.scss',
-        filters='pyscss', output='assets/sendria.%(version)s.css')
-    css = webassets.Bundle('css/reset.css', 'css/jquery-ui.css', scss,
-        filters=('cssrewrite', 'cssmin'), output='assets/bundle.%(version)s.css')
+async def events_handler(rq: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+    message_filter = MessageFilter.from_query(rq.query)
+    tenant = _tenant(rq)
 
-    assets = webassets.Environment(directory=config.STATIC_DIR, url=config.STATIC_URL)
-    assets.debug = debug  # yuck! but the commandline script only supports *disabling* debug
-    assets.auto_build = autobuild
+    response = aiohttp.web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        # disable buffering in nginx
+        'X-Accel-Buffering': 'no',
+    })
+    await response.prepare(rq)
 
-    assets.register('js_all', js)
-    assets.register('css_all', css)
+    if rq.app['debug']:
+        logger.debug('sse connection opened', peer=rq.remote, tenant=tenant,
+            filter=message_filter.to_dict() if message_filter else None)
 
-    return assets
+    client = notifier.register_sse(response, rq.remote, message_filter, tenant)
+    try:
+        await client.wait_closed()
+    finally:
+        notifier.unregister(response)
+
+    if rq.app['debug']:
+        logger.debug('sse connection closed', peer=rq.remote)
+
+    return response
+
+
+@_in_main_process
+async def get_notifier_stats(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    return notifier.merge_stats([report['notifier'] for report in workers.reports()])
+
+
+@_in_main_process
+async def get_webhooks_stats(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    return callback.stats()
+
+
+async def get_cache_stats(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    return cache.stats()
+
+
+@_in_main_process
+async def get_metrics(rq: aiohttp.web.Request) -> aiohttp.web.Response:
+    global MessagesCount
+    # gauges are refreshed on scrape instead of on every change
+    metrics.QUEUE_DEPTH.set(db.DbMessagesQueue.qsize(), queue='db')
+    metrics.QUEUE_DEPTH.set(sum(target.queue.qsize() for target in callback.Targets.values()), queue='callback')
+    for target in callback.Targets.values():
+        metrics.WEBHOOK_QUEUE_DEPTH.set(target.queue.qsize(), target=target.name)
+    notifier.update_metrics()
+
+    if MessagesCount is None or time.monotonic() - MessagesCount[0] >= DB_MESSAGES_TTL:
+        count = 0
+        for tenant in (None, *tenants.names()):
+            async with db.connection(tenant) as conn:
+                count += await db.get_messages_count(conn)
+        MessagesCount = (time.monotonic(), count)
+    metrics.DB_MESSAGES.set(MessagesCount[1])
+    metrics.DB_SIZE_BYTES.set(db.get_db_size())
+    if journal.enabled():
+        metrics.JOURNAL_SIZE_BYTES.set(journal.size())
+
+    # with HTTP workers, their HTTP requests and notifier clients
+    body = metrics.render(report['metrics'] for report in workers.reports())
+    return aiohttp.web.Response(body=body.encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@_in_main_process
+async def get_profile(rq: aiohttp.web.Request) -> aiohttp.web.Response:
+    try:
+        seconds = float(rq.query.get('seconds', 10))
+    except ValueError:
+        raise InvalidRequestException('invalid seconds')
+    if not 0 < seconds <= profiling.PROFILE_MAX_SECONDS:
+        raise InvalidRequestException(f'seconds must be between 0 and {profiling.PROFILE_MAX_SECONDS}')
+    fmt = rq.query.get('format', profiling.PROFILE_FORMATS[0])
+    if fmt not in profiling.PROFILE_FORMATS:
+        raise InvalidRequestException(f'format must be one of: {", ".join(profiling.PROFILE_FORMATS)}')
+
+    body, filename = await profiling.profile(seconds, fmt)
+    return aiohttp.web.Response(body=body, headers={
+        'Content-Type': 'text/plain; charset=utf-8' if fmt == 'text' else 'application/octet-stream',
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    })
+
+
+async def put_worker_report(rq: aiohttp.web.Request) -> WebHandlerResponse:
+    workers.add_report(int(rq.match_info['number']), await rq.json())
+    return {}
+
+
+def load_assets_manifest() -> Dict[str, List[str]]:
+    with config.ASSETS_MANIFEST.open() as fh:
+        return json.load(fh)
+
+
+def _store_routes(auth: middlewares.BasicAuth, prefix: str, ws_path: str, name_prefix: str) -> List[aiohttp.web.RouteDef]:
+    # routes of one store: the default one, or of a tenant (with {tenant} in prefix and ws_path)
+    return [
+        aiohttp.web.delete(f'{prefix}/messages/', auth.required(delete_messages), name=f'{name_prefix}delete-messages'),
+        aiohttp.web.get(f'{prefix}/messages/', auth.required(get_messages), name=f'{name_prefix}get-messages'),
+        aiohttp.web.get(f'{prefix}/messages/export', auth.required(export_messages), name=f'{name_prefix}export-messages'),
+        aiohttp.web.post(f'{prefix}/messages/import', auth.required(import_messages), name=f'{name_prefix}upload-messages'),
+        aiohttp.web.delete(prefix + r'/messages/{message_id:\d+}', auth.required(delete_message),
+            name=f'{name_prefix}delete-message'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}.json', auth.required(get_message_info),
+            name=f'{name_prefix}get-message-info'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}.plain', auth.required(get_message_plain),
+            name=f'{name_prefix}get-message-plain'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}.html', auth.required(get_message_html),
+            name=f'{name_prefix}get-message-html'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}.source', auth.required(get_message_source),
+            name=f'{name_prefix}get-message-source'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}.eml', auth.required(get_message_eml),
+            name=f'{name_prefix}get-message-eml'),
+        aiohttp.web.get(prefix + r'/messages/{message_id:\d+}/parts/{cid}', auth.required(get_message_part),
+            name=f'{name_prefix}get-message-part'),
+        aiohttp.web.get(f'{prefix}/events', auth.required(events_handler), name=f'{name_prefix}events'),
+
+        aiohttp.web.get(ws_path, websocket_handler, name=f'{name_prefix}websocket'),
+    ]
 
 
 def setup() -> aiohttp.web.Application:
     app = aiohttp.web.Application(debug=config.CONFIG.debug)
     app.middlewares.extend([
+        middlewares.request_metrics,
         middlewares.set_default_headers,
         middlewares.error_handler,
         middlewares.response_from_dict,
     ])
+    if config.CONFIG.slow_request_threshold is not None:
+        app.middlewares.insert(1, middlewares.slow_request_log(config.CONFIG.slow_request_threshold / 1000))
 
     app['SENDRIA_NO_QUIT'] = config.CONFIG.no_quit
     app['SENDRIA_NO_CLEAR'] = config.CONFIG.no_clear
@@ -285,8 +620,12 @@ def setup() -> aiohttp.web.Application:
     app['debug'] = config.CONFIG.debug
     app['websockets'] = weakref.WeakSet()
 
-    assets = configure_assets(config.CONFIG.debug, config.CONFIG.autobuild_assets)
-    app['assets'] = assets
+    manifest = load_assets_manifest()
+    app['assets'] = {
+        name: [f'{config.STATIC_URL}assets/{filename}' for filename in filenames]
+        for name, filenames in manifest.items()
+    }
+    app['assets_files'] = {filename for filenames in manifest.values() for filename in filenames}
 
     # aiohttp_jinja requirement
     app['static_root_url'] = config.STATIC_URL
@@ -296,25 +635,56 @@ def setup() -> aiohttp.web.Application:
     app.add_routes([
         aiohttp.web.get('/', home, name='home'),
         aiohttp.web.delete('/api', auth.required(terminate), name='terminate'),
-        aiohttp.web.delete('/api/messages/', auth.required(delete_messages), name='delete-messages'),
-        aiohttp.web.get('/api/messages/', auth.required(get_messages), name='get-messages'),
-        aiohttp.web.delete(r'/api/messages/{message_id:\d+}', auth.required(delete_message), name='delete-message'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}.json', auth.required(get_message_info), name='get-message-info'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}.plain', auth.required(get_message_plain), name='get-message-plain'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}.html', auth.required(get_message_html), name='get-message-html'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}.source', auth.required(get_message_source), name='get-message-source'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}.eml', auth.required(get_message_eml), name='get-message-eml'),
-        aiohttp.web.get(r'/api/messages/{message_id:\d+}/parts/{cid}', auth.required(get_message_part), name='get-message-part'),
-
-        aiohttp.web.get(r'/ws', websocket_handler),
+        aiohttp.web.get('/api/stats/notifier', auth.required(get_notifier_stats), name='get-notifier-stats'),
+        aiohttp.web.get('/api/stats/webhooks', auth.required(get_webhooks_stats), name='get-webhooks-stats'),
+        aiohttp.web.get('/api/stats/cache', auth.required(get_cache_stats), name='get-cache-stats'),
+        aiohttp.web.get('/metrics', auth.required(get_metrics), name='metrics'),
+        *_store_routes(auth, '/api', '/ws', ''),
     ])
+    if tenants.enabled():
+        tenant = '{tenant:' + tenants.RE_TENANT_NAME.pattern.strip('^$') + '}'
+        app.add_routes([
+            aiohttp.web.get(f'/t/{tenant}/', home, name=f'{TENANT_ROUTE_PREFIX}home'),
+            *_store_routes(auth, f'/api/t/{tenant}', f'/ws/t/{tenant}', TENANT_ROUTE_PREFIX),
+        ])
+    if config.CONFIG.profiling:
+        app.router.add_get('/api/debug/profile', auth.required(get_profile), name='debug-profile')
+    app.router.add_get('/static/assets/{filename}', get_asset, name='asset')
     app.router.add_static('/static/', path=config.STATIC_DIR, name='static')
 
     # initialize and run websocket notifier
-    notifier.setup(websockets=app['websockets'], debug_mode=app['debug'])
+    notifier.setup(
+        websockets=app['websockets'],
+        debug_mode=app['debug'],
+        client_buffer_size=config.CONFIG.websocket_buffer_size,
+        coalesce_time=config.CONFIG.websocket_coalesce_time / 1000,
+    )
     loop = asyncio.get_event_loop()
     loop.create_task(notifier.ping())
     loop.create_task(notifier.send_messages())
     logger.info('notifier initialized')
 
     return app
+
+
+def setup_control() -> aiohttp.web.Application:
+    """HTTP server of main process for HTTP workers (see: workers.CONTROL_SOCKET), on socket in private directory: requests passed
+    by workers are authorized by them already."""
+    app = aiohttp.web.Application(client_max_size=0)
+    app.middlewares.extend([
+        middlewares.error_handler,
+        middlewares.response_from_dict,
+    ])
+    app.add_routes([
+        aiohttp.web.put(r'/workers/{number:\d+}', put_worker_report, name='put-worker-report'),
+        aiohttp.web.get('/api/stats/notifier', get_notifier_stats, name='get-notifier-stats'),
+        aiohttp.web.get('/api/stats/webhooks', get_webhooks_stats, name='get-webhooks-stats'),
+        aiohttp.web.get('/metrics', get_metrics, name='metrics'),
+        aiohttp.web.post('/api/messages/import', import_messages, name='upload-messages'),
+    ])
+    if tenants.enabled():
+        tenant = '{tenant:' + tenants.RE_TENANT_NAME.pattern.strip('^$') + '}'
+        app.router.add_post(f'/api/t/{tenant}/messages/import', import_messages, name=f'{TENANT_ROUTE_PREFIX}upload-messages')
+    if config.CONFIG.profiling:
+        app.router.add_get('/api/debug/profile', get_profile, name='debug-profile')
+    return app
@@ -1,18 +1,76 @@
 __all__ = []
 
+import time
 import traceback
-from typing import Callable, NoReturn
+from typing import Callable, NoReturn, TYPE_CHECKING
 
 import aiohttp.web
 from aiohttp_basicauth import BasicAuthMiddleware
-from passlib.apache import HtpasswdFile
 from structlog import get_logger
 
 from .json_encoder import json_response
 from .. import __version__
 from .. import errors
+from .. import metrics
+
+if TYPE_CHECKING:
+    from passlib.apache import HtpasswdFile
 
 logger = get_logger()
+# long living connections, their duration says nothing about latency; with routes of tenants (see:
+# core.TENANT_ROUTE_PREFIX)
+STREAMING_ROUTES = ('websocket', 'events', 'tenant-websocket', 'tenant-events')
+
+
+def _route_name(rq: aiohttp.web.Request) -> str:
+    route = rq.match_info.route
+    name = route.name
+    if not name and route.resource is not None:
+        name = route.resource.name
+    if not name:
+        return 'unmatched' if route.resource is None else 'unnamed'
+    return name
+
+
+@aiohttp.web.middleware
+async def request_metrics(rq: aiohttp.web.Request, handler: Callable) -> aiohttp.web.StreamResponse:
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        rsp = await handler(rq)
+        status = rsp.status
+        return rsp
+    except aiohttp.web.HTTPException as exp:
+        status = exp.status
+        raise
+    finally:
+        route = _route_name(rq)
+        if route not in STREAMING_ROUTES:
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started_at, route=route, method=rq.method)
+        metrics.HTTP_REQUESTS.inc(route=route, method=rq.method, status=status)
+
+
+def slow_request_log(threshold: float) -> Callable:
+    """Log requests handled longer than threshold (in seconds)."""
+    @aiohttp.web.middleware
+    async def _slow_request_log(rq: aiohttp.web.Request, handler: Callable) -> aiohttp.web.StreamResponse:
+        started_at = time.perf_counter()
+        status = 500
+        try:
+            rsp = await handler(rq)
+            status = rsp.status
+            return rsp
+        except aiohttp.web.HTTPException as exp:
+            status = exp.status
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            route = _route_name(rq)
+            if duration >= threshold and route not in STREAMING_ROUTES:
+                logger.warning('slow request', method=rq.method, uri=rq.rel_url.human_repr(), route=route,
+                    status=status, duration=round(duration * 1000, 3))
+
+    return _slow_request_log
 
 
 @aiohttp.web.middleware
@@ -67,7 +125,7 @@ async def set_default_headers(rq: aiohttp.web.Request, handler: Callable) -> aio
 
 
 class BasicAuth(BasicAuthMiddleware):
-    def __init__(self, http_auth: HtpasswdFile, *args, **kwargs) -> NoReturn:
+    def __init__(self, http_auth: 'HtpasswdFile', *args, **kwargs) -> NoReturn:
         self._http_auth = http_auth
         kwargs['realm'] = 'Sendria'
         kwargs['force'] = False
@@ -1,51 +1,446 @@
+__all__ = ['setup', 'register', 'register_sse', 'unregister', 'broadcast', 'deliver', 'ping', 'send_messages', 'stats',
+    'merge_stats', 'update_metrics']
+
 import asyncio
+import collections
+import json
+import time
 import weakref
-from typing import Optional, NoReturn
+from typing import Optional, NoReturn, List, Tuple, Dict, Any, Union, Callable
 
 import aiohttp.web
 from structlog import get_logger
 
+from .json_encoder import JSONEncoder
+from .. import __version__
+from .. import metrics
+from .. import tracing
+from ..filters import MessageFilter, FilterIndex
+
 logger = get_logger()
 DEBUG: bool = False
 WSHandlers: Optional[weakref.WeakSet] = None
 WebsocketMessagesQueue: Optional[asyncio.Queue] = None
+Clients: Dict[Union[aiohttp.web.WebSocketResponse, aiohttp.web.StreamResponse], 'Client'] = {}
+Filters = FilterIndex()
+# with HTTP workers events are sent through it to all of them (see: workers), instead of to clients of this process
+Publisher: Optional[Callable[[str, tuple, Any, Optional[str]], NoReturn]] = None
+CLIENT_BUFFER_SIZE: int = 100
+COALESCE_TIME: float = 0.05
+SEND_TIMEOUT: float = 10.0
+PING_INTERVAL: float = 30.0
+# events which can be merged into one frame: {"event": "add_message", "data": [...]}; in protocol 1 split into one
+# frame per id
+COALESCABLE_EVENTS = ('add_message', 'delete_message')
+# events which are delivered to filtered subscribers only if the message matches their filter
+FILTERED_EVENTS = ('add_message',)
+# 1: plain text frames: "event,id,id,..."
+# 2: JSON frames: {"event": ..., "data": ...}, add_message carries summary rows of messages
+PROTOCOL_VERSIONS = (1, 2)
+DEFAULT_PROTOCOL_VERSION = 1
+FRAME_FORMAT_TEXT = 'text'
+FRAME_FORMAT_JSON = 'json'
+FRAME_FORMAT_SSE = 'sse'
+
+
+class Client:
+    __slots__ = (
+        'response', 'peer', 'tenant', 'filter', 'queue', 'queued_at', 'task', 'closed', 'connected_at',
+        'frames_sent', 'frames_dropped', 'last_lag', 'max_lag',
+        '__weakref__',
+    )
+    kind = None
+    frame_format = None
+
+    def __init__(self, response: aiohttp.web.StreamResponse, peer: Optional[str],
+        message_filter: Optional[MessageFilter], buffer_size: int, tenant: Optional[str] = None,
+    ) -> NoReturn:
+        self.response = response
+        self.peer = peer
+        # only events of this tenant are sent to the client
+        self.tenant = tenant
+        self.filter = message_filter
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        # when frames waiting in the queue were put there, oldest first
+        self.queued_at: collections.deque = collections.deque()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = asyncio.Event()
+        self.connected_at = time.time()
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> NoReturn:
+        self.task = asyncio.get_event_loop().create_task(self._sender())
+
+    def stop(self) -> NoReturn:
+        if not self.task or self.task.done():
+            self.closed.set()
+        elif self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def wait_closed(self) -> NoReturn:
+        await self.closed.wait()
+
+    def put(self, frame: Union[str, Tuple[str, ...]]) -> bool:
+        # tuple: frames sent one by one, but buffered as one (see: _text_frames)
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.frames_dropped += 1
+            return False
+        self.queued_at.append(time.monotonic())
+        return True
+
+    def lag(self) -> float:
+        # age of the oldest frame still waiting in the buffer
+        if not self.queued_at:
+            return 0.0
+        return time.monotonic() - self.queued_at[0]
+
+    async def send(self, frame: str) -> NoReturn:
+        raise NotImplementedError()
+
+    async def ping(self) -> NoReturn:
+        raise NotImplementedError()
+
+    async def close(self, reason: str) -> NoReturn:
+        raise NotImplementedError()
+
+    async def _sender(self) -> NoReturn:
+        try:
+            while True:
+                frame = await self.queue.get()
+                queued_at = self.queued_at.popleft()
+                frames = (frame,) if isinstance(frame, str) else frame
+                try:
+                    for frame in frames:
+                        await asyncio.wait_for(self.send(frame), SEND_TIMEOUT)
+                except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+                    logger.warning(f'{self.kind} send failed, dropping client', peer=self.peer)
+                    await _drop(self, 'send failed')
+                    return
+                finally:
+                    self.queue.task_done()
+
+                self.frames_sent += len(frames)
+                self.last_lag = time.monotonic() - queued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+        finally:
+            self.closed.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'kind': self.kind,
+            'peer': self.peer,
+            'tenant': self.tenant,
+            'format': self.frame_format,
+            'filter': self.filter.to_dict() if self.filter else None,
+            'connected_at': self.connected_at,
+            'buffered': self.queue.qsize(),
+            'buffer_size': self.queue.maxsize,
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'lag': self.lag(),
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
+
+
+class WebSocketClient(Client):
+    __slots__ = ('protocol',)
+    kind = 'websocket'
+
+    def __init__(self, *args, protocol: int = DEFAULT_PROTOCOL_VERSION, **kwargs) -> NoReturn:
+        self.protocol = protocol
+        super().__init__(*args, **kwargs)
+
+    @property
+    def frame_format(self) -> str:
+        return FRAME_FORMAT_TEXT if self.protocol == 1 else FRAME_FORMAT_JSON
+
+    async def send(self, frame: str) -> NoReturn:
+        await self.response.send_str(frame)
+
+    async def ping(self) -> NoReturn:
+        await self.response.ping()
+
+    async def close(self, reason: str) -> NoReturn:
+        if not self.response.closed:
+            await self.response.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=reason.encode())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(super().to_dict(), protocol=self.protocol)
+
+
+class SSEClient(Client):
+    __slots__ = ()
+    kind = 'sse'
+    frame_format = FRAME_FORMAT_SSE
+
+    async def send(self, frame: str) -> NoReturn:
+        await self.response.write(frame.encode())
+
+    async def ping(self) -> NoReturn:
+        # SSE comment line, ignored by clients but keeps proxies from closing idle connection
+        if not self.put(': ping\n\n'):
+            raise ConnectionError('buffer full')
+
+    async def close(self, reason: str) -> NoReturn:
+        pass
 
 
 def setup(*,
     websockets: weakref.WeakSet,
     debug_mode: bool,
+    client_buffer_size: Optional[int] = None,
+    coalesce_time: Optional[float] = None,
 ) -> NoReturn:
-    global WSHandlers, WebsocketMessagesQueue, DEBUG
+    global WSHandlers, WebsocketMessagesQueue, DEBUG, CLIENT_BUFFER_SIZE, COALESCE_TIME
 
     DEBUG = debug_mode
     WSHandlers = websockets
     WebsocketMessagesQueue = asyncio.Queue()
 
+    if client_buffer_size:
+        CLIENT_BUFFER_SIZE = client_buffer_size
+    if coalesce_time is not None:
+        COALESCE_TIME = coalesce_time
+
+
+def _register(client: Client) -> Client:
+    Clients[client.response] = client
+    if client.filter:
+        Filters.add(client.filter)
+    client.start()
+    return client
+
+
+def register(ws: aiohttp.web.WebSocketResponse, peer: Optional[str] = None,
+    protocol: int = DEFAULT_PROTOCOL_VERSION, message_filter: Optional[MessageFilter] = None,
+    tenant: Optional[str] = None,
+) -> Client:
+    client = WebSocketClient(ws, peer, message_filter, CLIENT_BUFFER_SIZE, tenant, protocol=protocol)
+    WSHandlers.add(ws)
+    _register(client)
+    if protocol >= 2:
+        client.put(_dumps({'event': 'hello', 'data': {'protocol': protocol, 'version': __version__}}))
+    return client
+
+
+def register_sse(response: aiohttp.web.StreamResponse, peer: Optional[str] = None,
+    message_filter: Optional[MessageFilter] = None, tenant: Optional[str] = None,
+) -> Client:
+    client = SSEClient(response, peer, message_filter, CLIENT_BUFFER_SIZE, tenant)
+    _register(client)
+    client.put(_sse_frame('hello', {'version': __version__}))
+    return client
+
+
+def unregister(response: Union[aiohttp.web.WebSocketResponse, aiohttp.web.StreamResponse]) -> NoReturn:
+    WSHandlers.discard(response)
+    client = Clients.pop(response, None)
+    if client:
+        if client.filter:
+            Filters.remove(client.filter)
+        client.stop()
+
+
+async def _drop(client: Client, reason: str) -> NoReturn:
+    metrics.NOTIFIER_DROPPED_CLIENTS.inc(reason=reason)
+    unregister(client.response)
+    try:
+        await client.close(reason)
+    except Exception:  # noqa: S110
+        pass
+
+
+async def _ping_client(client: Client) -> NoReturn:
+    try:
+        await asyncio.wait_for(client.ping(), SEND_TIMEOUT)
+    except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+        logger.warning(f'{client.kind} ping failed, dropping client', peer=client.peer)
+        await _drop(client, 'ping failed')
+
 
 async def ping() -> NoReturn:
     while True:
-        ws: aiohttp.web.WebSocketResponse
-        for ws in WSHandlers:
-            await ws.ping()
-        await asyncio.sleep(30)
+        await asyncio.gather(*(_ping_client(client) for client in list(Clients.values())), return_exceptions=True)
+        await asyncio.sleep(PING_INTERVAL)
+
+
+async def broadcast(event: str, *args, data: Optional[Any] = None, tenant: Optional[str] = None) -> NoReturn:
+    """Send event to clients of given tenant (None: of the default store)."""
+    if Publisher is not None:
+        Publisher(event, args, data, tenant)
+    else:
+        deliver(event, *args, data=data, tenant=tenant)
+
+
+def deliver(event: str, *args, data: Optional[Any] = None, tenant: Optional[str] = None) -> NoReturn:
+    # to clients connected to this process
+    WebsocketMessagesQueue.put_nowait((time.monotonic(), tenant, (event, args, data)))
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, cls=JSONEncoder)
+
+
+def _sse_frame(event: str, data: Any) -> str:
+    return f'event: {event}\ndata: {_dumps(data)}\n\n'
+
 
+def _coalesce(events: List[Tuple]) -> List[Tuple[str, List, List]]:
+    groups: List[Tuple[str, List, List]] = []
+    for name, args, data in events:
+        if groups and groups[-1][0] == name and (name in COALESCABLE_EVENTS or not args):
+            groups[-1][1].extend(args)
+        else:
+            groups.append((name, list(args), []))
+        if data is not None:
+            groups[-1][2].append(data)
+    return groups
 
-async def broadcast(*args) -> NoReturn:
-    WebsocketMessagesQueue.put_nowait(args)
+
+def _text_frames(events: List[Tuple]) -> Tuple[str, ...]:
+    # protocol 1 is not coalesced, clients read one id from a frame: "add_message,1", "add_message,2"; all frames of
+    # one batch are buffered as one, so a burst doesn't overflow the buffer
+    frames = []
+    for name, args, _ in events:
+        if name in COALESCABLE_EVENTS:
+            frames.extend(f'{name},{arg}' for arg in args)
+        else:
+            frames.append(','.join(map(str, [name, *args])))
+    return tuple(frames)
+
+
+def _render_frames(groups: List[Tuple[str, List, List]], frame_format: str) -> List[str]:
+    frames = []
+    for name, args, data in groups:
+        if data:
+            payload = data
+        elif name in COALESCABLE_EVENTS:
+            payload = args
+        else:
+            payload = args or None
+        if frame_format == FRAME_FORMAT_SSE:
+            frames.append(_sse_frame(name, payload))
+        else:
+            frames.append(_dumps({'event': name, 'data': payload}))
+    return frames
+
+
+async def _collect_events() -> Dict[Optional[str], List[Tuple]]:
+    items = [await WebsocketMessagesQueue.get()]
+    if COALESCE_TIME > 0:
+        deadline = time.monotonic() + COALESCE_TIME
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(WebsocketMessagesQueue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    while not WebsocketMessagesQueue.empty():
+        items.append(WebsocketMessagesQueue.get_nowait())
+
+    now = time.monotonic()
+    ret = {}
+    for queued_at, tenant, event in items:
+        metrics.QUEUE_WAIT_SECONDS.observe(now - queued_at, queue='websocket')
+        ret.setdefault(tenant, []).append(event)
+    return ret
+
+
+def _match_events(events: List[Tuple]) -> List[Optional[set]]:
+    # every message is matched once against the whole filter index, not once per subscriber
+    if not len(Filters):
+        return [None] * len(events)
+    return [
+        Filters.match(data) if name in FILTERED_EVENTS and data is not None else None
+        for name, _, data in events
+    ]
+
+
+def _select_events(events: List[Tuple], matches: List[Optional[set]],
+    message_filter: Optional[MessageFilter],
+) -> List[Tuple]:
+    if not message_filter:
+        return events
+    return [
+        event for event, matched in zip(events, matches)
+        if event[0] not in FILTERED_EVENTS or (matched is not None and message_filter.key in matched)
+    ]
 
 
 async def send_messages() -> NoReturn:
     while True:
-        msg = await WebsocketMessagesQueue.get()
-        msg = ','.join(map(str, msg))
+        tenant_events = await _collect_events()
+        tenant_matches = {tenant: _match_events(events) for tenant, events in tenant_events.items()}
 
-        cnt = 0
-        ws: aiohttp.web.WebSocketResponse
-        for ws in set(WSHandlers):
-            await ws.send_str(msg)
-            cnt += 1
+        clients = list(Clients.values())
+        frames: Dict[Tuple, List[Union[str, Tuple[str, ...]]]] = {}
+        for client in clients:
+            if client.tenant not in tenant_events:
+                continue
+            cache_key = (client.tenant, client.frame_format, client.filter.key if client.filter else None)
+            if cache_key not in frames:
+                selected = _select_events(tenant_events[client.tenant], tenant_matches[client.tenant], client.filter)
+                if client.frame_format == FRAME_FORMAT_TEXT:
+                    frames[cache_key] = [_text_frames(selected)] if selected else []
+                else:
+                    frames[cache_key] = _render_frames(_coalesce(selected), client.frame_format)
+            for frame in frames[cache_key]:
+                if not client.put(frame):
+                    logger.warning(f'{client.kind} client too slow, dropping', peer=client.peer,
+                        buffered=client.queue.qsize())
+                    asyncio.get_event_loop().create_task(_drop(client, 'client too slow'))
+                    break
 
-        WebsocketMessagesQueue.task_done()
+        events = []
+        for tenant in tenant_events:
+            for name, args, _ in tenant_events[tenant]:
+                if name == 'add_message':
+                    for message_id in args:
+                        tracing.mark(message_id, 'broadcast', tenant)
+                WebsocketMessagesQueue.task_done()
+            events.extend(tenant_events[tenant])
 
         if DEBUG:
-            logger.debug('websocket messages sent', message=msg, receivers_cnt=cnt)
+            logger.debug('websocket messages sent', events_cnt=len(events),
+                frames=[event[0] for event in events], receivers_cnt=len(clients))
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        'queued': WebsocketMessagesQueue.qsize() if WebsocketMessagesQueue else 0,
+        'client_buffer_size': CLIENT_BUFFER_SIZE,
+        'coalesce_time': COALESCE_TIME,
+        'protocol_versions': PROTOCOL_VERSIONS,
+        'filters': len(Filters),
+        'clients': [client.to_dict() for client in Clients.values()],
+    }
+
+
+def merge_stats(others: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Stats of all HTTP workers (see: workers.reports), or of this process if there are none."""
+    if not others:
+        return stats()
+    merged = dict(others[0], clients=list(others[0]['clients']))
+    for other in others[1:]:
+        merged['queued'] += other['queued']
+        merged['filters'] += other['filters']
+        merged['clients'].extend(other['clients'])
+    return merged
+
+
+def update_metrics() -> NoReturn:
+    # gauges are refreshed on scrape instead of on every change
+    if WebsocketMessagesQueue is not None:
+        metrics.QUEUE_DEPTH.set(WebsocketMessagesQueue.qsize(), queue='websocket')
+    metrics.NOTIFIER_CLIENTS.clear()
+    for kind in ('websocket', 'sse'):
+        metrics.NOTIFIER_CLIENTS.set(sum(1 for client in Clients.values() if client.kind == kind), kind=kind)
@@ -0,0 +1,177 @@
+__all__ = ['iter_path', 'iter_file', 'parse_message', 'import_messages']
+
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import re
+import time
+import zipfile
+from contextlib import AsyncExitStack
+from email import message_from_bytes
+from email.utils import getaddresses, parseaddr
+from typing import Optional, NoReturn, Iterator, Iterable, List, Dict, BinaryIO
+
+from structlog import get_logger
+
+from . import db
+from . import tenants
+from .message import Message
+
+logger = get_logger()
+# messages parsed by one worker task, and stored in one transaction
+IMPORT_CHUNK_SIZE = 500
+IMPORT_PEER = 'import'
+RE_MBOX_QUOTED_FROM = re.compile(rb'^>+From ')
+
+
+def _iter_mbox(fh: BinaryIO) -> Iterator[bytes]:
+    lines = None
+    for line in fh:
+        if line.startswith(b'From '):
+            if lines:
+                yield _mbox_message(lines)
+            lines = []
+            continue
+        if lines is None:
+            # garbage before the first separator
+            continue
+        if line[:1] == b'>' and RE_MBOX_QUOTED_FROM.match(line):
+            # mboxrd, the same as written by export
+            line = line[1:]
+        lines.append(line)
+    if lines:
+        yield _mbox_message(lines)
+
+
+def _mbox_message(lines: List[bytes]) -> bytes:
+    # blank line before the next separator belongs to mbox, not to the message
+    if lines[-1] in (b'\n', b'\r\n'):
+        lines = lines[:-1]
+    return b''.join(lines)
+
+
+def _iter_zip(fh: BinaryIO) -> Iterator[bytes]:
+    with zipfile.ZipFile(fh) as zf:
+        # in order of writing, for zips from export it's order of arrival
+        for zinfo in zf.infolist():
+            if not zinfo.is_dir():
+                yield zf.read(zinfo)
+
+
+def iter_file(fh: BinaryIO) -> Iterator[bytes]:
+    """Raw messages from mbox, zip (ie. from export) or single message file."""
+    head = fh.read(5)
+    fh.seek(0)
+    if head.startswith(b'PK\x03\x04'):
+        yield from _iter_zip(fh)
+    elif head == b'From ':
+        yield from _iter_mbox(fh)
+    else:
+        yield fh.read()
+
+
+def iter_path(path: pathlib.Path) -> Iterator[bytes]:
+    """Raw messages from Maildir, directory of .eml files or file (see: iter_file)."""
+    if path.is_dir():
+        if (path / 'cur').is_dir() and (path / 'new').is_dir():
+            paths = [p for subdir in ('cur', 'new') for p in sorted((path / subdir).iterdir()) if p.is_file()]
+        else:
+            paths = sorted(path.rglob('*.eml'))
+        for p in paths:
+            yield p.read_bytes()
+        return
+
+    with path.open('rb') as fh:
+        yield from iter_file(fh)
+
+
+def parse_message(data: bytes) -> Message:
+    """Parse message like received over SMTP. Envelope is taken from headers added by Sendria (ie. in messages
+    exported from Sendria), otherwise from the message headers."""
+    email = message_from_bytes(data)
+    if 'X-Peer' not in email:
+        email['X-Peer'] = IMPORT_PEER
+    if 'X-MailFrom' not in email:
+        email['X-MailFrom'] = parseaddr(email.get('Return-Path') or email.get('From') or '')[1]
+    if 'X-RcptTo' not in email:
+        recipients = [*email.get_all('To', []), *email.get_all('Cc', []), *email.get_all('Bcc', [])]
+        email['X-RcptTo'] = ', '.join(addr for _, addr in getaddresses(recipients) if addr)
+    return Message.from_email(email)
+
+
+def _parse_messages(chunk: List[bytes], parts_layout: str) -> List[Optional[Message]]:
+    # runs in worker process, without setup of db module (parts_layout is given explicitly)
+    ret = []
+    for data in chunk:
+        try:
+            message = parse_message(data)
+            for part, row in zip(message.parts, db.message_part_rows(message, parts_layout)):
+                part['row'] = row
+        except Exception:
+            message = None
+        ret.append(message)
+    return ret
+
+
+def _chunks(sources: Iterable[bytes], size: int) -> Iterator[List[bytes]]:
+    chunk = []
+    for data in sources:
+        chunk.append(data)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def import_messages(sources: Iterable[bytes], notify: bool = True, webhooks: bool = True,
+    workers: Optional[int] = None, tenant: Optional[str] = None,
+) -> Dict[str, float]:
+    """Parse messages in worker processes and store them in batches, in the same order as they are given.
+
+    Messages are stored in store of given tenant, or routed to tenants like the ones received over SMTP.
+    """
+    workers = workers or os.cpu_count() or 1
+    loop = asyncio.get_event_loop()
+    stats = {'imported': 0, 'failed': 0}
+    started_at = time.monotonic()
+
+    # spawn: forking a process with running threads (aiosqlite, SMTP server) is not safe
+    executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    pending: collections.deque = collections.deque()
+    try:
+        async with AsyncExitStack() as stack:
+            connections = {}
+
+            async def store() -> NoReturn:
+                parsed = await pending.popleft()
+                groups = {}
+                for message in parsed:
+                    if message is None:
+                        stats['failed'] += 1
+                        continue
+                    groups.setdefault(tenant if tenant is not None else tenants.route(message), []).append(message)
+                for message_tenant, messages in groups.items():
+                    if message_tenant not in connections:
+                        connections[message_tenant] = await stack.enter_async_context(db.connection(message_tenant))
+                    await db.store_messages(connections[message_tenant], messages, notify=notify, webhooks=webhooks)
+                    stats['imported'] += len(messages)
+
+            for chunk in _chunks(sources, IMPORT_CHUNK_SIZE):
+                pending.append(loop.run_in_executor(executor, _parse_messages, chunk, db.PARTS_LAYOUT))
+                # bounded number of parsed, but not stored yet messages
+                if len(pending) >= workers * 2:
+                    await store()
+            while pending:
+                await store()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    stats['duration'] = round(time.monotonic() - started_at, 3)
+    logger.info('messages imported', workers=workers, notify=notify, webhooks=webhooks, tenant=tenant, **stats)
+    return stats
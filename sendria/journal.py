@@ -0,0 +1,286 @@
+__all__ = ['Record', 'setup', 'enabled', 'append', 'load', 'release', 'close', 'size']
+
+import asyncio
+import json
+import os
+import pathlib
+import struct
+import threading
+import zlib
+from email.message import Message as EmailMessage
+from typing import Optional, NoReturn, BinaryIO, Iterable, Iterator, Dict, List, Any, Tuple
+
+from structlog import get_logger
+
+from . import metrics
+from .message import Message
+
+logger = get_logger()
+# new segment is started above that size, old ones are removed when all their messages are stored
+SEGMENT_SIZE = 64 * 1024 * 1024
+# record: header, envelope (JSON), message as received (DATA), trailer with crc32 of envelope and message
+RECORD_MAGIC = b'SJR1'
+RECORD_HEADER = struct.Struct('>4sIQ')
+RECORD_TRAILER = struct.Struct('>I')
+COPY_CHUNK_SIZE = 64 * 1024
+# append only, so size of file is the only metadata which has to be synced
+_fsync = getattr(os, 'fdatasync', os.fsync)
+
+JournalDir: Optional[pathlib.Path] = None
+# segments with messages not stored yet, and the one written to; accessed from SMTP thread (append) and main one
+# (release), under the lock
+Lock = threading.Lock()
+Segments: Dict[int, 'Segment'] = {}
+Current: Optional['Segment'] = None
+# bytes appended since start, and how many of them are known to be on disk
+Written = 0
+Synced = 0
+# SMTP thread: fsync in progress, every message appended meanwhile waits for the next one
+Syncing: Optional[asyncio.Future] = None
+# descriptors of finished segments, closed when fsync in progress is done
+Retired: List[int] = []
+
+
+class Segment:
+    __slots__ = ('number', 'path', 'fd', 'size', 'pending')
+
+    def __init__(self, number: int, path: pathlib.Path) -> NoReturn:
+        self.number = number
+        self.path = path
+        # only the current segment is open
+        self.fd: Optional[int] = None
+        self.size = 0
+        # messages appended, but not stored in database yet
+        self.pending = 0
+
+
+class Record:
+    """Message in the journal, from its acceptance until it's stored in database."""
+    __slots__ = ('segment', 'offset', 'envelope_length', 'data_length', 'tenant', 'trace')
+
+    def __init__(self, segment: Segment, offset: int, envelope_length: int, data_length: int,
+        tenant: Optional[str] = None,
+    ) -> NoReturn:
+        self.segment = segment
+        self.offset = offset
+        self.envelope_length = envelope_length
+        self.data_length = data_length
+        self.tenant = tenant
+        # tracing.Trace, if message is not kept in memory while it waits for storing (see: db.add_message)
+        self.trace = None
+
+
+def _segment_path(number: int) -> pathlib.Path:
+    return JournalDir / f'{number:012d}.journal'
+
+
+def _sync_dir() -> NoReturn:
+    # new and removed segments have to be durable too
+    fd = os.open(JournalDir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _new_segment(number: int) -> Segment:
+    segment = Segment(number, _segment_path(number))
+    segment.fd = os.open(segment.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+    _sync_dir()
+    Segments[number] = segment
+    return segment
+
+
+def _scan(segment: Segment) -> Iterator[Record]:
+    """Complete records of segment, up to the first torn or damaged one (ie. interrupted by crash)."""
+    with segment.path.open('rb') as fh:
+        while True:
+            offset = fh.tell()
+            header = fh.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size or header[:4] != RECORD_MAGIC:
+                break
+            _, envelope_length, data_length = RECORD_HEADER.unpack(header)
+            envelope = fh.read(envelope_length)
+            crc = zlib.crc32(envelope)
+            left = data_length
+            while left > 0:
+                chunk = fh.read(min(COPY_CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                left -= len(chunk)
+            trailer = fh.read(RECORD_TRAILER.size)
+            if left or len(trailer) < RECORD_TRAILER.size or RECORD_TRAILER.unpack(trailer)[0] != crc:
+                break
+            try:
+                tenant = json.loads(envelope).get('tenant')
+            except ValueError:
+                break
+            yield Record(segment, offset, envelope_length, data_length, tenant)
+    logger.warning('journal segment damaged, messages after it are skipped', path=str(segment.path), offset=offset)
+
+
+def setup(journal_dir: pathlib.Path) -> List[Record]:
+    """Start writing to journal in given directory. Returns messages which were accepted, but not stored, before the
+    last shutdown (ie. a crash); they should be stored, then released like new ones."""
+    global JournalDir, Current
+    JournalDir = pathlib.Path(journal_dir)
+    JournalDir.mkdir(parents=True, exist_ok=True)
+
+    records = []
+    number = 0
+    for path in sorted(JournalDir.glob('*.journal')):
+        number = int(path.stem)
+        segment = Segment(number, path)
+        segment_records = list(_scan(segment))
+        if not segment_records:
+            path.unlink()
+            continue
+        segment.size = path.stat().st_size
+        segment.pending = len(segment_records)
+        Segments[number] = segment
+        records.extend(segment_records)
+    Current = _new_segment(number + 1)
+
+    logger.info('journal enabled', path=str(JournalDir), replayed=len(records))
+    return records
+
+
+def enabled() -> bool:
+    return Current is not None
+
+
+def _write(fd: int, data: bytes) -> NoReturn:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _rotate() -> NoReturn:
+    global Current, Synced
+    segment = Current
+    # everything written so far is in this or older segments, and is durable after that
+    os.fsync(segment.fd)
+    Synced = Written
+    Retired.append(segment.fd)
+    segment.fd = None
+    if not segment.pending:
+        segment.path.unlink()
+        del Segments[segment.number]
+    Current = _new_segment(segment.number + 1)
+    if Syncing is None:
+        _close_retired()
+
+
+def _close_retired() -> NoReturn:
+    while Retired:
+        os.close(Retired.pop())
+
+
+async def _sync() -> NoReturn:
+    global Synced, Syncing
+    try:
+        with Lock:
+            target, fd = Written, Current.fd
+        with metrics.JOURNAL_SYNC_SECONDS.time():
+            await asyncio.get_event_loop().run_in_executor(None, _fsync, fd)
+        Synced = max(Synced, target)
+    finally:
+        Syncing = None
+        _close_retired()
+
+
+async def _wait_synced(position: int) -> NoReturn:
+    global Syncing
+    # group commit: one fsync for all messages appended while the previous one was running
+    while Synced < position:
+        if Syncing is None:
+            Syncing = asyncio.ensure_future(_sync())
+        await asyncio.shield(Syncing)
+
+
+async def append(envelope: Dict[str, Any], data: BinaryIO) -> Record:
+    """Write message (envelope and DATA as received) to the journal, and wait until it's on disk. Called from SMTP
+    thread only."""
+    global Written
+    envelope_bytes = json.dumps(envelope, separators=(',', ':')).encode()
+    data_length = data.seek(0, os.SEEK_END)
+    data.seek(0)
+
+    with Lock:
+        if Current.size >= SEGMENT_SIZE:
+            _rotate()
+        segment = Current
+        record = Record(segment, segment.size, len(envelope_bytes), data_length, envelope.get('tenant'))
+        try:
+            _write(segment.fd, RECORD_HEADER.pack(RECORD_MAGIC, len(envelope_bytes), data_length) + envelope_bytes)
+            crc = zlib.crc32(envelope_bytes)
+            while True:
+                chunk = data.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                _write(segment.fd, chunk)
+            _write(segment.fd, RECORD_TRAILER.pack(crc))
+        except OSError:
+            # ie. disk is full: partial record would hide the ones after it from replay
+            os.ftruncate(segment.fd, segment.size)
+            raise
+        length = RECORD_HEADER.size + len(envelope_bytes) + data_length + RECORD_TRAILER.size
+        segment.size += length
+        segment.pending += 1
+        Written += length
+        position = Written
+
+    await _wait_synced(position)
+    return record
+
+
+def load(record: Record) -> Tuple[Optional[str], EmailMessage]:
+    """Tenant and parsed message of record (see: smtp.AsyncMessage.handle_DATA)."""
+    with record.segment.path.open('rb') as fh:
+        fh.seek(record.offset + RECORD_HEADER.size)
+        envelope = json.loads(fh.read(record.envelope_length))
+        email = Message.parse_email(fh, envelope['peer'], envelope['mail_from'], envelope['rcpt_tos'],
+            length=record.data_length)
+    return envelope.get('tenant'), email
+
+
+def release(records: Iterable[Record]) -> NoReturn:
+    """Messages of given records are stored in database, they're not needed in the journal anymore."""
+    with Lock:
+        for record in records:
+            segment = record.segment
+            segment.pending -= 1
+            if segment.pending:
+                continue
+            if segment is Current:
+                # nothing is waiting, the next messages can be written from the start
+                os.ftruncate(segment.fd, 0)
+                segment.size = 0
+            else:
+                segment.path.unlink()
+                del Segments[segment.number]
+
+
+def size() -> int:
+    """Bytes of all segments, ie. of messages which are not stored yet."""
+    with Lock:
+        return sum(segment.size for segment in Segments.values())
+
+
+def close() -> NoReturn:
+    global Current
+    if Current is None:
+        return
+    with Lock:
+        os.fsync(Current.fd)
+        Retired.append(Current.fd)
+        _close_retired()
+        if not Current.pending:
+            Current.path.unlink()
+            del Segments[Current.number]
+        Current = None
+    logger.info('journal closed', pending=sum(segment.pending for segment in Segments.values()))
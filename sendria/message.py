@@ -1,10 +1,24 @@
-__all__ = ['Message']
+__all__ = ['Message', 'SENDER_ROLES', 'RECIPIENT_ROLES']
 
+import binascii
+import re
 import uuid
+from email.feedparser import FeedParser
 from email.header import decode_header as _decode_header
 from email.message import Message as EmailMessage
-from email.utils import getaddresses
-from typing import Union, List, Dict, Any
+from email.utils import getaddresses, parseaddr
+from typing import Union, List, Dict, Any, Optional, Iterable, Iterator, Tuple, BinaryIO, Type
+
+# the same as email.generator does with line endings of payloads
+RE_NEWLINES = re.compile(r'\r\n|\r|\n')
+# bodies are decoded in chunks of about this size (cut at line ends)
+DECODE_CHUNK_SIZE = 64 * 1024
+# received messages are parsed from files in chunks of this size
+PARSE_CHUNK_SIZE = 64 * 1024
+
+# roles of addresses in message (see: Message.normalize_addresses)
+SENDER_ROLES = ('mail_from', 'from')
+RECIPIENT_ROLES = ('rcpt_to', 'to', 'cc', 'bcc')
 
 
 class Message:
@@ -17,7 +31,14 @@ class Message:
         'source',
         'size', 'type', 'peer',
         'parts',
+        'headers',
+        # (role, address, domain) of all senders and recipients, normalised
+        'addresses',
         'created_at',
+        # name of tenant (see: tenants) whose store the message belongs to, None: the default one
+        'tenant',
+        # tracing.Trace with timestamps of pipeline stages, only for messages received by this process
+        'trace',
     )
 
     @classmethod
@@ -36,7 +57,21 @@ class Message:
         o.type = email.get_content_type()
         o.peer = ':'.join([i.strip(" '()")for i in email['X-Peer'].split(',')])
         o.parts = []
+        # raw values of all headers, by lowercased name
+        o.headers = {}
+        for name, value in email.items():
+            o.headers.setdefault(name.lower(), []).append(value)
+        o.addresses = cls.normalize_addresses({
+            'mail_from': [o.sender_envelope],
+            'from': [o.sender_message],
+            'rcpt_to': cls.split_addresses(o.recipients_envelope) if o.recipients_envelope else [],
+            'to': o.recipients_message_to,
+            'cc': o.recipients_message_cc,
+            'bcc': o.recipients_message_bcc,
+        })
         o.created_at = None
+        o.tenant = None
+        o.trace = None
 
         for part in cls.iter_message_parts(email):
             cid = part.get('Content-Id') or str(uuid.uuid4())
@@ -46,16 +81,76 @@ class Message:
 
         return o
 
+    @classmethod
+    def parse_email(cls, fh: BinaryIO, peer: str, mail_from: Optional[str], rcpt_tos: List[str],
+        length: Optional[int] = None, message_class: Optional[Type[EmailMessage]] = None,
+    ) -> EmailMessage:
+        """Parse message received over SMTP (length bytes from the current position of fh, or all of them), and add
+        envelope headers. The same as aiosmtpd.handlers.MessageBase.prepare_message does with bytes, but read chunk
+        by chunk, so there's no copy of the whole message in memory."""
+        parser = FeedParser(message_class)
+        while length is None or length > 0:
+            chunk = fh.read(PARSE_CHUNK_SIZE if length is None else min(PARSE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            parser.feed(chunk.decode('ascii', 'surrogateescape'))
+        email = parser.close()
+        email['X-Peer'] = peer
+        email['X-MailFrom'] = mail_from
+        email['X-RcptTo'] = ', '.join(rcpt_tos)
+        return email
+
+    @classmethod
+    def from_db_row(cls, row: Dict[str, Any]) -> 'Message':
+        # row as returned by db.get_message, without parts
+        o = cls()
+        for k in cls.__slots__:
+            setattr(o, k, row.get(k))
+        o.recipients_envelope = ', '.join(row['recipients_envelope'])
+        o.parts = []
+        o.headers = None
+        return o
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             k: getattr(self, k)
             for k in self.__slots__
         }
 
+    def to_summary(self) -> Dict[str, Any]:
+        # the same shape as a row returned by GET /api/messages/, without the source
+        return {
+            'id': self.id,
+            'sender_envelope': self.sender_envelope,
+            'sender_message': self.sender_message,
+            'recipients_envelope': self.split_addresses(self.recipients_envelope) if self.recipients_envelope else [],
+            'recipients_message_to': self.recipients_message_to,
+            'recipients_message_cc': self.recipients_message_cc,
+            'recipients_message_bcc': self.recipients_message_bcc,
+            'subject': self.subject,
+            'size': self.size,
+            'type': self.type,
+            'peer': self.peer,
+            'created_at': self.created_at,
+        }
+
+    def plain_text(self) -> Optional[str]:
+        for part in self.parts:
+            part = part['part']
+            if part.get_content_type() == 'text/plain' and part.get_filename() is None:
+                body = part.get_payload(decode=True) or b''
+                try:
+                    return body.decode(part.get_content_charset() or 'utf-8', 'replace')
+                except LookupError:
+                    return body.decode('utf-8', 'replace')
+        return None
+
     def __repr__(self) -> str:
         r = []
         for k in self.__slots__:
-            if k not in ('source', 'parts'):
+            if k not in ('source', 'parts', 'headers', 'addresses', 'trace'):
                 r.append(f'{k}={getattr(self, k)}')
             else:
                 r.append(f'{k}=...')
@@ -78,6 +173,73 @@ class Message:
         return [('{0} <{1}>'.format(name, addr) if name else addr)
             for name, addr in getaddresses([value])]
 
+    @classmethod
+    def normalize_addresses(cls, addresses: Dict[str, Iterable[Optional[str]]]) -> List[Tuple[str, str, str]]:
+        """Unique (role, address, domain) of addresses given by role, as returned by split_addresses."""
+        ret = []
+        for role, values in addresses.items():
+            seen = set()
+            for value in values:
+                value = (value or '').strip()
+                # split_addresses gives "name <address>", and name may contain commas
+                if value.endswith('>') and '<' in value:
+                    address = value[value.rindex('<') + 1:-1]
+                else:
+                    address = parseaddr(value)[1]
+                address = address.strip().lower()
+                if not address or address in seen:
+                    continue
+                seen.add(address)
+                ret.append((role, address, address.rpartition('@')[2] if '@' in address else ''))
+        return ret
+
+    @classmethod
+    def find_part_body(cls, source: str, part: EmailMessage, start: int = 0) -> Optional[Tuple[int, int]]:
+        """Offset and length of encoded body of given part within source (as_string() of the whole message).
+
+        Parts have to be looked up in order, with start after the body of previous one.
+        """
+        payload = part.get_payload()
+        if not isinstance(payload, str) or not payload:
+            return None
+        body = '\n'.join(RE_NEWLINES.split(payload))
+        # body is always right after the blank line ending headers of its part
+        offset = source.find('\n\n' + body, start)
+        if offset < 0:
+            return None
+        return offset + 2, len(body)
+
+    @classmethod
+    def iter_decoded_body(cls, body: str, encoding: Optional[str]) -> Iterator[bytes]:
+        """Decode body (as found by find_part_body) chunk by chunk, for given Content-Transfer-Encoding."""
+        encoding = (encoding or '').lower()
+        rest = ''
+        start = 0
+        while start < len(body):
+            end = body.find('\n', start + DECODE_CHUNK_SIZE)
+            end = len(body) if end < 0 else end + 1
+            chunk = body[start:end]
+            start = end
+
+            if encoding == 'base64':
+                data = rest + ''.join(chunk.split())
+                rest = data[len(data) - len(data) % 4:]
+                yield binascii.a2b_base64(data[:len(data) - len(rest)])
+            elif encoding == 'quoted-printable':
+                yield binascii.a2b_qp(cls._payload_bytes(chunk))
+            else:
+                yield cls._payload_bytes(chunk)
+        if rest:
+            yield binascii.a2b_base64(rest)
+
+    @staticmethod
+    def _payload_bytes(payload: str) -> bytes:
+        # the same as Message.get_payload(decode=True) for non-ascii payloads
+        try:
+            return payload.encode('ascii')
+        except UnicodeError:
+            return payload.encode('raw-unicode-escape')
+
     @classmethod
     def iter_message_parts(cls, email: EmailMessage) -> EmailMessage:
         if email.is_multipart():
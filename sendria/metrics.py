@@ -0,0 +1,222 @@
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'snapshot', 'CONTENT_TYPE']
+
+import copy
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, NoReturn, Iterable, Dict, Tuple, List, Any
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+Registry: List['Metric'] = []
+
+LabelValues = Tuple[str, ...]
+# values of all metrics of one process, by name: [[label values, value], ...] (see: snapshot)
+Snapshot = Dict[str, List[List[Any]]]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    """Minimal Prometheus metric, rendered in text exposition format.
+
+    Metrics can be updated from SMTP server thread, so all updates are done under lock.
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> NoReturn:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        Registry.append(self)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: expected labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def values(self) -> Dict[LabelValues, Any]:
+        with self._lock:
+            return {key: copy.copy(value) for key, value in self._values.items()}
+
+    def merge(self, values: Dict[LabelValues, Any], other: Iterable[List[Any]]) -> NoReturn:
+        """Add values of the same metric from another process (see: snapshot) to values."""
+        raise NotImplementedError()
+
+    def samples(self, values: Dict[LabelValues, Any]) -> Iterable[str]:
+        raise NotImplementedError()
+
+    def render(self, others: Iterable[Snapshot] = ()) -> List[str]:
+        values = self.values()
+        for other in others:
+            self.merge(values, other.get(self.name, ()))
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+            *self.samples(values),
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs) -> NoReturn:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels) -> NoReturn:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, values: Dict[LabelValues, float], other: Iterable[List[Any]]) -> NoReturn:
+        for key, value in other:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def samples(self, values: Dict[LabelValues, float]) -> Iterable[str]:
+        for key, value in values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels) -> NoReturn:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> NoReturn:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self) -> NoReturn:
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Optional[Iterable[float]] = None, **kwargs) -> NoReturn:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS)) + (math.inf,)
+        # label values -> [per bucket counts..., sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> NoReturn:
+        key = self._label_values(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[idx] += 1
+                    break
+            data[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> NoReturn:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merge(self, values: Dict[LabelValues, List[float]], other: Iterable[List[Any]]) -> NoReturn:
+        for key, data in other:
+            key = tuple(key)
+            if key in values:
+                values[key] = [a + b for a, b in zip(values[key], data)]
+            else:
+                values[key] = list(data)
+
+    def samples(self, values: Dict[LabelValues, List[float]]) -> Iterable[str]:
+        names = self.labelnames + ('le',)
+        for key, data in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(names, key + (_format_value(bound),))} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(data[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+def render(others: Iterable[Snapshot] = ()) -> str:
+    """All metrics, with values of other processes added (ie. of HTTP workers, see: snapshot)."""
+    others = list(others)
+    lines = []
+    for metric in Registry:
+        lines.extend(metric.render(others))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot() -> Snapshot:
+    """Values of all metrics, to be rendered by another process (JSON serializable)."""
+    return {metric.name: [[list(key), value] for key, value in metric.values().items()] for metric in Registry}
+
+
+SMTP_SESSIONS = Counter('sendria_smtp_sessions_total', 'SMTP connections accepted.')
+SMTP_ACTIVE_SESSIONS = Gauge('sendria_smtp_active_sessions', 'SMTP connections currently open.')
+SMTP_REJECTED_SESSIONS = Counter('sendria_smtp_rejected_sessions_total',
+    'SMTP connections closed because of a limit of sessions or messages in one session.', ['limit'])
+SMTP_MESSAGES = Counter('sendria_smtp_messages_total', 'Messages received over SMTP.')
+SMTP_RECEIVED_BYTES = Counter('sendria_smtp_received_bytes_total', 'Size of messages received over SMTP.')
+SMTP_SPOOLED_MESSAGES = Counter('sendria_smtp_spooled_messages_total',
+    'Messages received over SMTP with DATA written to a temporary file.')
+SMTP_PARSE_SECONDS = Histogram('sendria_smtp_parse_seconds', 'Time spent parsing received messages.')
+
+QUEUE_DEPTH = Gauge('sendria_queue_depth', 'Items waiting in internal queue.', ['queue'])
+QUEUE_WAIT_SECONDS = Histogram('sendria_queue_wait_seconds', 'Time items spent waiting in internal queue.', ['queue'])
+
+MESSAGE_STAGE_SECONDS = Histogram('sendria_message_stage_seconds',
+    'Time from the end of SMTP DATA to given pipeline stage of message.', ['stage'])
+
+DB_COMMIT_SECONDS = Histogram('sendria_db_commit_seconds', 'Time spent storing messages in one transaction.')
+DB_COMMIT_BATCH_SIZE = Histogram('sendria_db_commit_batch_size', 'Messages stored in one transaction.',
+    buckets=SIZE_BUCKETS)
+DB_MESSAGES = Gauge('sendria_db_messages', 'Messages stored in database.')
+DB_SIZE_BYTES = Gauge('sendria_db_size_bytes', 'Size of database files.')
+
+JOURNAL_SIZE_BYTES = Gauge('sendria_journal_size_bytes', 'Size of journal of messages not stored in database yet.')
+JOURNAL_SYNC_SECONDS = Histogram('sendria_journal_sync_seconds', 'Time spent syncing journal to disk.')
+
+HTTP_REQUEST_SECONDS = Histogram('sendria_http_request_duration_seconds', 'HTTP requests latency.',
+    ['route', 'method'])
+HTTP_REQUESTS = Counter('sendria_http_requests_total', 'HTTP requests handled.', ['route', 'method', 'status'])
+
+NOTIFIER_CLIENTS = Gauge('sendria_notifier_clients', 'Connected WebSocket and SSE clients.', ['kind'])
+NOTIFIER_DROPPED_CLIENTS = Counter('sendria_notifier_dropped_clients_total', 'Clients disconnected by notifier.',
+    ['reason'])
+
+WEBHOOK_QUEUE_DEPTH = Gauge('sendria_webhook_queue_depth', 'Webhooks waiting for delivery.', ['target'])
+WEBHOOK_REQUEST_SECONDS = Histogram('sendria_webhook_request_duration_seconds', 'Webhook requests latency.',
+    ['target'])
+WEBHOOK_RESPONSES = Counter('sendria_webhook_responses_total',
+    'Webhook responses by HTTP status ("error" when no response was received).', ['target', 'status'])
+WEBHOOK_DELIVERIES = Counter('sendria_webhook_deliveries_total', 'Webhook deliveries by final result.',
+    ['target', 'result'])
@@ -0,0 +1,76 @@
+__all__ = ['setup_loop', 'profile', 'PROFILE_FORMATS', 'PROFILE_MAX_SECONDS']
+
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import time
+from typing import Optional, NoReturn, Tuple
+
+from structlog import get_logger
+
+from .errors import ProfilerBusyException
+
+logger = get_logger()
+# pstats: binary, for `python -m pstats`, snakeviz etc.; text: the most expensive calls, sorted by cumulative time
+PROFILE_FORMATS = ('pstats', 'text')
+PROFILE_MAX_SECONDS = 300
+PROFILE_TEXT_LIMIT = 100
+Profiling = False
+
+
+class _AsyncioLogHandler(logging.Handler):
+    """Pass warnings of asyncio debug mode (ie. slow callbacks) to our logger."""
+
+    def emit(self, record: logging.LogRecord) -> NoReturn:
+        message = record.getMessage()
+        if message.startswith('Executing '):
+            logger.warning('slow callback', details=message, thread=record.threadName)
+        else:
+            logger.warning('asyncio warning', details=message, thread=record.threadName)
+
+
+def setup_loop(loop: asyncio.AbstractEventLoop, slow_callback_threshold: Optional[float]) -> NoReturn:
+    """Log callbacks blocking the loop longer than given threshold (in seconds). Enables asyncio debug mode."""
+    if slow_callback_threshold is None:
+        return
+
+    asyncio_logger = logging.getLogger('asyncio')
+    if not any(isinstance(handler, _AsyncioLogHandler) for handler in asyncio_logger.handlers):
+        asyncio_logger.addHandler(_AsyncioLogHandler(logging.WARNING))
+        asyncio_logger.propagate = False
+
+    loop.slow_callback_duration = slow_callback_threshold
+    loop.set_debug(True)
+
+
+async def profile(seconds: float, fmt: str = 'pstats') -> Tuple[bytes, str]:
+    """Profile everything running in the event loop for given time, return the profile and its file name."""
+    global Profiling
+    # only one profiler can be active at time
+    if Profiling:
+        raise ProfilerBusyException('another profile is being captured')
+
+    Profiling = True
+    profiler = cProfile.Profile()
+    started_at = time.time()
+    logger.info('profiling started', seconds=seconds)
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        Profiling = False
+    logger.info('profiling finished', seconds=seconds)
+
+    name = 'sendria-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at)))
+    if fmt == 'text':
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TEXT_LIMIT)
+        return stream.getvalue().encode(), f'{name}.txt'
+
+    # the same as pstats.Stats.dump_stats does
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats), f'{name}.pstats'
@@ -1,39 +1,137 @@
 __all__ = []
 
+import asyncio
+import re
+import tempfile
+import time
 from email.message import Message as EmailMessage
-from typing import Optional, NoReturn
+from typing import Optional, NoReturn, AnyStr, BinaryIO, List, TYPE_CHECKING
 
 import aiosmtpd.controller
 import aiosmtpd.handlers
 import aiosmtpd.smtp
-from passlib.apache import HtpasswdFile
 from structlog import get_logger
 
 from . import db
+from . import journal
+from . import metrics
+from . import tenants
+from . import tracing
 from .message import Message
 
+if TYPE_CHECKING:
+    from passlib.apache import HtpasswdFile
+
 logger = get_logger()
+# advertised with SIZE extension, bigger messages are rejected; None: no limit
+MAX_MESSAGE_SIZE: Optional[int] = aiosmtpd.smtp.DATA_SIZE_DEFAULT
+# DATA is kept in memory up to that size, bigger one is written to a temporary file (in TMPDIR)
+SPOOL_THRESHOLD = 1024 * 1024
+# how often it's checked if received message can be parsed, when queue of messages waiting for storing is full
+QUEUE_WAIT_INTERVAL = 0.05
+# connections open at the same time, and messages accepted in one of them; the next ones get 421; 0: no limit
+MAX_SESSIONS = 0
+MAX_MESSAGES_PER_SESSION = 0
+# chunk of BDAT is read (and written to spool) in parts of that size
+BDAT_READ_SIZE = 64 * 1024
+# replies to pipelined commands are sent together, but not more than that many at once
+PIPELINE_MAX_REPLIES = 100
+# replies after which the connection is closed (or switched to TLS), they are never held back
+FINAL_REPLIES = (b'220', b'221', b'421')
+RE_BDAT = re.compile(r'^(\d{1,18})(?:\s+(LAST))?$', re.IGNORECASE)
+# SMTP thread only
+ActiveSessions = 0
+
+
+class Envelope(aiosmtpd.smtp.Envelope):
+    def __init__(self) -> NoReturn:
+        super().__init__()
+        # DATA of the message, instead of content and original_content (see: SMTP.smtp_DATA)
+        self.spool: Optional[BinaryIO] = None
+        # chunks received so far with BDAT, and their size (see: SMTP.smtp_BDAT)
+        self.chunks: Optional[BinaryIO] = None
+        self.chunks_size = 0
+
+    def close_chunks(self) -> NoReturn:
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
 
 
 class AsyncMessage(aiosmtpd.handlers.AsyncMessage):
-    def __init__(self, *args, smtp_auth: Optional[HtpasswdFile] = None, **kwargs) -> NoReturn:
+    def __init__(self, *args, smtp_auth: Optional['HtpasswdFile'] = None, **kwargs) -> NoReturn:
         self._smtp_auth = smtp_auth
 
         super().__init__(*args, **kwargs)
 
+    async def handle_EHLO(self, server: aiosmtpd.smtp.SMTP, session: aiosmtpd.smtp.Session,
+        envelope: aiosmtpd.smtp.Envelope, hostname: str, responses: List[str],
+    ) -> List[str]:
+        session.host_name = hostname
+        # before the last one ("250 HELP")
+        return responses[:-1] + ['250-PIPELINING', '250-CHUNKING'] + responses[-1:]
+
+    async def handle_DATA(self, server: aiosmtpd.smtp.SMTP, session: aiosmtpd.smtp.Session,
+        envelope: aiosmtpd.smtp.Envelope,
+    ) -> str:
+        trace = tracing.Trace(time.time())
+        # parsed messages are kept in memory until they are stored, so a new one is not parsed above the limit;
+        # meanwhile it waits in the spool, and its sender for the reply
+        while not db.queue_has_room(envelope.spool.tell()):
+            await asyncio.sleep(QUEUE_WAIT_INTERVAL)
+        metrics.SMTP_MESSAGES.inc()
+        metrics.SMTP_RECEIVED_BYTES.inc(envelope.spool.tell())
+        with metrics.SMTP_PARSE_SECONDS.time():
+            email = self.prepare_message(session, envelope)
+            message = Message.from_email(email)
+        trace.mark('parsed')
+
+        message.tenant = tenants.route(message, getattr(server, '_username', None))
+        self._log_message(email, message.tenant)
+        message.trace = trace
+        record = None
+        if journal.enabled():
+            # on disk before the reply, so accepted message is not lost if it's not stored before shutdown or crash
+            record = await journal.append({
+                'peer': str(session.peer),
+                'mail_from': envelope.mail_from,
+                'rcpt_tos': envelope.rcpt_tos,
+                'tenant': message.tenant,
+            }, envelope.spool)
+            trace.mark('journaled')
+        db.add_message(message, record)
+        return '250 OK'
+
+    def prepare_message(self, session: aiosmtpd.smtp.Session, envelope: Envelope) -> EmailMessage:
+        envelope.spool.seek(0)
+        return Message.parse_email(envelope.spool, str(session.peer), envelope.mail_from, envelope.rcpt_tos,
+            message_class=self.message_class)
+
     async def handle_message(self, email: EmailMessage) -> NoReturn:
+        # not used by handle_DATA, kept for aiosmtpd.handlers.AsyncMessage API
+        self._log_message(email)
+        db.add_message(Message.from_email(email))
+
+    @staticmethod
+    def _log_message(email: EmailMessage, tenant: Optional[str] = None) -> NoReturn:
         logger.debug("message received",
             envelope_from=email['X-MailFrom'],
             envelope_to=email['X-RcptTo'],
             peer=':'.join([i.strip(" '()")for i in email['X-Peer'].split(',')]),
+            tenant=tenant,
         )
-        db.add_message(Message.from_email(email))
 
 
 class SMTP(aiosmtpd.smtp.SMTP):
-    def __init__(self, handler: AsyncMessage, smtp_auth: Optional[HtpasswdFile], *args, **kwargs) -> NoReturn:
+    def __init__(self, handler: AsyncMessage, smtp_auth: Optional['HtpasswdFile'], *args, **kwargs) -> NoReturn:
         self._smtp_auth = smtp_auth
         self._username = None
+        # over MAX_SESSIONS, the connection is closed right after 421 reply
+        self._rejected = False
+        self._messages = 0
+        # replies held back until the pipelined commands received together are handled (see: push)
+        self._replies: List[bytes] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
 
         super().__init__(
             handler,
@@ -43,14 +141,213 @@ class SMTP(aiosmtpd.smtp.SMTP):
             *args, **kwargs,
         )
 
+    def _create_envelope(self) -> Envelope:
+        return Envelope()
+
+    async def smtp_DATA(self, arg: str) -> NoReturn:
+        # the same as aiosmtpd.smtp.SMTP.smtp_DATA, but lines are written to a spool file instead of being collected
+        # in memory (see: SPOOL_THRESHOLD)
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed('DATA'):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if self.envelope.chunks is not None:
+            await self.push('503 Error: DATA not allowed after BDAT')
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD) as spool:
+            error = await self._read_data(spool)
+            if error:
+                self._set_post_data_state()
+                await self.push(error)
+                return
+
+            status = await self._deliver(spool)
+        self._set_post_data_state()
+        await self.push(status)
+
+    @aiosmtpd.smtp.syntax('BDAT size [LAST]')
+    async def smtp_BDAT(self, arg: str) -> NoReturn:
+        # CHUNKING (RFC 3030): message is sent in chunks of given size, as they are (no dot-stuffing, any bytes),
+        # the last one marked with LAST; chunk is read even if the command is rejected, pipelining client has sent
+        # it already
+        match = RE_BDAT.match(arg or '')
+        if not match:
+            await self.push('501 Syntax: BDAT size [LAST]')
+            return
+        size, last = int(match.group(1)), bool(match.group(2))
+
+        error = None
+        if not self.session.host_name:
+            error = '503 Error: send HELO first'
+        elif self._auth_required and not self.session.authenticated:
+            error = '530 5.7.0 Authentication required'
+        elif not self.envelope.rcpt_tos:
+            error = '503 Error: need RCPT command'
+        elif self.data_size_limit and self.envelope.chunks_size + size > self.data_size_limit:
+            error = '552 Error: Too much mail data'
+        if not error and self.envelope.chunks is None:
+            self.envelope.chunks = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        if not await self._read_chunk(size, None if error else self.envelope.chunks):
+            return
+        if error:
+            if self.envelope.chunks is not None:
+                # message is rejected, the next chunks of it are too
+                self._set_post_data_state()
+            await self.push(error)
+            return
+
+        self.envelope.chunks_size += size
+        if not last:
+            await self.push(f'250 OK, {size} octets received')
+            return
+        spool, self.envelope.chunks = self.envelope.chunks, None
+        with spool:
+            status = await self._deliver(spool)
+        self._set_post_data_state()
+        await self.push(status)
+
+    async def _read_chunk(self, size: int, spool: Optional[BinaryIO]) -> bool:
+        """Read BDAT chunk into spool, or skip it if spool is None. Returns False if connection is lost."""
+        while size > 0:
+            try:
+                data = await self._reader.read(min(size, BDAT_READ_SIZE))
+            except asyncio.CancelledError:
+                logger.info('connection lost during BDAT')
+                self._writer.close()
+                raise
+            if not data:
+                return False
+            # big chunk on slow connection
+            self._reset_timeout()
+            if spool is not None:
+                spool.write(data)
+            size -= len(data)
+        return True
+
+    async def _deliver(self, spool: BinaryIO) -> str:
+        """Pass complete message (DATA or all BDAT chunks) to handler, returns reply for client."""
+        if spool.tell() > SPOOL_THRESHOLD:
+            metrics.SMTP_SPOOLED_MESSAGES.inc()
+        self.envelope.spool = spool
+        status = await self._call_handler_hook('DATA')
+        if status is aiosmtpd.smtp.MISSING:
+            status = '250 OK'
+        if status.startswith('250'):
+            self._messages += 1
+        return status
+
+    async def _read_data(self, spool: BinaryIO) -> Optional[str]:
+        """Read DATA until the lone dot, removing dot-stuffing. Returns error reply if it's not acceptable, the
+        rest of DATA is read anyway (RFC 5321, 4.2.5)."""
+        error = None
+        size = 0
+        # readuntil gave a part of too long line, the rest of it is read next
+        partial = False
+        while self.transport is not None:
+            try:
+                line = await self._reader.readuntil(b'\r\n')
+            except asyncio.CancelledError:
+                logger.info('connection lost during DATA')
+                self._writer.close()
+                raise
+            except asyncio.LimitOverrunError as exc:
+                line = await self._reader.read(exc.consumed)
+                error = error or '500 Line too long (see RFC5321 4.5.3.1.6)'
+            if not partial and line == b'.\r\n':
+                break
+            size += len(line)
+            if self.data_size_limit and size > self.data_size_limit:
+                error = error or '552 Error: Too much mail data'
+            if not error:
+                spool.write(line[1:] if not partial and line[:1] == b'.' else line)
+            partial = not line.endswith(b'\r\n')
+        return error
+
+    async def smtp_MAIL(self, arg: Optional[str]) -> NoReturn:
+        if MAX_MESSAGES_PER_SESSION and self._messages >= MAX_MESSAGES_PER_SESSION:
+            logger.info('too many messages in SMTP session, closing', peer=str(self.session.peer), messages=self._messages)
+            metrics.SMTP_REJECTED_SESSIONS.inc(limit='messages')
+            await self.push('421 4.7.0 Too many messages in this session, send the next ones in a new one')
+            self.transport.close()
+            return
+        await super().smtp_MAIL(arg)
+
+    def _set_post_data_state(self) -> NoReturn:
+        # transaction is finished or aborted (ie. by RSET or MAIL), chunks received for it are not needed
+        if getattr(self, 'envelope', None) is not None:
+            self.envelope.close_chunks()
+        super()._set_post_data_state()
+
+    async def push(self, status: AnyStr) -> NoReturn:
+        # PIPELINING (RFC 2920): reply is sent when the event loop gets back from this session; commands received
+        # already are read without waiting, so replies to ones received together are sent together, in one write
+        if isinstance(status, str):
+            status = status.encode('utf-8' if self.enable_SMTPUTF8 else 'ascii')
+        self._replies.append(status + b'\r\n')
+        if status[3:4] == b'-':
+            return
+        if len(self._replies) >= PIPELINE_MAX_REPLIES or status[:3] in FINAL_REPLIES:
+            self._flush_replies()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush_replies)
+        await self._writer.drain()
+
+    def _flush_replies(self) -> NoReturn:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # connection could be lost meanwhile
+        if self._replies and self.transport is not None and not self.transport.is_closing():
+            self._writer.write(b''.join(self._replies))
+        self._replies.clear()
+
+    async def _handle_client(self) -> NoReturn:
+        if self._rejected:
+            await self.push('421 4.7.0 Too many connections, try again later')
+            self.transport.close()
+            return
+        await super()._handle_client()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> NoReturn:
+        global ActiveSessions
+        # called once more after STARTTLS, with the same session
+        if self.transport is None:
+            metrics.SMTP_SESSIONS.inc()
+            metrics.SMTP_ACTIVE_SESSIONS.inc()
+            ActiveSessions += 1
+            if MAX_SESSIONS and ActiveSessions > MAX_SESSIONS:
+                logger.warning('too many SMTP connections, rejecting', peer=str(transport.get_extra_info('peername')),
+                    max_sessions=MAX_SESSIONS)
+                metrics.SMTP_REJECTED_SESSIONS.inc(limit='sessions')
+                self._rejected = True
+        super().connection_made(transport)
+
+    def connection_lost(self, error: Optional[Exception]) -> NoReturn:
+        global ActiveSessions
+        metrics.SMTP_ACTIVE_SESSIONS.dec()
+        ActiveSessions -= 1
+        if self.envelope is not None:
+            self.envelope.close_chunks()
+        super().connection_lost(error)
+
     def authenticate(self, mechanism: str, login: str, password: str) -> bool:
-        if not self._smtp_auth:
-            return True
-        return self._smtp_auth.check_password(login, password)
+        if self._smtp_auth and not self._smtp_auth.check_password(login, password):
+            return False
+        # messages of the session are routed to tenant of this user (see: tenants.route)
+        self._username = login.decode('utf-8', 'replace') if isinstance(login, bytes) else login
+        return True
 
 
 class Controller(aiosmtpd.controller.Controller):
-    def __init__(self, handler: AsyncMessage, smtp_auth: Optional[HtpasswdFile], debug: bool, *args, **kwargs) -> NoReturn:
+    def __init__(self, handler: AsyncMessage, smtp_auth: Optional['HtpasswdFile'], debug: bool, *args, **kwargs) -> NoReturn:
         self.smtp_auth = smtp_auth
         self.debug = debug
         self.ident = kwargs.pop('ident')
@@ -59,10 +356,23 @@ class Controller(aiosmtpd.controller.Controller):
         super().__init__(handler, ready_timeout=5.0, *args, **kwargs)
 
     def factory(self) -> SMTP:
-        return SMTP(self.handler, self.smtp_auth, ident=self.ident, hostname=self.hostname)
+        return SMTP(self.handler, self.smtp_auth, ident=self.ident, hostname=self.hostname, data_size_limit=MAX_MESSAGE_SIZE)
+
 
+def run(smtp_host: str, smtp_port: int, smtp_auth: Optional['HtpasswdFile'], ident: Optional[str], debug: bool,
+    max_message_size: Optional[int] = None, spool_threshold: Optional[int] = None,
+    max_sessions: Optional[int] = None, max_messages_per_session: Optional[int] = None,
+) -> Controller:
+    global MAX_MESSAGE_SIZE, SPOOL_THRESHOLD, MAX_SESSIONS, MAX_MESSAGES_PER_SESSION
+    if max_message_size is not None:
+        MAX_MESSAGE_SIZE = max_message_size or None
+    if spool_threshold is not None:
+        SPOOL_THRESHOLD = spool_threshold
+    if max_sessions is not None:
+        MAX_SESSIONS = max_sessions
+    if max_messages_per_session is not None:
+        MAX_MESSAGES_PER_SESSION = max_messages_per_session
 
-def run(smtp_host: str, smtp_port: int, smtp_auth: Optional[HtpasswdFile], ident: Optional[str], debug: bool) -> Controller:
     message = AsyncMessage(smtp_auth=smtp_auth)
     controller = Controller(message, smtp_auth, debug, hostname=smtp_host, port=smtp_port, ident=ident)
     controller.start()
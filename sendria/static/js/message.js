@@ -79,7 +79,7 @@
             this.dom().addClass('deleted');
             this.selectSibling();
             this.closeNotification();
-            restCall('DELETE', '/api/messages/' + this.id).fail(function() {
+            restCall('DELETE', messagesUrl(this.id)).fail(function() {
                 self._deleted = false;
                 self.dom().removeClass('deleted');
             });
@@ -141,7 +141,7 @@
                 deferred.resolveWith(this);
             }
             else {
-                cleared.watch(restCall('GET', '/api/messages/' + this.id + '.json')).done(function(data) {
+                cleared.watch(restCall('GET', messagesUrl(this.id + '.json'))).done(function(data) {
                     data = data.data;
                     self._loaded = true;
                     self.href = data.href;
@@ -192,7 +192,7 @@
     };
 
     Message.load = function(id, notify) {
-        cleared.watch(restCall('GET', '/api/messages/' + id + '.json')).done(function(msg) {
+        cleared.watch(restCall('GET', messagesUrl(id + '.json'))).done(function(msg) {
             var message = Message.add(msg.data, true);
             Message.applyFilter();
             if (notify) {
@@ -201,6 +201,20 @@
         });
     };
 
+    Message.addNew = function(rows, notify) {
+        // new messages are shown only on the first page, the others are just shifted
+        if (currentPage !== 1) {
+            return;
+        }
+        $.each(rows, function(i, row) {
+            var message = Message.add(row);
+            if (message && notify) {
+                message.showNotification();
+            }
+        });
+        Message.applyFilter();
+    };
+
     Message.add = function(msg, loadedEverything) {
         if (msg.id in messages) {
             console.warn('Message ' + msg.id + ' already exists.');
@@ -215,7 +229,7 @@
         Message.deleteAll();
         $('#loading-dialog').dialog('open');
         // restCall('GET', '/api/messages/').done(function(data) {
-        restCall('GET', '/api/messages/?page=' + currentPage).done(function(data) {
+        restCall('GET', messagesUrl('?page=' + currentPage)).done(function(data) {
             pagesTotal = data.meta.pages_total || 1;
             data = (data.data || []).reverse();
             $.each(data, function(i, msg) {
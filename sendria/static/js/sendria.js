@@ -43,7 +43,7 @@
             if (!confirm('Do you really want to delete all messages?')) {
                 return;
             }
-            restCall('DELETE', '/api/messages/');
+            restCall('DELETE', messagesUrl());
         });
 
         if (NotificationUtil.available) {
@@ -137,7 +137,7 @@
         // Real-time updates
         var wsConnected = false;
         function wsConnect() {
-            var wsUrl = window.location.host + '/ws';
+            var wsUrl = window.location.host + $('body').data('websocket-url') + '?protocol=2';
             try {
                 var socket = new WebSocket('ws://' + wsUrl);
             } catch (err) {
@@ -174,15 +174,20 @@
                 );
             };
             socket.onmessage = function (ev) {
-                var split = ev.data.split(',')
-                if (split[0] === 'add_message') {
-                    Message.load(split[1], $.jStorage.get('notifications'));
-                } else if (split[0] === 'delete_message') {
-                    var msg = Message.get(split[1]);
-                    if (msg) {
-                        msg.del();
-                    }
-                } else if (split[0] === 'delete_messages') {
+                var frame = JSON.parse(ev.data);
+                if (frame.event === 'hello') {
+                    return;
+                } else if (frame.event === 'add_message') {
+                    // summary rows are pushed by server, no need to ask for them
+                    Message.addNew(frame.data, $.jStorage.get('notifications'));
+                } else if (frame.event === 'delete_message') {
+                    $.each(frame.data, function(i, id) {
+                        var msg = Message.get(id);
+                        if (msg) {
+                            msg.del();
+                        }
+                    });
+                } else if (frame.event === 'delete_messages') {
                     Message.deleteAll();
                 } else {
                     console.log('Unknown websocket event:', ev.data)
@@ -43,6 +43,11 @@
 // REST
 (function($, global) {
     'use strict';
+    // messages API of store the page is for (the default one or of a tenant)
+    global.messagesUrl = function messagesUrl(path) {
+        return $('body').data('messages-url') + (path || '');
+    };
+
     global.restCall = function restCall(method, path) {
         return $.ajax({
             url: path,
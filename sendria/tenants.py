@@ -0,0 +1,120 @@
+__all__ = ['Tenant', 'setup', 'enabled', 'names', 'exists', 'route', 'validate_name']
+
+import fnmatch
+import re
+from typing import Optional, NoReturn, Iterable, Dict, List, Any, Union
+
+from structlog import get_logger
+
+from . import exit_err
+from .message import Message
+
+logger = get_logger()
+# tenant name is used in file names of its store and in URLs
+RE_TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,63}$')
+Tenants: Dict[str, 'Tenant'] = {}
+# indexes of routing rules: SMTP AUTH user and recipient domain to tenant name
+SmtpUsers: Dict[str, str] = {}
+Domains: Dict[str, str] = {}
+
+
+class Tenant:
+    """Namespace of messages with its own store and notifications, and rules which messages belong to it."""
+    __slots__ = ('name', 'smtp_users', 'domains', 'headers')
+
+    def __init__(self, name: str, *,
+        smtp_users: Iterable[str] = (),
+        domains: Iterable[str] = (),
+        headers: Optional[Dict[str, Union[str, List[str]]]] = None,
+    ) -> NoReturn:
+        self.name = validate_name(name)
+        self.smtp_users = tuple(smtp_users)
+        self.domains = tuple(domain.strip().lower().lstrip('*@') for domain in domains if domain.strip())
+        # lowercased header name to globs of its value
+        self.headers = {
+            header.lower(): tuple(value.lower() for value in ([values] if isinstance(values, str) else values))
+            for header, values in (headers or {}).items()
+        }
+
+    def matches_headers(self, message: Message) -> bool:
+        for header, patterns in self.headers.items():
+            for value in (message.headers or {}).get(header, ()):
+                value = ' '.join(str(value).split()).lower()
+                if any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns):
+                    return True
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'smtp_users': list(self.smtp_users),
+            'domains': list(self.domains),
+            'headers': {header: list(patterns) for header, patterns in self.headers.items()},
+        }
+
+
+def validate_name(name: Optional[str]) -> str:
+    if not name or not RE_TENANT_NAME.match(name):
+        raise ValueError(f'invalid tenant name: {name!r} (lowercase letters, digits, "-" and "_" only)')
+    return name
+
+
+def _tenant_from_config(cfg: Dict[str, Any]) -> Tenant:
+    return Tenant(cfg.get('name'),
+        smtp_users=cfg.get('smtp_users', ()),
+        domains=cfg.get('domains', ()),
+        headers=cfg.get('headers'),
+    )
+
+
+def setup(tenants: Optional[List[Dict[str, Any]]] = None) -> bool:
+    Tenants.clear()
+    SmtpUsers.clear()
+    Domains.clear()
+
+    try:
+        for cfg in tenants or ():
+            tenant = _tenant_from_config(cfg)
+            if tenant.name in Tenants:
+                raise ValueError(f'tenant "{tenant.name}" defined more than once')
+            Tenants[tenant.name] = tenant
+            for user in tenant.smtp_users:
+                SmtpUsers.setdefault(user, tenant.name)
+            for domain in tenant.domains:
+                Domains.setdefault(domain, tenant.name)
+    except ValueError as exc:
+        exit_err(f'invalid tenant configuration: {exc}')
+
+    if Tenants:
+        logger.info('tenants enabled', tenants=[tenant.to_dict() for tenant in Tenants.values()])
+    return bool(Tenants)
+
+
+def enabled() -> bool:
+    return bool(Tenants)
+
+
+def names() -> List[str]:
+    return list(Tenants)
+
+
+def exists(name: Optional[str]) -> bool:
+    return name in Tenants
+
+
+def route(message: Message, smtp_user: Optional[str] = None) -> Optional[str]:
+    """Name of tenant which given message belongs to, None if it's for the default store.
+
+    Rules are checked in order: SMTP AUTH user, header rules (in order of tenants), domain of envelope recipients.
+    """
+    if not Tenants:
+        return None
+    if smtp_user is not None and smtp_user in SmtpUsers:
+        return SmtpUsers[smtp_user]
+    for tenant in Tenants.values():
+        if tenant.headers and tenant.matches_headers(message):
+            return tenant.name
+    for role, _, domain in message.addresses or ():
+        if role == 'rcpt_to' and domain in Domains:
+            return Domains[domain]
+    return None
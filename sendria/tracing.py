@@ -0,0 +1,156 @@
+__all__ = ['setup', 'Trace', 'register', 'mark', 'mark_webhook', 'get', 'pop_dirty', 'flush_export']
+
+import collections
+import json
+import os
+import pathlib
+import time
+from typing import Optional, NoReturn, Dict, Any, List, Union, TextIO, Tuple
+
+from structlog import get_logger
+
+from . import metrics
+
+logger = get_logger()
+# stages in pipeline order, every one (except received) is stored as offset from received
+STAGES = ('received', 'parsed', 'journaled', 'enqueued', 'committed', 'broadcast')
+WEBHOOK_STAGE = 'webhook_delivered'
+# exported span names, every span ends at given stage and starts at the previous one
+SPAN_NAMES = {
+    'parsed': 'sendria.parse',
+    'journaled': 'sendria.journal',
+    'enqueued': 'sendria.enqueue',
+    'committed': 'sendria.store',
+    'broadcast': 'sendria.notify',
+}
+# traces of recent messages kept in memory, so later stages (broadcast, webhooks) can be attached to them;
+# by tenant and message id, ids are unique only in store of one tenant
+TRACES_CACHE_SIZE = 1000
+Traces: 'collections.OrderedDict[Tuple[Optional[str], int], Trace]' = collections.OrderedDict()
+# traces changed after message was stored, waiting to be saved
+Dirty: Dict[Tuple[Optional[str], int], 'Trace'] = {}
+ExportFile: Optional[TextIO] = None
+
+
+class Trace:
+    """High resolution timestamps of message pipeline stages.
+
+    Stored as ``{"received": <unix time>, "parsed": <ms since received>, ..., "webhook_delivered": {"<target>": <ms>}}``.
+    """
+    __slots__ = ('message_id', 'tenant', 'trace_id', 'received', 'stages', 'webhooks')
+
+    def __init__(self, received: float, trace_id: Optional[str] = None) -> NoReturn:
+        self.message_id: Optional[int] = None
+        self.tenant: Optional[str] = None
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.received = received
+        self.stages: Dict[str, float] = {}
+        self.webhooks: Dict[str, float] = {}
+
+    def offset(self, at: float) -> float:
+        return round((at - self.received) * 1000, 3)
+
+    def mark(self, stage: str, at: Optional[float] = None) -> float:
+        at = at or time.time()
+        self.stages[stage] = self.offset(at)
+        metrics.MESSAGE_STAGE_SECONDS.observe(at - self.received, stage=stage)
+        return at
+
+    def to_dict(self) -> Dict[str, Any]:
+        ret = {'received': self.received, **self.stages}
+        if self.webhooks:
+            ret[WEBHOOK_STAGE] = dict(self.webhooks)
+        return ret
+
+    def dumps(self) -> str:
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+
+def setup(export_file: Optional[Union[str, pathlib.Path]] = None) -> NoReturn:
+    global ExportFile
+
+    if export_file:
+        ExportFile = open(export_file, 'a')  # noqa: SIM115
+        logger.info('spans export enabled', path=str(export_file))
+
+
+def register(message_id: int, trace: Trace, tenant: Optional[str] = None) -> NoReturn:
+    trace.message_id = message_id
+    trace.tenant = tenant
+    Traces[(tenant, message_id)] = trace
+    while len(Traces) > TRACES_CACHE_SIZE:
+        Traces.popitem(last=False)
+
+
+def get(message_id: Union[int, str], tenant: Optional[str] = None) -> Optional[Trace]:
+    try:
+        return Traces.get((tenant, int(message_id)))
+    except ValueError:
+        return None
+
+
+def mark(message_id: int, stage: str, tenant: Optional[str] = None) -> NoReturn:
+    trace = Traces.get((tenant, message_id))
+    if trace is None:
+        return
+    trace.mark(stage)
+    Dirty[(tenant, message_id)] = trace
+    if stage == STAGES[-1]:
+        _export_message(trace)
+
+
+def mark_webhook(message_id: int, target: str, tenant: Optional[str] = None) -> NoReturn:
+    trace = Traces.get((tenant, message_id))
+    if trace is None:
+        return
+    at = time.time()
+    trace.webhooks[target] = trace.offset(at)
+    metrics.MESSAGE_STAGE_SECONDS.observe(at - trace.received, stage=WEBHOOK_STAGE)
+    Dirty[(tenant, message_id)] = trace
+    if ExportFile:
+        start_at = trace.received + trace.stages.get('committed', 0) / 1000
+        _export_span(trace, 'sendria.webhook', start_at, at, parent=_root_span_id(trace), target=target)
+
+
+def pop_dirty() -> List[Trace]:
+    traces = list(Dirty.values())
+    Dirty.clear()
+    return traces
+
+
+def _root_span_id(trace: Trace) -> str:
+    return trace.trace_id[:16]
+
+
+def _export_span(trace: Trace, name: str, start_at: float, end_at: float, parent: Optional[str] = None,
+    **attributes,
+) -> NoReturn:
+    if trace.tenant:
+        attributes['sendria.tenant'] = trace.tenant
+    span = {
+        'traceId': trace.trace_id,
+        'spanId': _root_span_id(trace) if parent is None else os.urandom(8).hex(),
+        'parentSpanId': parent,
+        'name': name,
+        'startTimeUnixNano': int(start_at * 1e9),
+        'endTimeUnixNano': int(end_at * 1e9),
+        'attributes': {'sendria.message_id': trace.message_id, **attributes},
+    }
+    ExportFile.write(json.dumps(span, separators=(',', ':')) + '\n')
+
+
+def _export_message(trace: Trace) -> NoReturn:
+    """Export root span (received -> broadcast) with one child span for every step between stages."""
+    if not ExportFile:
+        return
+
+    stages = [stage for stage in STAGES[1:] if stage in trace.stages]
+    times = [trace.received] + [trace.received + trace.stages[stage] / 1000 for stage in stages]
+    _export_span(trace, 'sendria.message', times[0], times[-1])
+    for stage, start_at, end_at in zip(stages, times, times[1:]):
+        _export_span(trace, SPAN_NAMES[stage], start_at, end_at, parent=_root_span_id(trace))
+
+
+def flush_export() -> NoReturn:
+    if ExportFile:
+        ExportFile.flush()
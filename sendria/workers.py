@@ -0,0 +1,222 @@
+__all__ = ['start', 'stop', 'connect', 'disconnect', 'publish', 'forward', 'add_report', 'reports', 'MAIN_PID']
+
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from typing import Optional, NoReturn, List, Set, Any, Dict, Tuple
+
+import aiohttp
+import aiohttp.web
+from structlog import get_logger
+
+from . import exit_err
+from . import config
+from . import metrics
+from . import tracing
+from .http import notifier
+from .http.json_encoder import JSONEncoder
+
+logger = get_logger()
+# workers have to bind HTTP port and connect to the bus in that time
+START_TIMEOUT = 30.0
+STOP_TIMEOUT = 10.0
+# one line of the bus is one event, ie. delete_message with ids of all messages removed by bulk delete
+BUS_LINE_LIMIT = 64 * 1024 * 1024
+# events are not sent to a worker which has that much of them unread, its clients would be dropped anyway
+BUS_BUFFER_LIMIT = 16 * 1024 * 1024
+# socket of HTTP server of main process, next to the bus; requests which need SMTP server, message saver or webhooks
+# are passed there by workers (see: forward), and workers report their stats there
+CONTROL_SOCKET = 'control.sock'
+# workers report their metrics and notifier stats that often, older reports are of workers which are gone
+REPORT_INTERVAL = 5.0
+REPORT_MAX_AGE = 3 * REPORT_INTERVAL
+# pid of process with SMTP server and message saver, set in HTTP workers
+MAIN_PID: Optional[int] = None
+Processes: List[multiprocessing.Process] = []
+BusDir: Optional[str] = None
+BusServer: Optional[asyncio.AbstractServer] = None
+# main process: connections of workers, their HTTP server for workers and the last reports of them (by number)
+BusClients: Set[asyncio.StreamWriter] = set()
+ControlRunner: Optional[aiohttp.web.AppRunner] = None
+Reports: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+# HTTP worker: connection to main process, and session for its HTTP server (None in main process)
+BusWriter: Optional[asyncio.StreamWriter] = None
+ControlSession: Optional[aiohttp.ClientSession] = None
+Stopping = False
+
+
+def _encode(event: str, args: tuple, data: Any, tenant: Optional[str]) -> bytes:
+    return json.dumps({'event': event, 'args': args, 'data': data, 'tenant': tenant}, cls=JSONEncoder).encode() + b'\n'
+
+
+def _fan_out(line: bytes) -> NoReturn:
+    for writer in list(BusClients):
+        if writer.transport.get_write_buffer_size() > BUS_BUFFER_LIMIT:
+            logger.warning('http worker does not read events, skipping', buffered=writer.transport.get_write_buffer_size())
+            continue
+        writer.write(line)
+
+
+def publish(event: str, args: tuple, data: Any, tenant: Optional[str]) -> NoReturn:
+    """Send notifier event to clients of all HTTP workers (see: notifier.broadcast)."""
+    line = _encode(event, args, data, tenant)
+    if BusWriter is not None:
+        # from worker, main process sends it back to all of them
+        BusWriter.write(line)
+        return
+
+    _fan_out(line)
+    if event == 'add_message':
+        for message_id in args:
+            tracing.mark(message_id, 'broadcast', tenant)
+
+
+async def _bus_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> NoReturn:
+    BusClients.add(writer)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            _fan_out(line)
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+        logger.exception('http worker bus error')
+    finally:
+        BusClients.discard(writer)
+        writer.close()
+    if not Stopping:
+        logger.error('http worker disconnected', workers=len(BusClients))
+
+
+def add_report(number: int, report: Dict[str, Any]) -> NoReturn:
+    """Metrics and notifier stats of HTTP worker (see: _reporter)."""
+    Reports[number] = (time.monotonic(), report)
+
+
+def reports() -> List[Dict[str, Any]]:
+    """The last reports of running HTTP workers, empty without them."""
+    now = time.monotonic()
+    return [report for number, (reported_at, report) in sorted(Reports.items()) if now - reported_at < REPORT_MAX_AGE]
+
+
+async def start(count: int) -> NoReturn:
+    """Start HTTP workers, and route events of notifier from this process to them."""
+    global BusDir, BusServer, ControlRunner
+    from . import http
+
+    BusDir = tempfile.mkdtemp(prefix='sendria-')
+    bus_path = os.path.join(BusDir, 'bus.sock')
+    BusServer = await asyncio.start_unix_server(_bus_client, bus_path, limit=BUS_LINE_LIMIT)
+    notifier.Publisher = publish
+    ControlRunner = aiohttp.web.AppRunner(http.setup_control())
+    await ControlRunner.setup()
+    await aiohttp.web.UnixSite(ControlRunner, os.path.join(BusDir, CONTROL_SOCKET)).start()
+
+    from . import cli
+    # spawn: forking a process with running threads (aiosqlite, SMTP server) is not safe
+    context = multiprocessing.get_context('spawn')
+    for number in range(count):
+        process = context.Process(target=cli.run_http_worker, args=(number, config.CONFIG, bus_path),
+            name=f'sendria-http-{number}')
+        process.start()
+        Processes.append(process)
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while len(BusClients) < count:
+        if any(not process.is_alive() for process in Processes) or time.monotonic() > deadline:
+            await stop()
+            exit_err('http workers failed to start', exitcodes=[process.exitcode for process in Processes])
+        await asyncio.sleep(0.05)
+    logger.info('http workers started', workers=count, pids=[process.pid for process in Processes])
+
+
+async def stop() -> NoReturn:
+    global Stopping
+    Stopping = True
+    for process in Processes:
+        if process.is_alive():
+            process.terminate()
+    loop = asyncio.get_event_loop()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for process in Processes:
+        await loop.run_in_executor(None, process.join, max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.warning('http worker did not stop, killing', pid=process.pid)
+            process.kill()
+    if BusServer is not None:
+        BusServer.close()
+    if ControlRunner is not None:
+        await ControlRunner.cleanup()
+    if BusDir is not None:
+        shutil.rmtree(BusDir, ignore_errors=True)
+
+
+async def _bus_reader(reader: asyncio.StreamReader) -> NoReturn:
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        item = json.loads(line)
+        notifier.deliver(item['event'], *item['args'], data=item['data'], tenant=item['tenant'])
+    if not Stopping:
+        # main process is gone, so is the SMTP server and message saver
+        logger.error('main process disconnected, stopping http worker')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+async def forward(rq: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Pass request to HTTP server of main process, and its response back (in HTTP worker)."""
+    async with ControlSession.request(rq.method, f'http://sendria{rq.rel_url}',
+        data=rq.content if rq.body_exists else None,
+        headers={name: rq.headers[name] for name in ('Content-Type',) if name in rq.headers},
+    ) as rsp:
+        body = await rsp.read()
+    return aiohttp.web.Response(status=rsp.status, body=body,
+        headers={name: rsp.headers[name] for name in ('Content-Type', 'Content-Disposition') if name in rsp.headers})
+
+
+async def _reporter(number: int) -> NoReturn:
+    # main process has no clients of notifier, nor HTTP requests, it gets them from here
+    while True:
+        notifier.update_metrics()
+        report = {'metrics': metrics.snapshot(), 'notifier': notifier.stats()}
+        try:
+            async with ControlSession.put(f'http://sendria/workers/{number}',
+                data=json.dumps(report, cls=JSONEncoder), headers={'Content-Type': 'application/json'},
+            ) as rsp:
+                rsp.raise_for_status()
+        except aiohttp.ClientError:
+            if not Stopping:
+                logger.exception('http worker report failed')
+        await asyncio.sleep(REPORT_INTERVAL)
+
+
+async def connect(bus_path: str, number: int) -> NoReturn:
+    """Receive events of notifier from the bus, and send ones of this worker there; pass some requests to main
+    process (see: forward) and report stats of this worker to it."""
+    global BusWriter, ControlSession, MAIN_PID
+    MAIN_PID = os.getppid()
+    reader, BusWriter = await asyncio.open_unix_connection(bus_path, limit=BUS_LINE_LIMIT)
+    notifier.Publisher = publish
+    # no timeout: imports and profiles take long
+    ControlSession = aiohttp.ClientSession(
+        connector=aiohttp.UnixConnector(os.path.join(os.path.dirname(bus_path), CONTROL_SOCKET)),
+        timeout=aiohttp.ClientTimeout(total=None),
+    )
+    loop = asyncio.get_event_loop()
+    loop.create_task(_bus_reader(reader))
+    loop.create_task(_reporter(number))
+
+
+async def disconnect() -> NoReturn:
+    global Stopping
+    Stopping = True
+    if BusWriter is not None:
+        BusWriter.close()
+    if ControlSession is not None:
+        await ControlSession.close()
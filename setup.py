@@ -1,9 +1,11 @@
+import importlib.util
 import os
 import subprocess
-import shutil
+import sys
 
 from setuptools import setup, find_packages
 from setuptools.command.build_py import build_py
+from setuptools.command.sdist import sdist
 
 requirements = [
     'aiohttp',
@@ -26,28 +28,34 @@ requirements = [
 ]
 
 
+def build_assets():
+    manifest = 'sendria/static/assets/manifest.json'
+    # Lame check if we have prebuilt assets. If we do so we are probably installing from a pypi package which
+    # means that webassets might not be installed yet and thus we cannot build the assets now...
+    if os.path.exists(manifest):
+        return
+
+    if not importlib.util.find_spec('webassets'):
+        print("Cannot find webassets. Please execute manually: python -m sendria.build_assets")
+        return
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-m', 'sendria.build_assets'], stdout=devnull, stderr=devnull)
+
+
 class BuildPyWithAssets(build_py):
     def run(self):
         if not self.dry_run:
-            self._build_assets()
+            build_assets()
         build_py.run(self)
 
-    def _build_assets(self):
-        asset_dir = 'sendria/static/assets'
-        # Lame check if we have prebuilt assets. If we do so we are probably installing from a pypi package which
-        # means that webassets might not be installed yet and thus we cannot build the assets now...
-        if os.path.exists(asset_dir) and os.listdir(asset_dir):
-            return
 
-        webassets = shutil.which('webassets')
-        if not webassets:
-            print("Cannot find webassets. Please execute manually: /path/to/webassets -m sendria.build_assets build'")
-            return
-
-        args = ['webassets', '-m', 'sendria.build_assets', 'build']
-        with open(os.devnull, 'w') as devnull:
-            subprocess.check_call(args, stderr=devnull)
-            subprocess.check_call(args + ['--production'], stderr=devnull)
+class SdistWithAssets(sdist):
+    # assets are not in the repository, they are built for the release
+    def run(self):
+        if not self.dry_run:
+            build_assets()
+        sdist.run(self)
 
 
 with open('README.md') as f:
@@ -75,10 +83,11 @@ setup(
     entry_points={
         'console_scripts': [
             'sendria = sendria.cli:main',
+            'sendria-bench = sendria.bench.cli:main',
         ],
     },
     install_requires=requirements,
-    cmdclass={'build_py': BuildPyWithAssets},
+    cmdclass={'build_py': BuildPyWithAssets, 'sdist': SdistWithAssets},
     # see: https://pypi.python.org/pypi?:action=list_classifiers
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,85 @@
+import asyncio
+import io
+
+import aiohttp.web
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from sendria import db
+from sendria.http import core, middlewares, notifier
+from sendria.message import Message
+
+
+def _message(subject: str) -> Message:
+    source = f'From: a@example.test\r\nTo: b@example.test\r\nSubject: {subject}\r\n\r\nhello\r\n'.encode()
+    email = Message.parse_email(io.BytesIO(source), "('127.0.0.1', 1234)", 'a@example.test', ['b@example.test'])
+    return Message.from_email(email)
+
+
+async def _delete(tmp_path, query: str, no_clear: bool = False):
+    """Status and JSON (None if it's not JSON) of DELETE /api/messages/ with given query string, and number of
+    messages left of 2."""
+    await db.setup(tmp_path / 'sendria.sqlite')
+    async with db.connection() as conn:
+        await db.store_messages(conn, [_message('first'), _message('second')], notify=False, webhooks=False)
+
+    app = aiohttp.web.Application(middlewares=[middlewares.error_handler, middlewares.response_from_dict])
+    app['SENDRIA_NO_CLEAR'] = no_clear
+    app.router.add_delete('/api/messages/', core.delete_messages)
+    async with TestClient(TestServer(app)) as client:
+        rsp = await client.delete(f'/api/messages/?{query}' if query else '/api/messages/')
+        body = await rsp.json() if rsp.content_type == 'application/json' else None
+
+    async with db.connection() as conn:
+        left = await db.get_messages_count(conn)
+    return rsp.status, body, left
+
+
+@pytest.fixture(autouse=True)
+def _notifier(monkeypatch):
+    monkeypatch.setattr(notifier, 'WebsocketMessagesQueue', asyncio.Queue())
+
+
+@pytest.mark.parametrize('query', ['bogus=1', 'befor=2021-03-01', 'recipient=b@example.test', 'to=b@example.test&x=1'])
+def test_unknown_param_does_not_delete_all(tmp_path, query):
+    _, body, left = asyncio.run(_delete(tmp_path, query))
+    assert body['code'] != 'OK'
+    assert 'unknown filters' in body['message']
+    assert left == 2
+
+
+@pytest.mark.parametrize('param', ['until', 'before'])
+def test_until_and_before(tmp_path, param):
+    _, body, left = asyncio.run(_delete(tmp_path, f'{param}=2000-01-01'))
+    assert body == {'code': 'OK', 'data': {'deleted': 0}}
+    assert left == 2
+
+
+def test_match_all_filter_is_rejected(tmp_path):
+    _, body, left = asyncio.run(_delete(tmp_path, 'to=*'))
+    assert body['code'] != 'OK'
+    assert left == 2
+
+
+def test_filtered_delete(tmp_path):
+    _, body, left = asyncio.run(_delete(tmp_path, 'subject=^first$'))
+    assert body == {'code': 'OK', 'data': {'deleted': 1}}
+    assert left == 1
+
+
+def test_no_query_deletes_all(tmp_path):
+    _, body, left = asyncio.run(_delete(tmp_path, ''))
+    assert body == {'code': 'OK', 'data': {}}
+    assert left == 0
+
+
+def test_no_clear_rejects_filters(tmp_path):
+    status, _, left = asyncio.run(_delete(tmp_path, 'since=2000-01-01', no_clear=True))
+    assert status == 403
+    assert left == 2
+
+
+def test_no_clear_allows_ids(tmp_path):
+    _, body, left = asyncio.run(_delete(tmp_path, 'ids=1', no_clear=True))
+    assert body == {'code': 'OK', 'data': {'deleted': 1}}
+    assert left == 1